@@ -4,18 +4,58 @@
 from rest_framework import generics
 from rest_framework import status
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
-from .serializers import UrlSerializer
+from .serializers import UrlSerializer, URL_VALUES, serialize_values
 from app.models import Url
+from app.clicks import click_stats, total_clicks
+from app.middleware import READ_METHODS
+from app.bulk import NDJSONParser, create_rules
+from app.common import get_owner
 
 
-class UrlList(generics.ListAPIView):
-    ''' Возвращает все правила из БД. ''' 
-    queryset = Url.objects.all().order_by('expire_date')
+class ValuesListMixin:
+    ''' Быстрый список правил: страница выбирается через values() и сериализуется в словари без объектов моделей. '''
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).values(*URL_VALUES)
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(serialize_values(page, request))
+
+
+class UrlList(ValuesListMixin, generics.ListAPIView):
+    ''' Возвращает правила из БД постранично (по ключу expire_date, id) с числом переходов. ''' 
+    queryset = Url.objects.select_related('owner').annotate(clicks=total_clicks()).order_by('expire_date', 'id')
     serializer_class = UrlSerializer
+    sessionless = READ_METHODS                                                          # чтение API без сессии (см. app.middleware)
+    throttle_scope = 'api'                                                              # лимит частоты запросов (см. RATE_LIMITS)
 
 
-class UrlViewSet(viewsets.ModelViewSet):
-    ''' Возвращает все правила из БД. ''' 
-    queryset = Url.objects.all().order_by('expire_date')
+class UrlViewSet(ValuesListMixin, viewsets.ModelViewSet):
+    ''' Возвращает правила из БД постранично (по ключу expire_date, id) с числом переходов. ''' 
+    queryset = Url.objects.select_related('owner').annotate(clicks=total_clicks()).order_by('expire_date', 'id')
     serializer_class = UrlSerializer
+    sessionless = READ_METHODS                                                          # чтение API без сессии (см. app.middleware)
+    throttle_scope = 'api'                                                              # лимит частоты запросов (см. RATE_LIMITS)
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser], throttle_scope='bulk')
+    def bulk(self, request):
+        ''' Пакетное создание правил пользователя из JSON-массива либо потока NDJSON (application/x-ndjson).
+            Элемент: {"link": <URL>, "subpart": <субдомен>?, "expire_date": <ГГГГ-ММ-ДД>?}.
+            Возвращает результаты по элементам: id, subpart, alias, expire_date (existing - правило уже было) либо errors.
+            Код ответа: 201 - создано хотя бы одно правило, 200 - все правила уже были, 400 - ни одного правила.
+        '''
+        results = create_rules(request.data, get_owner(request), request.get_host())
+        if any('id' in result and not result.get('existing') for result in results):
+            code = status.HTTP_201_CREATED
+        elif any('id' in result for result in results):                                # только уже сокращённые ссылки
+            code = status.HTTP_200_OK
+        else:
+            code = status.HTTP_400_BAD_REQUEST
+        return Response({'results': results}, status=code)
+
+    @action(detail=True, methods=['get'])
+    def stats(self, request, pk=None):
+        ''' Счётчики переходов по правилу из таблицы ClickStat: всего, по дням, по источникам и типам клиентов. '''
+        rule = self.get_object()
+        return Response(dict(click_stats(rule.id), id=rule.id))
@@ -0,0 +1,13 @@
+"""
+Definition of the application config.
+"""
+
+from django.apps import AppConfig
+
+
+class MainConfig(AppConfig):
+    """ Конфигурация приложения. Подключает обработчики сигналов моделей. """
+    name = 'app'
+
+    def ready(self):
+        from . import signals                                                           # регистрация обработчиков сигналов
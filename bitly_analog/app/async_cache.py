@@ -0,0 +1,26 @@
+# ----- Асинхронный клиент Redis для пути перенаправления (ASGI)
+
+import asyncio, weakref
+from django.conf import settings
+from redis import asyncio as aioredis
+
+from .metrics import AsyncCountingConnectionPool
+
+
+# ----- Глобальные переменные
+ASYNC_REDIS_MAX_CONNECTIONS = getattr(settings, 'ASYNC_REDIS_MAX_CONNECTIONS', 100)     # предел пула соединений на процесс
+
+_clients = weakref.WeakKeyDictionary()                                                  # клиенты по циклам событий
+
+
+def get_async_redis():
+    ''' Возвращает асинхронный клиент Redis с пулом соединений для текущего цикла событий
+        (соединения пула привязаны к циклу, в котором созданы). Адрес - из CACHES['default'].
+    '''
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        pool = AsyncCountingConnectionPool.from_url(settings.CACHES['default']['LOCATION'],   # с учётом обращений (app.metrics)
+                                                    max_connections=ASYNC_REDIS_MAX_CONNECTIONS)
+        client = _clients[loop] = aioredis.Redis(connection_pool=pool)
+    return client
@@ -0,0 +1,171 @@
+# ----- Замеры производительности основных путей приложения
+
+import json, platform, random, statistics
+from datetime import timedelta
+from time import perf_counter
+import django
+from django.contrib.sessions.backends.base import VALID_KEY_CHARS
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from .models import Owner, Session, Url
+from .bloom import rebuild_subpart_filter
+from .periodic_tasks import clean_urls
+from .subparts import refill_subpart_pool
+
+
+# ----- Глобальные переменные
+HIGHER_IS_BETTER = ('rps',)                                                             # метрики, рост которых - улучшение
+METRICS = ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries')                              # сравниваемые метрики сценария
+CLEAN_BATCH = 100                                                                       # просроченных правил на один вызов clean_urls
+HOT_LINKS = 100                                                                         # число часто открываемых ссылок сценария redirect
+
+
+def seed(owners, rules):
+    ''' Заполнение БД: owners пользователей с сессиями и rules правил со сроками 1-30 суток,
+        построение фильтра и пула субдоменов. Возвращает список субдоменов правил.
+        Аргументы:
+        owners (int) -- число пользователей
+        rules  (int) -- число правил
+    '''
+    expire = timezone.now() + timedelta(days=30)
+    sessions = Session.objects.bulk_create([Session(session_key=get_random_string(32, VALID_KEY_CHARS), session_data='',
+                                                    expire_date=expire) for _ in range(owners)])
+    Owner.objects.bulk_create([Owner(session=session) for session in sessions])
+    owner_ids = list(Owner.objects.values_list('id', flat=True))                        # bulk_create не возвращает id (SQLite, MySQL)
+    today = timezone.localdate()
+    urls = []
+    for i in range(rules):
+        link = 'https://example.com/page/{}'.format(i)
+        urls.append(Url(link=link, link_hash=Url.digest(link), subpart='b{}'.format(i), alias='bench/b{}'.format(i),
+                        expire_date=today + timedelta(days=1 + i % 30), owner_id=owner_ids[i % len(owner_ids)]))
+    Url.objects.bulk_create(urls, batch_size=1000)
+    rebuild_subpart_filter()
+    refill_subpart_pool()
+    return [url.subpart for url in urls]
+
+
+def measure(call, requests, before=None):
+    ''' Выполнение call(i) requests раз. Возвращает метрики: пропускная способность (вызовов в секунду),
+        перцентили задержки p50/p95/p99 (мс) и среднее число запросов к БД на вызов.
+        Аргументы:
+        call     (callable) -- вызов сценария с номером итерации
+        requests (int)      -- число вызовов
+        before   (callable) -- подготовка итерации с её номером (вне замера)
+    '''
+    latencies, queries = [], 0
+    for i in range(requests):
+        if before:
+            before(i)
+        with CaptureQueriesContext(connection) as captured:
+            begin = perf_counter()
+            call(i)
+            latencies.append((perf_counter() - begin) * 1000)
+        queries += len(captured)
+    elapsed = sum(latencies) / 1000
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': requests,
+        'seconds': round(elapsed, 4),
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': round(cuts[49], 3),
+        'p95_ms': round(cuts[94], 3),
+        'p99_ms': round(cuts[98], 3),
+        'queries': round(queries / requests, 2),
+    }
+
+
+def scenarios(subparts):
+    ''' Возвращает сценарии замеров {имя: (подготовка сценария, подготовка итерации, вызов)}
+        для клиента Django по данным засеянной БД.
+    '''
+    client = Client()
+    ids = list(Url.objects.filter(subpart__in=subparts[:1000]).values_list('id', flat=True))
+    hot = subparts[:HOT_LINKS]                                                          # часто открываемые ссылки (в кэше после прогрева)
+    cold = iter(subparts[::-1])                                                         # ссылки без маппинга в кэше: каждая - один раз
+    rnd = random.Random(0)
+
+    def create(i):
+        client.post('/', {'link': 'https://example.com/new/{}'.format(i), 'domain': 'bench', 'subpart': '',
+                          'expire_date': (timezone.localdate() + timedelta(days=7)).strftime('%d.%m.%Y')})
+
+    def expire(i):
+        owner_id = Owner.objects.values_list('id', flat=True).first()
+        Url.objects.bulk_create([Url(link='https://example.com/old', subpart='x{}-{}'.format(i, j), alias='bench/x',
+                                     expire_date=timezone.localdate(), owner_id=owner_id) for j in range(CLEAN_BATCH)])
+
+    return {
+        'redirect': (None, None, lambda i: client.get('/' + hot[i % len(hot)])),
+        'redirect_cold': (None, None, lambda i: client.get('/' + next(cold))),
+        'redirect_to': (None, None, lambda i: client.get('/redirect_to/{}/'.format(rnd.choice(ids)))),
+        'check_subpart': (None, None, lambda i: client.get('/ajax_check_subpart/{}/'.format(
+            rnd.choice(subparts) if i % 2 else 'free{}'.format(i)))),
+        'create': (lambda: client.get('/'), None, create),                             # сессия и пользователь - до замера
+        'list': (None, None, lambda i: client.get('/urls_list/')),
+        'clean': (None, expire, lambda i: clean_urls()),                                # CLEAN_BATCH просроченных правил на вызов
+    }
+
+
+def run(owners=100, rules=10000, requests=500, names=None, warmup=50):
+    ''' Засев БД и замеры сценариев. Возвращает отчёт: параметры запуска и метрики по сценариям.
+        Аргументы:
+        owners   (int)  -- число пользователей
+        rules    (int)  -- число правил
+        requests (int)  -- число запросов сценария (для clean - requests // 50 вызовов, redirect_cold - не больше rules // 2)
+        names    (list) -- имена сценариев (None - все)
+        warmup   (int)  -- число вызовов прогрева кэшей перед замером (для redirect - не меньше HOT_LINKS)
+    '''
+    subparts = seed(owners, rules)
+    report = {
+        'meta': {
+            'date': timezone.now().isoformat(), 'python': platform.python_version(), 'django': django.get_version(),
+            'db': connection.vendor, 'owners': owners, 'rules': rules, 'requests': requests,
+        },
+        'results': {},
+    }
+    for name, (prepare, before, call) in scenarios(subparts).items():
+        if names and name not in names:
+            continue
+        if prepare:
+            prepare()
+        if name == 'clean':                                                             # без прогрева: каждый вызов - полная очистка
+            report['results'][name] = measure(call, max(requests // 50, 2), before)
+            continue
+        if name == 'redirect_cold':                                                     # без прогрева: замер промахов кэша
+            report['results'][name] = measure(call, min(requests, rules // 2))
+            continue
+        count = max(warmup, HOT_LINKS) if name == 'redirect' else warmup                # redirect: каждая горячая ссылка - в кэше до замера
+        for i in range(count):
+            call(-1 - i)                                                                # -1..-count по модулю HOT_LINKS - все индексы замера
+        report['results'][name] = measure(call, requests)
+    return report
+
+
+def compare(base, new):
+    ''' Сравнение отчётов: {сценарий: {метрика: (было, стало, изменение в %, ухудшение ли)}}. '''
+    result = {}
+    for name, metrics in new['results'].items():
+        if name not in base['results']:
+            continue
+        result[name] = {}
+        for metric in METRICS:
+            old, value = base['results'][name][metric], metrics[metric]
+            change = (value - old) / old * 100 if old else 0.0
+            worse = change < 0 if metric in HIGHER_IS_BETTER else change > 0
+            result[name][metric] = (old, value, round(change, 1), worse)
+    return result
+
+
+def save_report(report, path):
+    ''' Запись отчёта в JSON-файл. '''
+    with open(path, 'w', encoding='utf-8') as output:
+        json.dump(report, output, ensure_ascii=False, indent=2)
+
+
+def load_report(path):
+    ''' Чтение отчёта из JSON-файла. '''
+    with open(path, encoding='utf-8') as source:
+        return json.load(source)
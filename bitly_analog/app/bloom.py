@@ -0,0 +1,96 @@
+# ----- Фильтр Блума для проверки занятости субдоменов
+
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .models import Url
+
+
+# ----- Глобальные переменные
+SUBPART_FILTER_KEY = 'subparts:bloom'                                                   # ключ битовой карты фильтра в Redis
+SUBPART_FILTER_BITS = getattr(settings, 'SUBPART_FILTER_BITS', 2 ** 24)                 # размер битовой карты (бит)
+SUBPART_FILTER_HASHES = getattr(settings, 'SUBPART_FILTER_HASHES', 7)                   # число хеш-функций
+SUBPART_FILTER_CHUNK = 10000                                                            # размер пачки строк при перестроении
+
+
+class BloomFilter:
+    ''' Фильтр Блума на битовой карте Redis. Отвечает "точно нет" либо "возможно есть".
+        Аргументы:
+        key    (str) -- ключ битовой карты (без префикса кэша)
+        bits   (int) -- размер битовой карты
+        hashes (int) -- число хеш-функций
+    '''
+    def __init__(self, key, bits, hashes):
+        self.key = cache.make_key(key)                                                  # префикс и версия как у ключей кэша
+        self.bits = bits
+        self.hashes = hashes
+
+    def offsets(self, item):
+        ''' Возвращает номера битов элемента (двойное хеширование одного дайджеста). '''
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, *items):
+        ''' Добавление элементов в фильтр одним конвейером SETBIT.
+            Пока фильтр не построен, элементы не добавляются: частичная битовая карта давала бы ложные "точно нет".
+        '''
+        conn = get_redis_connection('default')
+        if not conn.exists(self.key):
+            return
+        pipe = conn.pipeline(transaction=False)
+        for item in items:
+            for offset in self.offsets(item):
+                pipe.setbit(self.key, offset, 1)
+        pipe.execute()
+
+    def might_contain(self, item):
+        ''' Возвращает False, только если элемента точно нет в фильтре.
+            Отсутствие битовой карты или ошибка Redis трактуются как "возможно есть".
+        '''
+        pipe = get_redis_connection('default').pipeline(transaction=False)
+        pipe.exists(self.key)
+        for offset in self.offsets(item):
+            pipe.getbit(self.key, offset)
+        try:
+            exists, *bits = pipe.execute()                                              # один запрос к Redis
+        except RedisError:
+            return True
+        return not exists or all(bits)
+
+    def rebuild(self, items):
+        ''' Перестроение фильтра: битовая карта собирается в памяти и атомарно заменяет текущую.
+            Аргументы:
+            items (iterable) -- все элементы множества
+        '''
+        bitmap = bytearray((self.bits + 7) // 8)
+        count = 0
+        for item in items:
+            for offset in self.offsets(item):
+                bitmap[offset >> 3] |= 0x80 >> (offset & 7)                             # порядок битов как у SETBIT
+            count += 1
+        conn = get_redis_connection('default')
+        tmp_key = self.key + ':tmp'
+        conn.set(tmp_key, bytes(bitmap))
+        conn.rename(tmp_key, self.key)
+        return count
+
+
+subpart_filter = BloomFilter(SUBPART_FILTER_KEY, SUBPART_FILTER_BITS, SUBPART_FILTER_HASHES)
+
+
+def rebuild_subpart_filter():
+    ''' Перестроение фильтра субдоменов по таблице Url. Возвращает число субдоменов в фильтре.
+        Правила, созданные во время перестроения, досылаются в новый фильтр.
+    '''
+    last_id = Url.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    subparts = Url.objects.filter(id__lte=last_id).values_list('subpart', flat=True)
+    count = subpart_filter.rebuild(subparts.iterator(chunk_size=SUBPART_FILTER_CHUNK))
+    added = list(Url.objects.filter(id__gt=last_id).values_list('subpart', flat=True))
+    if added:
+        subpart_filter.add(*added)
+    return count + len(added)
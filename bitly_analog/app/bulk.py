@@ -0,0 +1,203 @@
+# ----- Пакетное создание правил (API)
+
+import json
+from datetime import date, timedelta
+from itertools import islice
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from .models import Url, Collection, Log
+from .common import logger, save_rule, cache_links, drop_link, invalidate_rules, find_rules, DEDUPLICATE_LINKS
+from .bloom import subpart_filter
+from .forms import SUBPART_DUPLICATE
+from .subparts import pop_subparts, renew_subpart
+
+
+# ----- Глобальные переменные
+BULK_BATCH_SIZE = getattr(settings, 'BULK_BATCH_SIZE', 1000)                            # число правил в одной транзакции
+BULK_MAX_ITEMS = getattr(settings, 'BULK_MAX_ITEMS', 50000)                             # предел числа правил в одном запросе
+LINK_LENGTH = Url._meta.get_field('link').max_length                                    # предел длины оригинальной ссылки
+SUBPART_MAX_LENGTH = Url._meta.get_field('subpart').max_length                          # предел длины субдомена
+SUBPART_ATTEMPTS = 5                                                                    # число попыток подбора свободных субдоменов
+validate_link = URLValidator()
+
+
+class NDJSONParser(BaseParser):
+    ''' Парсер потока NDJSON (JSON-объект в каждой строке): строки читаются из тела запроса по мере обработки. '''
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line.decode(encoding))
+                except ValueError:                                                      # строка отмечается ошибкой в результатах
+                    yield None
+
+
+def clean_item(item, today, default_expire):
+    ''' Проверка одного элемента запроса. Возвращает кортеж (link, subpart, expire_date, ошибки).
+        Аргументы:
+        item           (dict) -- {'link': <URL>, 'subpart': <субдомен>?, 'expire_date': <ГГГГ-ММ-ДД>?}
+        today          (date) -- текущая дата
+        default_expire (date) -- дата удаления по умолчанию (срок жизни правил пользователя)
+    '''
+    if not isinstance(item, dict):
+        return None, None, None, {'item': ['Ожидается JSON-объект.']}
+    errors = {}
+    link = item.get('link')
+    try:
+        if not isinstance(link, str) or len(link) > LINK_LENGTH:
+            raise ValidationError('Некорректная ссылка.')
+        validate_link(link)
+    except ValidationError as exc:
+        errors['link'] = exc.messages
+    subpart = item.get('subpart') or ''
+    if not isinstance(subpart, str) or len(subpart) > SUBPART_MAX_LENGTH or '/' in subpart:
+        errors['subpart'] = ['Некорректный субдомен.']
+    expire_date = item.get('expire_date') or default_expire
+    try:
+        if not isinstance(expire_date, date):
+            expire_date = date.fromisoformat(expire_date)
+        if expire_date <= today:
+            errors['expire_date'] = ['Дата удаления должна быть позже текущей.']
+    except (TypeError, ValueError):
+        errors['expire_date'] = ['Ожидается дата в формате ГГГГ-ММ-ДД.']
+    return link, subpart, expire_date, errors
+
+
+def assign_subparts(urls, generated):
+    ''' Проверка субдоменов пачки одним запросом к БД. Занятые сгенерированные субдомены заменяются
+        и проверяются повторно. Возвращает множество занятых субдоменов, заданных пользователем.
+        Аргументы:
+        urls      (list) -- несохранённые объекты правил
+        generated (set)  -- id() объектов правил с генерируемым субдоменом
+    '''
+    busy = set(Url.objects.filter(subpart__in=[url.subpart for url in urls]).values_list('subpart', flat=True))
+    taken = {url.subpart for url in urls if url.subpart in busy and id(url) not in generated}
+    pending = [url for url in urls if url.subpart in busy and id(url) in generated]
+    for _ in range(SUBPART_ATTEMPTS):
+        if not pending:
+            break
+        for url in pending:
+            renew_subpart(url)
+        busy = set(Url.objects.filter(subpart__in=[url.subpart for url in pending]).values_list('subpart', flat=True))
+        pending = [url for url in pending if url.subpart in busy]
+    return taken
+
+
+def create_batch(items, owner, domain, start):
+    ''' Проверка и запись пачки правил: bulk_create для Url и Collection, маппинги - в Redis одним конвейером.
+        Найденные действующие правила с той же ссылкой продлеваются до более поздней даты удаления (bulk_update).
+        Возвращает результаты по элементам пачки.
+        Аргументы:
+        items  (list)  -- элементы запроса
+        owner  (Owner) -- объект пользователя
+        domain (str)   -- домен коротких ссылок
+        start  (int)   -- номер первого элемента пачки в запросе
+    '''
+    today = timezone.localdate()
+    default_expire = today + timedelta(days=owner.url_ttl)
+    results, urls, generated, seen, extended = [], [], set(), set(), {}
+    cleaned = [clean_item(item, today, default_expire) for item in items]
+    wanted = [Url.normalize_link(link) for link, subpart, expire, errors in cleaned if not errors and not subpart]
+    # действующие правила пользователя для тех же ссылок - одним запросом на пачку (см. DEDUPLICATE_LINKS)
+    links = find_rules(owner, wanted) if DEDUPLICATE_LINKS else {}
+    known = set(links)
+    auto = iter(pop_subparts(len(set(wanted) - known) if DEDUPLICATE_LINKS else len(wanted)))
+    for index, (link, subpart, expire_date, errors) in enumerate(cleaned, start):
+        if not errors and subpart in seen:
+            errors = {'subpart': [SUBPART_DUPLICATE]}                                   # дубликат внутри запроса
+        result = {'index': index}
+        results.append(result)
+        if errors:
+            result['errors'] = errors
+            continue
+        normalized = None if subpart else Url.normalize_link(link)
+        if normalized in links:                                                         # ссылка уже сокращена
+            rule = result['url'] = links[normalized]
+            result['existing'] = normalized in known
+            if result['existing'] and rule.expire_date < expire_date:                   # продление правила до новой даты (как в views.home)
+                rule.expire_date = expire_date
+                extended[rule.pk] = rule
+            continue
+        url = result['url'] = Url(link=link, subpart=subpart or next(auto), expire_date=expire_date, owner=owner,
+                                  link_hash=Url.digest(link))                          # bulk_create не вызывает Url.save
+        url.alias = '{}/{}'.format(domain, url.subpart)
+        if not subpart:
+            generated.add(id(url))
+            if DEDUPLICATE_LINKS:
+                links[normalized] = url
+        seen.add(url.subpart)
+        urls.append(url)
+
+    taken = assign_subparts(urls, generated)
+    urls = [url for url in urls if url.subpart not in taken]
+    try:
+        with transaction.atomic():
+            Url.objects.bulk_create(urls)
+            if urls and urls[0].pk is None:                                             # MySQL не возвращает id вставленных строк
+                ids = dict(Url.objects.filter(subpart__in=[url.subpart for url in urls]).values_list('subpart', 'id'))
+                for url in urls:
+                    url.pk = ids[url.subpart]
+            Collection.objects.bulk_create([Collection(owner=owner, url=url) for url in urls])
+    except IntegrityError:                                                              # субдомен занят параллельным запросом
+        for url in urls:                                                                # построчная запись с сигналами post_save
+            url.pk, url._state.adding = None, True
+        urls = [url for url in urls if save_rule(url, renew_subpart if id(url) in generated else None)]
+        Collection.objects.bulk_create([Collection(owner=owner, url=url) for url in urls])
+    else:
+        if urls:                                                                        # bulk_create не отправляет сигналы post_save:
+            cache_links((url.subpart, url.link, url.expire_date, url.redirect_status) for url in urls)  # кэш обновляется для всей пачки
+            subpart_filter.add(*(url.subpart for url in urls))
+            invalidate_rules(owner.id)
+    if extended:                                                                        # продлённые правила - одним запросом на пачку
+        Url.objects.bulk_update(extended.values(), ['expire_date'])
+        cache_links((url.subpart, url.link, url.expire_date, url.redirect_status) for url in extended.values())
+        drop_link(*(url.subpart for url in extended.values()), shared=False)             # L1-кэши процессов - после записи в Redis
+        invalidate_rules(owner.id)
+
+    for result in results:
+        url = result.pop('url', None)
+        if url is None:
+            continue
+        if url.pk is None:
+            result['errors'] = {'subpart': [SUBPART_DUPLICATE]}
+        else:
+            result.update({'id': url.pk, 'subpart': url.subpart, 'alias': url.alias,
+                           'expire_date': url.expire_date.isoformat()})
+    return results
+
+
+def create_rules(items, owner, domain, batch_size=BULK_BATCH_SIZE):
+    ''' Пакетное создание правил пользователя пачками по batch_size. Возвращает результаты по элементам запроса.
+        Элементы сверх BULK_MAX_ITEMS не обрабатываются (последний результат - ошибка превышения предела).
+        Аргументы:
+        items      (iterable) -- элементы запроса (JSON-массив либо поток NDJSON)
+        owner      (Owner)    -- объект пользователя
+        domain     (str)      -- домен коротких ссылок
+        batch_size (int)      -- число правил в пачке
+    '''
+    if isinstance(items, (dict, str)) or not hasattr(items, '__iter__'):
+        raise ParseError('Ожидается JSON-массив либо поток NDJSON.')
+    if isinstance(items, list) and len(items) > BULK_MAX_ITEMS:
+        raise ParseError('Превышен предел числа правил в запросе: {}.'.format(BULK_MAX_ITEMS))
+    items = iter(items)
+    results = []
+    while True:
+        batch = list(islice(items, min(batch_size, BULK_MAX_ITEMS - len(results))))
+        if not batch:
+            break
+        results += create_batch(batch, owner, domain, len(results))
+    if len(results) == BULK_MAX_ITEMS and next(items, None) is not None:               # поток NDJSON длиннее предела
+        results.append({'index': len(results), 'errors': {'item': ['Превышен предел числа правил в запросе.']}})
+    created = len({result['id'] for result in results if 'id' in result and not result.get('existing')})  # повторы ссылки в запросе - одно правило
+    if created:
+        logger(owner, Log.RULES_BULK_CREATED, created=created, items=len(results))
+    return results
@@ -0,0 +1,107 @@
+# ----- Заполнение кэша без лавины запросов к БД (single-flight, досрочное обновление XFetch)
+
+import math, random, time
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
+
+
+# ----- Глобальные переменные
+FILL_LOCK_KEY = 'fill:{}'                                                               # шаблон ключа блокировки заполнения ключа кэша
+FILL_LOCK_TTL = getattr(settings, 'CACHE_FILL_LOCK_TTL', 5)                             # предел удержания блокировки (сек)
+FILL_WAIT = getattr(settings, 'CACHE_FILL_WAIT', 0.5)                                   # предел ожидания значения другого процесса (сек)
+FILL_POLL = 0.01                                                                        # период опроса кэша при ожидании (сек)
+XFETCH_BETA = getattr(settings, 'CACHE_XFETCH_BETA', 1.0)                               # коэффициент досрочного обновления (0 - отключено)
+
+
+def fill_lock(key):
+    ''' Возвращает блокировку Redis заполнения ключа кэша key (освобождается только владельцем). '''
+    return get_redis_connection('default').lock(cache.make_key(FILL_LOCK_KEY.format(key)), timeout=FILL_LOCK_TTL)
+
+
+def release(lock):
+    ''' Освобождение блокировки; истёкшая блокировка (загрузка дольше FILL_LOCK_TTL) пропускается. '''
+    try:
+        lock.release()
+    except LockError:
+        pass
+
+
+def wait_for(read, wait=FILL_WAIT):
+    ''' Опрос кэша функцией read() до появления значения, но не дольше wait секунд. Возвращает значение либо None. '''
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(FILL_POLL)
+        value = read()
+        if value is not None:
+            return value
+    return None
+
+
+def single_flight(key, load, read, wait=FILL_WAIT):
+    ''' Заполнение ключа кэша key одним процессом: load() выполняет владелец блокировки,
+        остальные ждут значение в кэше (read()) и лишь по истечении wait секунд загружают его сами.
+        Аргументы:
+        key  (str)      -- ключ кэша
+        load (callable) -- загрузка значения с записью в кэш; возвращает значение
+        read (callable) -- чтение значения из кэша (None - значения нет)
+        wait (float)    -- предел ожидания (сек)
+    '''
+    lock = fill_lock(key)
+    if lock.acquire(blocking=False):
+        try:
+            return load()
+        finally:
+            release(lock)
+    value = wait_for(read, wait)
+    return load() if value is None else value
+
+
+def early_refresh(delta, expires, beta=XFETCH_BETA):
+    ''' Решение о досрочном обновлении (XFetch): вероятность растёт к моменту истечения и тем раньше,
+        чем дольше загрузка значения.
+        Аргументы:
+        delta   (float) -- длительность последней загрузки (сек)
+        expires (float) -- момент истечения значения (сек эпохи)
+        beta    (float) -- коэффициент (больше 1 - раньше)
+    '''
+    return time.time() - delta * beta * math.log(1 - random.random()) >= expires
+
+
+def store(key, load, timeout):
+    ''' Загрузка значения и запись в кэш вместе с длительностью загрузки и моментом истечения. Возвращает значение. '''
+    begin = time.monotonic()
+    value = load()
+    cache.set(key, (value, time.monotonic() - begin, time.time() + timeout), timeout=timeout)
+    return value
+
+
+def get_or_fill(key, load, timeout, stale_key=None):
+    ''' Возвращает (значение ключа кэша key, загружено ли оно сейчас).
+        Значение хранится как (значение, длительность загрузки, момент истечения) и досрочно обновляется
+        одним процессом до истечения (XFetch). При промахе загружает владелец блокировки ключа,
+        остальные получают устаревшее значение stale_key либо ждут значение в кэше.
+        Аргументы:
+        key       (str)      -- ключ кэша
+        load      (callable) -- загрузка значения из БД
+        timeout   (float)    -- время жизни значения (сек)
+        stale_key (str)      -- ключ устаревшего значения того же формата (None - нет)
+    '''
+    entry = cache.get(key)
+    if entry is not None and not (XFETCH_BETA and early_refresh(entry[1], entry[2])):
+        return entry[0], False
+    lock = fill_lock(key)
+    if lock.acquire(blocking=False):
+        try:
+            return store(key, load, timeout), True
+        finally:
+            release(lock)
+    if entry is not None:                                                               # обновляет другой процесс, значение ещё действует
+        return entry[0], False
+    stale = cache.get(stale_key) if stale_key else None
+    if stale is None:
+        stale = wait_for(lambda: cache.get(key))
+    if stale is not None:
+        return stale[0], False
+    return store(key, load, timeout), True
@@ -0,0 +1,210 @@
+# ----- Счётчики переходов по коротким ссылкам
+
+import re
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from .models import Url, ClickStat
+
+
+# ----- Глобальные переменные
+CLICKS_KEY = 'clicks:{}'                                                                # шаблон ключа хэша счётчиков правила
+CLICKS_DIRTY_KEY = 'clicks:dirty'                                                       # множество хэшей, изменённых после сброса
+CLICKS_FLUSH_BATCH = getattr(settings, 'CLICKS_FLUSH_BATCH', 500)                       # число правил в одной пачке сброса в БД
+KEY_LENGTH = ClickStat._meta.get_field('key').max_length                                # предел длины значения группы
+BOT_AGENT = re.compile(r'bot|crawl|spider|slurp|preview|curl|wget|python', re.I)        # признаки роботов в User-Agent
+MOBILE_AGENT = re.compile(r'mobi|android|iphone|ipad', re.I)                            # признаки мобильных клиентов
+
+# Чтение маппинга и счёт перехода за одно обращение к Redis. Негативная запись (целое 0) и промах не считаются.
+# KEYS: ключ маппинга, ключ хэша счётчиков, множество изменённых хэшей; ARGV: поля счётчиков
+CLICK_SCRIPT = '''
+local link = redis.call('GET', KEYS[1])
+if link and link ~= '0' then
+    for i = 1, #ARGV do
+        redis.call('HINCRBY', KEYS[2], ARGV[i], 1)
+    end
+    redis.call('SADD', KEYS[3], KEYS[2])
+end
+return link
+'''
+
+_scripts = {}                                                                           # зарегистрированные скрипты по клиентам
+
+
+def click_fields(request):
+    ''' Возвращает поля счётчиков перехода: всего, за день, по домену источника и по типу клиента.
+        Аргументы:
+        request (HttpRequest) -- объект HTTP-запроса
+    '''
+    referrer = urlsplit(request.META.get('HTTP_REFERER', '')).hostname or 'direct'
+    agent = request.META.get('HTTP_USER_AGENT', '')
+    kind = 'unknown' if not agent else 'bot' if BOT_AGENT.search(agent) else \
+        'mobile' if MOBILE_AGENT.search(agent) else 'desktop'
+    return (
+        ClickStat.TOTAL,
+        '{}:{}'.format(ClickStat.DAY, timezone.localdate().isoformat()),
+        '{}:{}'.format(ClickStat.REFERRER, referrer[:KEY_LENGTH]),
+        '{}:{}'.format(ClickStat.AGENT, kind),
+    )
+
+
+def click_keys(redirect_key, subpart):
+    ''' Возвращает ключи Redis скрипта CLICK_SCRIPT (с префиксом и версией django_redis). '''
+    return [cache.make_key(redirect_key), cache.make_key(CLICKS_KEY.format(subpart)), cache.make_key(CLICKS_DIRTY_KEY)]
+
+
+def click_script(client):
+    ''' Возвращает скрипт CLICK_SCRIPT, зарегистрированный для клиента Redis (вызов - EVALSHA с откатом на EVAL). '''
+    script = _scripts.get(id(client))
+    if script is None or script.registered_client is not client:
+        script = _scripts[id(client)] = client.register_script(CLICK_SCRIPT)
+    return script
+
+
+def get_and_count(redirect_key, subpart, fields):
+    ''' Чтение маппинга из Redis со счётом перехода в одном обращении. Возвращает значение из кэша либо None.
+        Аргументы:
+        redirect_key (str)   -- ключ маппинга без префикса кэша
+        subpart      (str)   -- значение субдомена
+        fields       (tuple) -- поля счётчиков (см. click_fields)
+    '''
+    value = click_script(get_redis_connection('default'))(keys=click_keys(redirect_key, subpart), args=fields)
+    return None if value is None else cache.client.decode(value)
+
+
+async def aget_and_count(client, redirect_key, subpart, fields):
+    ''' Асинхронный вариант get_and_count для клиента redis.asyncio. '''
+    value = await click_script(client)(keys=click_keys(redirect_key, subpart), args=fields)
+    return None if value is None else cache.client.decode(value)
+
+
+def count_click(subpart, fields, client=None):
+    ''' Счёт перехода без чтения маппинга (ссылка найдена в памяти процесса): один конвейер Redis.
+        Для асинхронного клиента возвращает корутину конвейера.
+        Аргументы:
+        subpart (str)   -- значение субдомена
+        fields  (tuple) -- поля счётчиков (см. click_fields)
+        client  (Redis) -- клиент Redis (None - соединение кэша по умолчанию)
+    '''
+    key = cache.make_key(CLICKS_KEY.format(subpart))
+    pipe = (client or get_redis_connection('default')).pipeline(transaction=False)
+    for field in fields:
+        pipe.hincrby(key, field, 1)
+    pipe.sadd(cache.make_key(CLICKS_DIRTY_KEY), key)
+    return pipe.execute()
+
+
+def total_clicks():
+    ''' Выражение аннотации выборки правил: общее число переходов из таблицы ClickStat. '''
+    query = ClickStat.objects.filter(url=OuterRef('pk'), kind=ClickStat.TOTAL).values('clicks')[:1]
+    return Coalesce(Subquery(query), 0)
+
+
+def click_stats(url_id):
+    ''' Возвращает сохранённые в БД счётчики правила по видам: {"total": число, "day": {дата: число},
+        "referrer": {домен: число}, "agent": {тип клиента: число}}; группы - по убыванию числа переходов, дни - по дате.
+        Переходы, ещё не сброшенные из Redis (flush_clicks), не учитываются.
+        Аргументы:
+        url_id (int) -- id правила
+    '''
+    stats = {ClickStat.TOTAL: 0, ClickStat.DAY: {}, ClickStat.REFERRER: {}, ClickStat.AGENT: {}}
+    rows = ClickStat.objects.filter(url_id=url_id).order_by('kind', '-clicks', 'key').values_list('kind', 'key', 'clicks')
+    for kind, key, clicks in rows:
+        if kind == ClickStat.TOTAL:
+            stats[kind] = clicks
+        else:
+            stats[kind][key] = clicks
+    stats[ClickStat.DAY] = dict(sorted(stats[ClickStat.DAY].items()))
+    return stats
+
+
+def upsert_clicks(rows):
+    ''' Прибавление счётчиков к строкам ClickStat одним запросом INSERT ... ON DUPLICATE KEY / ON CONFLICT.
+        Аргументы:
+        rows (list) -- кортежи (url_id, kind, key, clicks)
+    '''
+    qn = connection.ops.quote_name
+    table, clicks = qn(ClickStat._meta.db_table), qn('clicks')
+    columns = ', '.join(qn(name) for name in ('url_id', 'kind', 'key', 'clicks'))
+    if connection.vendor == 'mysql':
+        tail = 'ON DUPLICATE KEY UPDATE {0} = {0} + VALUES({0})'.format(clicks)
+    else:                                                                               # SQLite 3.24+, PostgreSQL
+        tail = 'ON CONFLICT ({0}, {1}, {2}) DO UPDATE SET {3} = {4}.{3} + excluded.{3}'.format(
+            qn('url_id'), qn('kind'), qn('key'), clicks, table)
+    sql = 'INSERT INTO {} ({}) VALUES {} {}'.format(table, columns, ', '.join(['(%s, %s, %s, %s)'] * len(rows)), tail)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [value for row in rows for value in row])
+
+
+def take_clicks(conn, keys):
+    ''' Атомарное чтение и удаление хэшей счётчиков (MULTI/EXEC). Возвращает словарь {субдомен: {поле: число}}. '''
+    pipe = conn.pipeline(transaction=True)
+    for key in keys:
+        pipe.hgetall(key)
+        pipe.delete(key)
+    values = pipe.execute()[::2]
+    prefix = cache.make_key(CLICKS_KEY.format(''))
+    return {key.decode()[len(prefix):]: counts for key, counts in zip(keys, values) if counts}
+
+
+def restore_clicks(conn, clicks):
+    ''' Возврат счётчиков в Redis, если запись в БД не удалась (следующий сброс повторит запись). '''
+    pipe = conn.pipeline(transaction=False)
+    dirty = cache.make_key(CLICKS_DIRTY_KEY)
+    for subpart, counts in clicks.items():
+        key = cache.make_key(CLICKS_KEY.format(subpart))
+        for field, value in counts.items():
+            pipe.hincrby(key, field, int(value))
+        pipe.sadd(dirty, key)
+    pipe.execute()
+
+
+def move_clicks(old, new):
+    ''' Перенос несброшенных счётчиков переходов правила на его новый субдомен.
+        Аргументы:
+        old (str) -- прежний субдомен
+        new (str) -- новый субдомен
+    '''
+    conn = get_redis_connection('default')
+    counts = take_clicks(conn, [cache.make_key(CLICKS_KEY.format(old)).encode()]).get(old)
+    if counts:
+        restore_clicks(conn, {new: counts})
+
+
+def flush_clicks(batch_size=CLICKS_FLUSH_BATCH):
+    ''' Перенос счётчиков переходов из Redis в таблицу ClickStat пачками правил.
+        Запускается планировщиком (см. SCHEDULER_JOBS). Счётчики удалённых правил отбрасываются.
+        Возвращает число перенесённых переходов.
+        Аргументы:
+        batch_size (int) -- число правил в пачке
+    '''
+    conn = get_redis_connection('default')
+    dirty = cache.make_key(CLICKS_DIRTY_KEY)
+    flushed = 0
+    while True:
+        keys = conn.spop(dirty, batch_size)                                             # изъятие пачки из множества изменённых
+        if not keys:
+            break
+        clicks = take_clicks(conn, keys)
+        ids = dict(Url.objects.filter(subpart__in=clicks).values_list('subpart', 'id'))
+        rows = [
+            (ids[subpart], *field.decode().partition(':')[::2], int(value))            # поле '<вид>:<группа>'
+            for subpart, counts in clicks.items() if subpart in ids
+            for field, value in counts.items()
+        ]
+        if not rows:
+            continue
+        try:
+            with transaction.atomic():
+                upsert_clicks(rows)
+        except Exception:
+            restore_clicks(conn, {subpart: counts for subpart, counts in clicks.items() if subpart in ids})
+            raise
+        flushed += sum(row[3] for row in rows if row[1] == ClickStat.TOTAL)
+    return flushed
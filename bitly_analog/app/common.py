@@ -1,105 +1,166 @@
 # ----- Общий функционал
 
-import json, inspect
+import json, threading, uuid
+from asgiref.sync import sync_to_async
+from datetime import datetime, time, timedelta
+from time import sleep
 from django.conf import settings
-from django.http import HttpRequest, HttpResponse
-from django.shortcuts import render, redirect, Http404
-from django.core.paginator import Paginator
+from django.db import IntegrityError, transaction, close_old_connections
+from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.shortcuts import render, Http404
 
-from .models import Url, Log, Session, Owner, Collection
+from .models import Url, Log, Owner
+from .local_cache import LocalCache
+from .bloom import subpart_filter
+from .log_buffer import log_buffer
+from .async_cache import get_async_redis
+from .pagination import KeysetPage, keyset_page, format_cursor, decode_cursor
+from .middleware import sessionless
+from .ratelimit import ratelimit
+from .clicks import CLICKS_KEY, click_fields, count_click, get_and_count, aget_and_count, total_clicks
+from .metrics import record_cache
+from .cache_fill import get_or_fill, single_flight
 
 # cache
 from django.core.cache import cache
-from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
 
 
 # ----- Глобальные переменные 
-UNKNOWN_NAME = 'UNKNOWN FUNCTION NAME'                                                  # ошибка установления процесса при записи лога 
-CACHE_TTL = getattr(settings, 'CACHE_TTL', DEFAULT_TIMEOUT)                             # таймаут объектов кэша по умолчанию
+CACHE_TTL = getattr(settings, 'CACHE_TTL', 300)                                         # таймаут объектов кэша по умолчанию
+RULES_VERSION_KEY = 'rules:{}:version'                                                  # шаблон ключа версии кэша списка правил пользователя
+RULES_PAGE_KEY = 'rules:{}:v{}:page:{}:{}'                                              # шаблон ключа страницы: пользователь, версия, курсор, строк
+RULES_COUNT_KEY = 'rules:{}:v{}:count'                                                  # шаблон ключа числа правил пользователя
+RULE_FIELDS = ('id', 'link', 'alias', 'subpart', 'expire_date')                         # поля правила в кэше списка (без объектов моделей)
+SUBPART_ATTEMPTS = 5                                                                    # число попыток записи правила с новым субдоменом
+REDIRECT_KEY = 'redirect:v2:{}'                                                         # шаблон ключа маппинга subpart -> (link, status, expires)
+REDIRECT_MISS_TTL = getattr(settings, 'REDIRECT_MISS_TTL', 30)                          # время жизни негативной записи в кэше (сек)
+REDIRECT_STATUS = getattr(settings, 'REDIRECT_STATUS', 302)                             # код перенаправления по умолчанию (301/302/307)
+REDIRECT_MAX_AGE = getattr(settings, 'REDIRECT_MAX_AGE', 0)                             # предел Cache-Control: max-age (0 - без кэширования)
+MISSING_LINK = 0                                                                        # значение маппинга для несуществующего субдомена (без сериализации)
+REDIRECT_L1_SIZE = getattr(settings, 'REDIRECT_L1_SIZE', 10000)                         # число маппингов в памяти процесса
+REDIRECT_L1_TTL = getattr(settings, 'REDIRECT_L1_TTL', 60)                              # время жизни маппинга в памяти процесса (сек)
+LINK_DROPS_CHANNEL = 'redirect:drops'                                                   # канал Pub/Sub удаления маппингов из L1-кэшей процессов
+PROCESS_TOKEN = uuid.uuid4().hex                                                        # метка процесса в сообщениях канала (свои - пропускаются)
+
+DEDUPLICATE_LINKS = getattr(settings, 'DEDUPLICATE_LINKS', False)                       # возвращать действующее правило той же ссылки
+OWNER_SESSION_KEY = 'owner'                                                             # ключ полей пользователя в сессии
+OWNER_FIELDS = [field.attname for field in Owner._meta.concrete_fields]                 # поля пользователя в сессии
+SESSION_RENEW_KEY = 'renewed'                                                           # ключ даты последнего продления сессии
+
+local_links = LocalCache(REDIRECT_L1_SIZE, REDIRECT_L1_TTL)                             # L1-кэш маппингов перед Redis
+_drops_listener = None                                                                  # поток подписки на LINK_DROPS_CHANNEL
+_drops_lock = threading.Lock()
 
             
-def logger(owner, process, exec_msg):
-    ''' Создание записи в таблице логирования Log. 
-        Аргументы:
-        owner    (Owner) -- объект пользователя 
-        process  (str)   -- имя вызывающего фрейма/функции/процесса
-        exec_msg (str)   -- сообщение о выполненных действиях
-    '''
-    try: # запись лога в БД 
-        Log.objects.create(
-            owner = owner,                                                          
-            process = process,                            
-            execute = exec_msg,
-        )
-    except:
-        Log.objects.create(
-            owner = owner or None,                                                          
-            process = process or None,                            
-            execute = 'Не удалось создать лог пользователя <{}> для процесса {}'.format(owner, process),
-        )
+def logger(owner, event, rule_id=None, **payload):
+    ''' Создание записи в таблице логирования Log (через буфер log_buffer). 
+        Аргументы:
+        owner   (Owner) -- объект пользователя (None - запись приложения)
+        event   (int)   -- вид события (Log.EVENTS)
+        rule_id (int)   -- id правила события
+        payload (dict)  -- небольшие данные события (значения, сериализуемые в JSON)
+    '''
+    log_buffer.put(Log(                                                                 # запись в БД пачкой из фонового потока
+        owner = owner,
+        event = event,
+        rule_id = rule_id,
+        payload = payload,
+    ))
         
  
 def is_subpart_exists(request, sub_domain):
     ''' Проверка на уникальность субдомена. Возвращает Boolean: True, если есть совпадения, иначе False. 
+        Ответ "нет" фильтра Блума возвращается без запроса к БД, в БД проверяются только вероятные совпадения.
         Аргументы:
-        request    (HttpRequest) -- объект HTTP-запроса
+        request    (HttpRequest) -- объект HTTP-запроса (может быть None)
         sub_domain (str)         -- имя субдомена
     '''
+    if not subpart_filter.might_contain(sub_domain):                                    # субдомен точно свободен
+        record_cache('bloom', True)
+        return False
+    record_cache('bloom', False)
     return Url.objects.filter(subpart=sub_domain).exists()
 
 
-def get_owner(request):
-    ''' Возвращает объект анонимного пользователя, установленного по ключу сессии из запроса. 
+def save_rule(url, renew=None, attempts=SUBPART_ATTEMPTS):
+    ''' Запись правила без предварительной проверки субдомена: уникальность обеспечивает индекс БД.
+        При занятом субдомене вызывает renew(url) для смены субдомена и повторяет запись,
+        прочие ошибки целостности (IntegrityError) передаются вызывающему.
+        Возвращает Boolean: True, если правило записано, иначе False.
         Аргументы:
-        request (HttpRequest) -- объект HTTP-запроса
+        url      (Url)      -- несохранённый объект правила
+        renew    (callable) -- функция смены субдомена правила (None - без повторов)
+        attempts (int)      -- максимальное число попыток записи
     '''
-    msg = ''                                                                            # сообщение в лог
-    if not request.session.exists(request.session.session_key):                         # наличие ключа сессии
-        request.session.create()                                                        # создание сессии для нового пользователя
-    try:
-        # извлеченние пользователя или создание нового
-        result = Owner.objects.get_or_create(session = Session.objects.get(session_key = request.session.session_key))
-    except IntegrityError:
-        owner = None
-        msg = DB_ERROR
-    else: 
-        if result[1]:                                                                   # создан новый пользователь
-            owner = result[0]
-            msg = 'Создан новый пользователь с ключом сессии: ' + result[0].session.session_key,
-    finally:
-        if result[1] or msg:                                                            # создан новый пользователь
-            logger(owner, get_fname(inspect.currentframe()), msg)                       # запись лога в БД  
-    return result[0]    # объект Owner из кортежа (object, create)
+    for _ in range(attempts):
+        try:
+            with transaction.atomic():                                                  # точка сохранения: ошибка не ломает внешнюю транзакцию
+                url.save()
+        except IntegrityError:
+            if not Url.objects.filter(subpart=url.subpart).exists():                    # другая ошибка целостности (например, нет пользователя)
+                raise
+            if renew is None:                                                           # субдомен уже занят
+                return False
+            renew(url)
+        else:
+            return True
+    return False
 
 
+def owner_state(owner):
+    ''' Возвращает значения полей пользователя для хранения в сессии. '''
+    return [getattr(owner, field.attname) for field in Owner._meta.concrete_fields]
 
-def get_fname(frame):
-    ''' Возвращает имя вызывающего фрейма/функции. 
+
+def find_rules(owner, links):
+    ''' Поиск действующих правил пользователя по ссылкам одним запросом по индексу (owner, link_hash).
+        Возвращает словарь {нормализованная ссылка: правило} (для ссылки - правило с наибольшей датой удаления).
         Аргументы:
-        frame (frame) -- объект вызывающего фрейма  
+        owner (Owner)    -- объект пользователя
+        links (iterable) -- оригинальные ссылки
     '''
-    try:
-        fname = inspect.getframeinfo(frame).function                                     # имя фрейма/функции
-    except:
-        fname = UNKNOWN_NAME 
-        logger(None, 'get_fname', 'Не удалось определить имя процесса.')
-    return fname                                                                        
+    links = {Url.digest(link): Url.normalize_link(link) for link in links}
+    query = Url.objects.filter(owner=owner, link_hash__in=links, expire_date__gt=timezone.localdate()).order_by('expire_date')
+    # сравнение нормализованных ссылок исключает коллизии хэша
+    return {links[url.link_hash]: url for url in query if Url.normalize_link(url.link) == links[url.link_hash]}
+
 
+def find_rule(owner, link):
+    ''' Возвращает действующее правило пользователя с той же (нормализованной) ссылкой либо None. '''
+    return find_rules(owner, [link]).get(Url.normalize_link(link))
 
 
-def paginate(object_list=[], page_number=1, onpage=10):
-    ''' Пагинация объектов заданной модели. Возвращает сраницу списка - объект класса Paginator. 
+def get_owner(request):
+    ''' Возвращает объект анонимного пользователя, установленного по ключу сессии из запроса. 
+        Поля пользователя хранятся в самой сессии (кэш Redis, см. SESSION_ENGINE): известный пользователь
+        восстанавливается без запросов к БД. Сессия записывается только при создании пользователя
+        и раз в сутки для продления срока её жизни.
         Аргументы:
-        request     (HttpRequest) -- объект HTTP-запроса
-        object_list (iterable)    -- список объектов для разбиения на страницы
-        page_number (int)         -- начальная страница пагинации списка правил пользователя
-        onpage      (int)         -- количество строк списка правил в таблице  
+        request (HttpRequest) -- объект HTTP-запроса
     '''
-    paginator = Paginator(object_list, onpage) 
-    return paginator.get_page(page_number) 
+    session = request.session
+    state = session.get(OWNER_SESSION_KEY)
+    if state:                                                                           # пользователь из сессии
+        owner = Owner.from_db(Owner.objects.db, OWNER_FIELDS, state)
+    else:
+        if not session.session_key or not session.exists(session.session_key):        # наличие ключа сессии
+            session.create()                                                            # создание сессии для нового пользователя
+        # извлеченние пользователя или создание нового
+        owner, created = Owner.objects.get_or_create(session_id=session.session_key)
+        session[OWNER_SESSION_KEY] = owner_state(owner)
+        if created:                                                                     # создан новый пользователь
+            logger(owner, Log.OWNER_CREATED)                                            # запись лога в БД
+    today = timezone.localdate().isoformat()
+    if session.get(SESSION_RENEW_KEY) != today:                                         # продление сессии не чаще раза в сутки
+        session[SESSION_RENEW_KEY] = today
+    return owner
+
 
 
-  
 def redirect_to(request, rule_id):
     ''' Перенаправление на ресурс по оригинальной ссылке.
         Аргументы:
@@ -111,10 +172,280 @@ def redirect_to(request, rule_id):
     except Url.DoesNotExist:
         raise Http404('В модели Url нет объекта с номером ' + str(rule_id))
     else:
-        return redirect(url.link)                                                       # пренаправление по ссылке правила
+        return redirect_response(*link_target(url.link, url.expire_date, url.redirect_status))  # код и кэширование - как у redirect_subpart
+
+
+
+def redirect_key(subpart):
+    ''' Возвращает ключ кэша маппинга короткой ссылки на оригинальную.
+        Аргументы:
+        subpart (str) -- значение субдомена
+    '''
+    return REDIRECT_KEY.format(subpart)
+
+
+def expire_at(expire_date):
+    ''' Возвращает момент истечения правила - начало суток даты удаления (aware datetime). '''
+    return timezone.make_aware(datetime.combine(expire_date, time.min))
+
+
+def link_ttl(expire_date):
+    ''' Возвращает время жизни маппинга в кэше (в секундах) - до начала суток даты удаления правила.
+        Для правила с истёкшим сроком возвращает 0.
+        Аргументы:
+        expire_date (date) -- дата удаления правила
+    '''
+    return max(int((expire_at(expire_date) - timezone.now()).total_seconds()), 0)
+
+
+def link_target(link, expire_date, status=None):
+    ''' Возвращает значение маппинга в кэше: кортеж (ссылка, код перенаправления правила, момент истечения в секундах эпохи).
+        Аргументы:
+        link        (str)  -- оригинальная ссылка
+        expire_date (date) -- дата удаления правила
+        status      (int)  -- код перенаправления правила (None - REDIRECT_STATUS)
+    '''
+    return link, status, int(expire_at(expire_date).timestamp())
+
+
+def cache_link(subpart, link, expire_date, status=None):
+    ''' Запись маппинга subpart -> (link, status, expires) в кэш с TTL по дату удаления правила. Возвращает TTL в секундах.
+        Аргументы:
+        subpart     (str)  -- значение субдомена
+        link        (str)  -- оригинальная ссылка
+        expire_date (date) -- дата удаления правила
+        status      (int)  -- код перенаправления правила (None - REDIRECT_STATUS)
+    '''
+    ttl = link_ttl(expire_date)
+    if ttl:                                                                             # запись заменяет и негативную запись
+        cache.set(redirect_key(subpart), link_target(link, expire_date, status), timeout=ttl)
+    else:                                                                               # правило с истёкшим сроком не кэшируется
+        cache.delete(redirect_key(subpart))
+    return ttl
+
+
+def cache_links(rules):
+    ''' Запись маппингов пачки правил в кэш одним конвейером SET EX (правила с истёкшим сроком пропускаются).
+        Аргументы:
+        rules (iterable) -- кортежи (subpart, link, expire_date, status)
+    '''
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    now = timezone.now()
+    moments = {}                                                                        # дата удаления -> момент истечения (дат в пачке немного)
+    for subpart, link, expire_date, status in rules:
+        moment = moments.get(expire_date)
+        if moment is None:
+            moment = moments[expire_date] = expire_at(expire_date)
+        ttl = int((moment - now).total_seconds())                                       # как link_ttl / link_target, без пересчёта даты
+        if ttl > 0:
+            pipe.set(cache.make_key(redirect_key(subpart)), cache.client.encode((link, status, int(moment.timestamp()))), ex=ttl)
+    pipe.execute()
+
+
+def drop_link(*subparts, shared=True):
+    ''' Удаление маппингов из L1-кэшей всех процессов (своего - сразу, остальных - по сообщению LINK_DROPS_CHANNEL)
+        и (при shared=True) из общего кэша вместе с несброшенными счётчиками переходов: освобождённый субдомен
+        может быть выдан новому правилу, которому не должны достаться чужие переходы.
+        DEL и PUBLISH - одним конвейером, DEL раньше оповещения.
+        Аргументы:
+        subparts (str)     -- значения субдоменов
+        shared   (Boolean) -- удалять ли маппинги и счётчики из Redis (правило удалено либо субдомен изменён)
+    '''
+    if not subparts:
+        return
+    for subpart in subparts:
+        local_links.delete(subpart)
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    if shared:
+        pipe.delete(*[cache.make_key(key.format(subpart)) for subpart in subparts for key in (REDIRECT_KEY, CLICKS_KEY)])
+    pipe.publish(cache.make_key(LINK_DROPS_CHANNEL), json.dumps({'from': PROCESS_TOKEN, 'subparts': subparts}))
+    pipe.execute()
+
+
+def listen_link_drops(pubsub):
+    ''' Цикл фонового потока: удаление из L1-кэша маппингов, изменённых другими процессами.
+        При обрыве подписки L1-кэш очищается целиком (сообщения за это время потеряны), подписка восстанавливается.
+        Аргументы:
+        pubsub (PubSub) -- подписка на LINK_DROPS_CHANNEL
+    '''
+    while True:
+        try:
+            for message in pubsub.listen():
+                drop = json.loads(message['data'])
+                if drop['from'] != PROCESS_TOKEN:
+                    for subpart in drop['subparts']:
+                        local_links.delete(subpart)
+        except (RedisError, ValueError, KeyError):
+            local_links.clear()
+            sleep(1)
+
+
+def start_link_drops():
+    ''' Подписка процесса на LINK_DROPS_CHANNEL и запуск потока-слушателя (один раз, до первой записи в L1-кэш:
+        изменения после подписки не теряются).
+    '''
+    global _drops_listener
+    if _drops_listener is not None:
+        return
+    with _drops_lock:
+        if _drops_listener is None:
+            pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(cache.make_key(LINK_DROPS_CHANNEL))
+            _drops_listener = threading.Thread(target=listen_link_drops, args=(pubsub,), name='link-drops', daemon=True)
+            _drops_listener.start()
 
 
+def seconds_to_midnight():
+    ''' Возвращает число секунд до начала следующих суток - ближайшего момента истечения любого правила. '''
+    now = timezone.localtime()
+    midnight = datetime.combine(now.date() + timedelta(days=1), time.min, tzinfo=now.tzinfo)
+    return (midnight - now).total_seconds()
 
+
+def load_link(subpart):
+    ''' Чтение правила из БД с записью маппинга в кэш. Возвращает значение маппинга (см. link_target) либо MISSING_LINK.
+        Отсутствие правила запоминается в Redis на REDIRECT_MISS_TTL секунд (негативный кэш).
+        Аргументы:
+        subpart (str) -- значение субдомена
+    '''
+    rule = Url.objects.filter(subpart=subpart, expire_date__gt=timezone.localdate()) \
+        .values_list('link', 'expire_date', 'redirect_status').first()                  # только поля маппинга, без объекта модели
+    if rule:
+        cache_link(subpart, *rule)                                                      # ЗАПИСЬ В КЭШ
+        return link_target(*rule)
+    cache.add(redirect_key(subpart), MISSING_LINK, timeout=REDIRECT_MISS_TTL)           # add (SET NX) не затирает маппинг нового правила
+    return MISSING_LINK
+
+
+def fill_link(subpart):
+    ''' load_link под блокировкой заполнения ключа: при одновременных промахах по одному субдомену
+        в БД идёт один запрос, остальные ждут маппинг в кэше (см. app.cache_fill).
+        Аргументы:
+        subpart (str) -- значение субдомена
+    '''
+    key = redirect_key(subpart)
+    return single_flight(key, lambda: load_link(subpart), lambda: cache.get(key))
+
+
+def remember_link(subpart, target):
+    ''' Запись найденного маппинга в L1-кэш процесса. Возвращает маппинг либо None, если правила нет. '''
+    if not target:                                                                      # нет правила (в т.ч. по негативной записи)
+        return None
+    if REDIRECT_L1_SIZE > 0:
+        start_link_drops()
+    local_links.set(subpart, target, ttl=seconds_to_midnight())                         # правила истекают в полночь - не дольше
+    return target
+
+
+def get_link(subpart, fields=None):
+    ''' Возвращает маппинг (ссылка, код перенаправления, момент истечения) по субдомену либо None, если действующего правила нет.
+        Порядок поиска: L1-кэш процесса, Redis (один GET), БД с записью маппинга в кэш.
+        При заданных полях счётчиков переход считается в том же обращении к Redis (см. app.clicks).
+        Аргументы:
+        subpart (str)   -- значение субдомена
+        fields  (tuple) -- поля счётчиков перехода (None - без счёта)
+    '''
+    target = local_links.get(subpart)                                                   # ВЫБОРКА ИЗ ПАМЯТИ ПРОЦЕССА
+    record_cache('l1', target is not None)
+    if target is not None:
+        if fields:
+            count_click(subpart, fields)
+        return target
+    if fields:
+        target = get_and_count(redirect_key(subpart), subpart, fields)                  # ВЫБОРКА ИЗ КЭША СО СЧЁТОМ ПЕРЕХОДА
+    else:
+        target = cache.get(redirect_key(subpart))                                       # ВЫБОРКА ИЗ КЭША
+    record_cache('redis', target is not None)
+    if target is None:
+        target = fill_link(subpart)
+        if target and fields:                                                           # маппинг только что загружен из БД
+            count_click(subpart, fields)
+    return remember_link(subpart, target)
+
+
+def load_link_in_thread(subpart):
+    ''' fill_link для пула потоков: соединение с БД потока закрывается по правилам CONN_MAX_AGE. '''
+    try:
+        return fill_link(subpart)
+    finally:
+        close_old_connections()
+
+
+async def aget_link(subpart, fields=None):
+    ''' Асинхронный вариант get_link: Redis - через асинхронный клиент с пулом соединений,
+        чтение из БД при промахе - в пуле потоков.
+        Аргументы:
+        subpart (str)   -- значение субдомена
+        fields  (tuple) -- поля счётчиков перехода (None - без счёта)
+    '''
+    client = get_async_redis()
+    target = local_links.get(subpart)                                                   # ВЫБОРКА ИЗ ПАМЯТИ ПРОЦЕССА
+    record_cache('l1', target is not None)
+    if target is not None:
+        if fields:
+            await count_click(subpart, fields, client)
+        return target
+    if fields:
+        target = await aget_and_count(client, redirect_key(subpart), subpart, fields)   # ВЫБОРКА ИЗ КЭША СО СЧЁТОМ ПЕРЕХОДА
+    else:
+        value = await client.get(cache.make_key(redirect_key(subpart)))                 # ВЫБОРКА ИЗ КЭША
+        target = None if value is None else cache.client.decode(value)                  # формат значений django_redis
+    record_cache('redis', target is not None)
+    if target is None:
+        target = await sync_to_async(load_link_in_thread, thread_sensitive=False)(subpart)
+        if target and fields:
+            await count_click(subpart, fields, client)
+    return remember_link(subpart, target)
+
+
+def redirect_response(link, status, expires):
+    ''' Ответ перенаправления с кодом правила (либо REDIRECT_STATUS) и Cache-Control на оставшийся срок жизни правила
+        (не дольше REDIRECT_MAX_AGE): повторные переходы обслуживают кэши браузера и CDN, а после истечения
+        правила закэшированное перенаправление перестаёт действовать.
+        Аргументы:
+        link    (str) -- оригинальная ссылка
+        status  (int) -- код перенаправления правила (None - REDIRECT_STATUS)
+        expires (int) -- момент истечения правила (секунды эпохи)
+    '''
+    response = HttpResponseRedirect(link)                                               # без resolve_url: ссылка всегда абсолютная
+    response.status_code = status or REDIRECT_STATUS
+    max_age = min(expires - int(timezone.now().timestamp()), REDIRECT_MAX_AGE)
+    if max_age > 0:
+        patch_cache_control(response, public=True, max_age=max_age)
+    else:                                                                               # без кэширования (в т.ч. 301 - навсегда)
+        patch_cache_control(response, no_store=True)
+    return response
+
+
+@sessionless()
+def redirect_subpart(request, subpart):
+    ''' Перенаправление на ресурс по короткой ссылке domain/subpart.
+        Аргументы:
+        request (HttpRequest) -- объект HTTP-запроса
+        subpart (str)         -- значение субдомена
+    '''
+    target = get_link(subpart, click_fields(request))                                   # переход считается в Redis
+    if target is None:
+        raise Http404('Нет действующего правила для субдомена ' + subpart)
+    return redirect_response(*target)
+
+
+@sessionless()
+async def aredirect_subpart(request, subpart):
+    ''' Асинхронное перенаправление по короткой ссылке domain/subpart (при запуске через ASGI).
+        Аргументы:
+        request (HttpRequest) -- объект HTTP-запроса
+        subpart (str)         -- значение субдомена
+    '''
+    target = await aget_link(subpart, click_fields(request))
+    if target is None:
+        raise Http404('Нет действующего правила для субдомена ' + subpart)
+    return redirect_response(*target)
+
+
+
+@sessionless()
+@ratelimit('check')
 def ajax_check_subpart(request, sub_domain=None):
     ''' Оповещение пользователя об уникальности субдомена при вводе оригинальной ссылки или изменении значения субдомена sub_domain. 
         Возвращает JSON-объект {'subpart_unique': <Boolean: true/false>}, как результат проверки по БД,
@@ -139,30 +470,67 @@ def ajax_check_subpart(request, sub_domain=None):
     return HttpResponse(json.dumps(result))
 
 
-def caching(request, owner, process, obj, cache_key, related_field, page_number=1):
-    ''' Кэширование выборки модели. Возвращает словарь контекста. '''
-    page_number = request.GET.get('page') or page_number                                # установка номера страницы для текущего отображения
+def rules_version(owner_id):
+    ''' Возвращает текущую версию ключей кэша списка правил пользователя.
+        Аргументы:
+        owner_id (int) -- id пользователя
+    '''
+    return cache.get_or_set(RULES_VERSION_KEY.format(owner_id), 1, timeout=None)
 
-    # КЭШИРОВАНИЕ 
-    # выборка всех правил пользователя с сортирвкой по дате удаления 
-    if 'cache_key' in cache and not obj:                                                # если не производилась запись объекта url в БД
-        url_query = cache.get('cache_key')                                              # ВЫБОРКА ИЗ КЭША
-        is_db_query = False                                                             # флаг сообщения в контексте 
-        logger(owner, process, 'Создан кэш объектов правил Url.')
-    else:
-        is_db_query = True
-        url_query = Url.objects.filter(
-            collection__in = Collection.objects.select_related(related_field).filter(
-                owner=owner)).order_by('expire_date')
 
-        results = [url.to_json() for url in url_query]
-        cache.set('cache_key', results, timeout=CACHE_TTL)                              # ЗАПИСЬ В КЭШ 
+def invalidate_rules(*owner_ids):
+    ''' Сброс кэша страниц списка правил пользователей сменой версии ключей (старые страницы истекают по TTL).
+        Версии всех пользователей меняются одним конвейером Redis.
+        Аргументы:
+        owner_ids (int) -- id пользователей
+    '''
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for owner_id in owner_ids:
+        key = cache.make_key(RULES_VERSION_KEY.format(owner_id))
+        pipe.set(key, 1, nx=True)                                                       # целые числа хранятся без сериализации
+        pipe.incr(key)
+    pipe.execute()
+
+
+def caching(request, owner):
+    ''' Кэширование страницы списка правил пользователя. Возвращает словарь контекста.
+        Страница выбирается по ключу (expire_date, id) из параметров ?after=<курсор> / ?before=<курсор>.
+        В кэше хранится только отображаемая страница (поля RULE_FIELDS и число переходов clicks) и число правил
+        под ключами с версией пользователя; запись и удаление правил меняют версию (см. signals).
+        Страницу из БД строит один запрос (app.cache_fill): остальные получают страницу прежней версии либо ждут её,
+        действующая страница досрочно обновляется до истечения.
+        Аргументы:
+        request (HttpRequest) -- объект HTTP-запроса
+        owner   (Owner)       -- объект пользователя
+    '''
+    after = decode_cursor(request.GET.get('after'))                                     # курсоры страницы (None - первая страница)
+    before = None if after else decode_cursor(request.GET.get('before'))
+    cursor = 'a' + format_cursor(after) if after else 'b' + format_cursor(before) if before else ''
+    onpage = owner.trows_on_page
+    version = rules_version(owner.id)
+    key = RULES_PAGE_KEY.format(owner.id, version, cursor, onpage)
+    stale_key = RULES_PAGE_KEY.format(owner.id, version - 1, cursor, onpage) if version > 1 else None
+    timeout = min(CACHE_TTL, seconds_to_midnight())                                     # не дольше суток правил
+
+    def load():
+        # страница правил пользователя с сортировкой по дате удаления
+        query = Url.objects.filter(owner=owner).values(*RULE_FIELDS)
+        rows, has_next, has_previous = keyset_page(query.annotate(clicks=total_clicks()), onpage, after, before)
+        return {
+            'rows': rows,
+            'count': cache.get_or_set(RULES_COUNT_KEY.format(owner.id, version), query.count, timeout),
+            'has_next': has_next,
+            'has_previous': has_previous,
+        }
+
+    # КЭШИРОВАНИЕ
+    payload, is_db_query = get_or_fill(key, load, timeout, stale_key)                   # ВЫБОРКА ИЗ КЭША / ЗАПИСЬ В КЭШ
+    record_cache('rules', not is_db_query)
+    if is_db_query:
+        logger(owner, Log.RULES_CACHED, version=version)
 
-        #print('TTL: ' + str(cache.ttl('url')))                                         # TTL=300 по умолчанию # вывод в консоль для отладки  
-    
     return {
-        'url_query': url_query,                                                         # список всех правил пользователя
         'is_db_query': is_db_query,                                                     # Boolean (выборка из БД->True / из кэша->False)
-        'page_obj': paginate(url_query, page_number, owner.trows_on_page),              # разбивка на страницы      
+        'page_obj': KeysetPage(payload['rows'], payload['count'], payload['has_next'], payload['has_previous']),
     }
     # ----- end of caching
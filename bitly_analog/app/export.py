@@ -0,0 +1,104 @@
+# ----- Потоковая выгрузка правил (NDJSON/CSV)
+
+import csv, json
+from datetime import date
+from django.conf import settings
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+
+from .models import Url
+from .middleware import sessionless
+
+
+# ----- Глобальные переменные
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)                        # число строк в одном запросе к БД
+EXPORT_FIELDS = ('id', 'link', 'alias', 'subpart', 'expire_date', 'owner_id')           # выгружаемые поля правила
+EXPORT_FORMATS = {                                                                      # формат -> (MIME-тип, расширение файла)
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+}
+
+
+class Echo:
+    ''' Файлоподобный объект для csv.writer: возвращает записанную строку вместо буферизации. '''
+    def write(self, value):
+        return value
+
+
+def export_query(owner=None, expire_from=None, expire_to=None):
+    ''' Возвращает выборку правил для выгрузки с необязательными фильтрами.
+        Аргументы:
+        owner       (int)  -- id пользователя
+        expire_from (date) -- начало диапазона дат удаления (включительно)
+        expire_to   (date) -- конец диапазона дат удаления (включительно)
+    '''
+    query = Url.objects.all()
+    if owner is not None:
+        query = query.filter(owner_id=owner)
+    if expire_from:
+        query = query.filter(expire_date__gte=expire_from)
+    if expire_to:
+        query = query.filter(expire_date__lte=expire_to)
+    return query
+
+
+def export_rows(query, chunk_size=EXPORT_CHUNK_SIZE, fields=EXPORT_FIELDS):
+    ''' Генератор кортежей полей fields по возрастанию id. Строки читаются пачками по первичному ключу:
+        в памяти не больше одной пачки при любом размере таблицы и любом драйвере БД
+        (курсор MySQL без серверной стороны загружает весь результат .iterator() в память клиента).
+        Аргументы:
+        query      (QuerySet) -- выборка правил
+        chunk_size (int)      -- число строк в пачке
+        fields     (tuple)    -- поля строки (первое - id)
+    '''
+    last_id = 0
+    while True:
+        rows = list(query.filter(id__gt=last_id).order_by('id').values_list(*fields)[:chunk_size])
+        yield from rows
+        if len(rows) < chunk_size:
+            break
+        last_id = rows[-1][0]
+
+
+def ndjson_lines(rows):
+    ''' Генератор строк NDJSON. '''
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False, default=date.isoformat) + '\n'
+
+
+def csv_lines(rows):
+    ''' Генератор строк CSV с заголовком. '''
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def export_lines(fmt, rows):
+    ''' Генератор строк выгрузки в формате fmt ('ndjson' или 'csv'). '''
+    return csv_lines(rows) if fmt == 'csv' else ndjson_lines(rows)
+
+
+def parse_date(value):
+    ''' Возвращает дату из строки ГГГГ-ММ-ДД либо None для пустого значения (ValueError - для некорректного). '''
+    return date.fromisoformat(value) if value else None
+
+
+@sessionless()
+def export_rules(request):
+    ''' Потоковая выгрузка правил: ?format=ndjson|csv&owner=<id>&expire_from=<ГГГГ-ММ-ДД>&expire_to=<ГГГГ-ММ-ДД>.
+        Аргументы:
+        request (HttpRequest) -- объект HTTP-запроса
+    '''
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return HttpResponseBadRequest('Формат выгрузки: ' + ', '.join(EXPORT_FORMATS))
+    try:
+        owner = request.GET.get('owner')
+        query = export_query(int(owner) if owner else None,
+                             parse_date(request.GET.get('expire_from')), parse_date(request.GET.get('expire_to')))
+    except ValueError:
+        return HttpResponseBadRequest('Ожидаются id пользователя и даты в формате ГГГГ-ММ-ДД.')
+    content_type, extension = EXPORT_FORMATS[fmt]
+    response = StreamingHttpResponse(export_lines(fmt, export_rows(query)), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="rules.{}"'.format(extension)
+    return response
@@ -8,12 +8,14 @@ from django.utils.translation import gettext_lazy as _
 
 from app.models import Url
 
+SUBPART_DUPLICATE = 'Найден дубликат субдомена! Измените текущее значение.'           # ошибка поля 'subpart' при занятом субдомене
+
 class Mainform(forms.ModelForm):
     ''' Форма ввода параметров для сокращения ссылки. '''
     class Meta:
         model = Url
         fields = '__all__'
-        exclude = ['alias', 'str_limit', 'owner']
+        exclude = ['alias', 'str_limit', 'owner', 'redirect_status']
         widgets = {
             'link': forms.URLInput(attrs={'class': 'form-control' }),
             'expire_date': forms.DateInput(format=('%d.%m.%Y'), attrs={'class': 'form-control', 'placeholder': 'дд.мм.гггг'}),
@@ -22,13 +24,15 @@ class Mainform(forms.ModelForm):
     # дополнительное поле для формирования поля 'alias' 
     domain = forms.CharField(label='Домен', widget=forms.TextInput(attrs={'class':' form-control', 'readonly': 'True'}))
 
-    def clean(self):
-        ''' Проверка значения поля 'subpart' на дубликат в БД. 
-            При наличии дубликата инициирует добавленную в стандартный набор form.errors ошибку. 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['subpart'].required = False             # пустой субдомен генерируется сервером
+
+    def validate_unique(self):
+        ''' Проверка значения поля 'subpart' на дубликат не выполняется отдельным запросом к БД:
+            уникальность обеспечивает индекс при записи правила (см. common.save_rule),
+            при дубликате ошибка SUBPART_DUPLICATE добавляется в form.errors в представлении.
         '''
-        subpart = self.cleaned_data['subpart']              # значение поля 
-        if Url.objects.filter(subpart=subpart).exists():  
-            self.add_error('subpart', 'Найден дубликат субдомена! Измените текущее значение.')
 
 
 
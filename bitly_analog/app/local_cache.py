@@ -0,0 +1,59 @@
+# ----- Локальный кэш в памяти процесса
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class LocalCache:
+    ''' Ограниченный по размеру LRU-кэш в памяти процесса с TTL записей. Потокобезопасен.
+        Аргументы:
+        maxsize (int) -- максимальное число записей (0 - кэш отключён)
+        ttl     (int) -- время жизни записи по умолчанию (в секундах)
+    '''
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()                                                      # key -> (value, время истечения)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        ''' Возвращает значение по ключу либо default при отсутствии или истечении записи. '''
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[1] <= monotonic():                                                  # запись устарела
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)                                                 # отметка последнего использования
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        ''' Запись значения с вытеснением давно не использованных записей при переполнении.
+            Аргументы:
+            key   (str)   -- ключ
+            value (any)   -- значение
+            ttl   (float) -- время жизни записи (в секундах), не больше TTL кэша
+        '''
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)                                          # вытеснение самой старой записи
+
+    def delete(self, key):
+        ''' Удаление записи по ключу. '''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        ''' Очистка кэша. '''
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
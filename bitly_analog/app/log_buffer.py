@@ -0,0 +1,90 @@
+# ----- Буферизованная запись логов в БД
+
+import atexit, threading
+from collections import deque
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+
+from .models import Log
+
+
+# ----- Глобальные переменные
+LOG_BUFFER_SIZE = getattr(settings, 'LOG_BUFFER_SIZE', 10000)                           # предел очереди записей (0 - синхронная запись)
+LOG_FLUSH_SIZE = getattr(settings, 'LOG_FLUSH_SIZE', 500)                               # число записей, запускающее сброс в БД
+LOG_FLUSH_INTERVAL = getattr(settings, 'LOG_FLUSH_INTERVAL', 2)                         # период сброса очереди в БД (сек)
+
+
+class LogBuffer:
+    ''' Очередь записей Log в памяти процесса со сбросом в БД через bulk_create из фонового потока.
+        Сброс выполняется по числу записей или по времени, а также при завершении процесса.
+        При переполнении очереди записи отбрасываются с учётом в счётчике dropped, запрос не блокируется.
+        Аргументы:
+        maxsize    (int)   -- предел очереди (0 - запись в БД сразу)
+        flush_size (int)   -- число записей для досрочного сброса
+        interval   (float) -- период сброса (сек)
+    '''
+    def __init__(self, maxsize, flush_size, interval):
+        self.maxsize = maxsize
+        self.flush_size = flush_size
+        self.interval = interval
+        self.dropped = 0                                                                # число отброшенных записей
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def put(self, entry):
+        ''' Постановка несохранённого объекта Log в очередь. '''
+        if self.maxsize <= 0:
+            entry.save()
+            return
+        with self._lock:
+            if len(self._queue) >= self.maxsize:
+                self.dropped += 1
+                return
+            self._queue.append(entry)
+            size = len(self._queue)
+            if self._worker is None:
+                self._start()
+        if size >= self.flush_size:
+            self._wakeup.set()                                                          # досрочный сброс
+
+    def flush(self):
+        ''' Запись накопленных записей в БД. Возвращает число записанных записей. '''
+        with self._lock:
+            entries, self._queue = list(self._queue), deque()
+        if not entries:
+            return 0
+        return self.write(entries)
+
+    def write(self, entries):
+        ''' Запись пачки в БД. При ошибке (например, пользователь записи удалён) пачка записывается половинами,
+            так что отбрасываются только ошибочные записи. Возвращает число записанных записей.
+        '''
+        try:
+            with transaction.atomic():                                                  # точка сохранения: ошибка не ломает внешнюю транзакцию
+                Log.objects.bulk_create(entries, batch_size=self.flush_size)
+        except DatabaseError:
+            if len(entries) == 1:
+                with self._lock:
+                    self.dropped += 1
+                return 0
+            middle = len(entries) // 2
+            return self.write(entries[:middle]) + self.write(entries[middle:])
+        return len(entries)
+
+    def _start(self):
+        ''' Запуск фонового потока сброса при первой записи (не при импорте модуля). '''
+        self._worker = threading.Thread(target=self._run, name='log-buffer', daemon=True)
+        self._worker.start()
+        atexit.register(self.flush)                                                     # сброс остатка при завершении процесса
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+            close_old_connections()                                                     # соединение потока по правилам CONN_MAX_AGE
+
+
+log_buffer = LogBuffer(LOG_BUFFER_SIZE, LOG_FLUSH_SIZE, LOG_FLUSH_INTERVAL)
@@ -0,0 +1,77 @@
+# ----- Срок хранения записей Log: удаление пачками и архив NDJSON.gz
+
+import gzip, json, os
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Log
+from .common import logger
+
+
+# ----- Глобальные переменные
+LOG_RETENTION_DAYS = getattr(settings, 'LOG_RETENTION_DAYS', 90)                        # срок хранения записей (сутки, 0 - бессрочно)
+LOG_ARCHIVE_DIR = getattr(settings, 'LOG_ARCHIVE_DIR', None)                            # каталог архивов задачи clean_logs (None - без архива)
+LOG_CLEAN_BATCH = getattr(settings, 'LOG_CLEAN_BATCH', 5000)                            # число записей, удаляемых одним запросом
+LOG_FIELDS = ('id', 'date_time', 'owner_id', 'event', 'rule_id', 'payload')             # поля записи в архиве
+
+
+def log_lines(rows):
+    ''' Генератор строк NDJSON из кортежей LOG_FIELDS. '''
+    for row in rows:
+        yield json.dumps(dict(zip(LOG_FIELDS, row)), ensure_ascii=False, default=datetime.isoformat) + '\n'
+
+
+def expire_logs(before, archive=None, delete=True, batch_size=LOG_CLEAN_BATCH):
+    ''' Обработка записей Log старше before пачками по первичному ключу: пачка дописывается в архив
+        (и сбрасывается на диск) до удаления, удаление - одним DELETE по id.
+        Возвращает число обработанных записей.
+        Аргументы:
+        before     (datetime) -- граница: обрабатываются записи с более ранней датой
+        archive    (file)     -- текстовый файл архива NDJSON (None - без архива)
+        delete     (bool)     -- удалять ли записи
+        batch_size (int)      -- число записей в пачке
+    '''
+    count = 0
+    last_id = 0
+    while True:
+        batch = list(Log.objects.filter(date_time__lt=before, id__gt=last_id)
+                     .order_by('id').values_list(*LOG_FIELDS)[:batch_size])
+        if not batch:
+            break
+        if archive is not None:
+            archive.writelines(log_lines(batch))
+            archive.flush()                                                             # архив пачки - на диске до её удаления
+        if delete:
+            Log.objects.filter(id__in=[row[0] for row in batch]).delete()              # без зависимых строк и сигналов - один DELETE
+        count += len(batch)
+        last_id = batch[-1][0]
+    return count
+
+
+def open_archive(path):
+    ''' Открытие архива NDJSON.gz на дозапись (текстовый режим, UTF-8). '''
+    return gzip.open(path, 'at', encoding='utf-8')
+
+
+def clean_logs():
+    ''' Удаление записей Log старше LOG_RETENTION_DAYS суток с архивом в LOG_ARCHIVE_DIR (если задан).
+        Запускается планировщиком (см. SCHEDULER_JOBS и manage.py run_scheduler). Возвращает число удалённых записей.
+    '''
+    if not LOG_RETENTION_DAYS:
+        return 0
+    before = timezone.now() - timedelta(days=LOG_RETENTION_DAYS)
+    path = None
+    if LOG_ARCHIVE_DIR:
+        os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(LOG_ARCHIVE_DIR, 'log-{}.ndjson.gz'.format(timezone.now().strftime('%Y%m%dT%H%M%S')))
+        with open_archive(path) as archive:
+            deleted = expire_logs(before, archive)
+        if not deleted:
+            os.remove(path)                                                             # пустой архив не хранится
+            path = None
+    else:
+        deleted = expire_logs(before)
+    if deleted:
+        logger(None, Log.LOGS_CLEANED, deleted=deleted, archive=path)                   # запись лога в БД
+    return deleted
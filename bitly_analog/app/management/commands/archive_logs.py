@@ -0,0 +1,32 @@
+# ----- Команда архивирования записей Log в NDJSON.gz
+
+from datetime import datetime, time, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from app.export import parse_date
+from app.log_retention import LOG_CLEAN_BATCH, LOG_RETENTION_DAYS, expire_logs, open_archive
+
+
+class Command(BaseCommand):
+    help = 'Выгружает записи Log старше даты в сжатый NDJSON (.ndjson.gz); с --delete удаляет выгруженные записи.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='путь к файлу архива (.ndjson.gz, дописывается)')
+        parser.add_argument('--before', help='граница дат записей (ГГГГ-ММ-ДД, по умолчанию - срок хранения LOG_RETENTION_DAYS)')
+        parser.add_argument('--delete', action='store_true', help='удалить записи после выгрузки')
+        parser.add_argument('--batch-size', type=int, default=LOG_CLEAN_BATCH, help='число записей в пачке')
+
+    def handle(self, *args, **options):
+        try:
+            before = parse_date(options['before'])
+        except ValueError:
+            raise CommandError('Дата ожидается в формате ГГГГ-ММ-ДД.')
+        if before:
+            before = timezone.make_aware(datetime.combine(before, time.min))
+        else:
+            before = timezone.now() - timedelta(days=LOG_RETENTION_DAYS)
+        with open_archive(options['output']) as archive:
+            count = expire_logs(before, archive, options['delete'], options['batch_size'])
+        action = 'выгружено и удалено' if options['delete'] else 'выгружено'
+        self.stdout.write(self.style.SUCCESS('Записей до {}: {} {}.'.format(before.isoformat(), action, count)))
@@ -0,0 +1,38 @@
+# ----- Команда замеров производительности
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from app.benchmark import run, save_report
+
+
+class Command(BaseCommand):
+    help = ('Замеры перенаправления, записи, проверки субдомена, списка API и очистки правил во временной БД. '
+            'Запуск: manage.py benchmark --settings=bitly_analog.bench_settings --output=run.json')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owners', type=int, default=100, help='число пользователей')
+        parser.add_argument('--rules', type=int, default=10000, help='число правил')
+        parser.add_argument('--requests', type=int, default=500, help='число запросов сценария')
+        parser.add_argument('--warmup', type=int, default=50, help='число запросов прогрева')
+        parser.add_argument('--scenario', action='append', dest='names', help='сценарий (по умолчанию - все)')
+        parser.add_argument('--output', help='путь к JSON-файлу отчёта')
+        parser.add_argument('--force', action='store_true', help='разрешить запуск с настоящим Redis (кэш будет очищен)')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'BENCHMARK_STANDIN', False) and not options['force']:
+            raise CommandError('Замеры очищают кэш: используйте --settings=bitly_analog.bench_settings либо --force.')
+        databases = setup_databases(verbosity=0, interactive=False)                    # временная БД, как у тестов
+        try:
+            cache.clear()
+            report = run(options['owners'], options['rules'], options['requests'], options['names'], options['warmup'])
+        finally:
+            teardown_databases(databases, verbosity=0)
+        for name, metrics in report['results'].items():
+            self.stdout.write('{:<14} {rps:>9} rps  p50 {p50_ms:>8} ms  p95 {p95_ms:>8} ms  p99 {p99_ms:>8} ms  '
+                              '{queries:>6} запросов к БД'.format(name, **metrics))
+        if options['output']:
+            save_report(report, options['output'])
+            self.stdout.write(self.style.SUCCESS('Отчёт записан: {}'.format(options['output'])))
@@ -0,0 +1,26 @@
+# ----- Команда сравнения отчётов замеров
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.benchmark import compare, load_report
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает два JSON-отчёта команды benchmark; с --fail-over завершается ошибкой при ухудшении сверх порога.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('base', help='отчёт до изменений')
+        parser.add_argument('new', help='отчёт после изменений')
+        parser.add_argument('--fail-over', type=float, help='допустимое ухудшение метрики, %%')
+
+    def handle(self, *args, **options):
+        regressions = []
+        for name, metrics in compare(load_report(options['base']), load_report(options['new'])).items():
+            for metric, (old, value, change, worse) in metrics.items():
+                line = '{:<14} {:<7} {:>10} -> {:<10} {:+.1f}%'.format(name, metric, old, value, change)
+                failed = worse and options['fail_over'] is not None and abs(change) > options['fail_over']
+                if failed:
+                    regressions.append(line)
+                self.stdout.write(self.style.ERROR(line) if failed else line)
+        if regressions:
+            raise CommandError('Ухудшение сверх {}%: {}'.format(options['fail_over'], len(regressions)))
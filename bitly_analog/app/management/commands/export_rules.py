@@ -0,0 +1,29 @@
+# ----- Команда выгрузки правил в NDJSON/CSV
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.export import EXPORT_FORMATS, export_query, export_rows, export_lines, parse_date
+
+
+class Command(BaseCommand):
+    help = 'Потоково выгружает правила Url в NDJSON или CSV (в файл либо stdout).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='ndjson', help='формат выгрузки')
+        parser.add_argument('--owner', type=int, help='id пользователя')
+        parser.add_argument('--expire-from', help='начало диапазона дат удаления (ГГГГ-ММ-ДД)')
+        parser.add_argument('--expire-to', help='конец диапазона дат удаления (ГГГГ-ММ-ДД)')
+        parser.add_argument('--output', help='путь к файлу выгрузки (по умолчанию - stdout)')
+
+    def handle(self, *args, **options):
+        try:
+            query = export_query(options['owner'], parse_date(options['expire_from']), parse_date(options['expire_to']))
+        except ValueError:
+            raise CommandError('Даты ожидаются в формате ГГГГ-ММ-ДД.')
+        lines = export_lines(options['format'], export_rows(query))
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
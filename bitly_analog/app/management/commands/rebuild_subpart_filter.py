@@ -0,0 +1,13 @@
+# ----- Команда перестроения фильтра субдоменов
+
+from django.core.management.base import BaseCommand
+
+from app.bloom import rebuild_subpart_filter
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает фильтр Блума субдоменов в Redis по таблице Url.'
+
+    def handle(self, *args, **options):
+        count = rebuild_subpart_filter()
+        self.stdout.write(self.style.SUCCESS('Фильтр субдоменов перестроен, субдоменов: {}'.format(count)))
@@ -0,0 +1,38 @@
+# ----- Команда запуска планировщика периодических задач
+
+import signal
+from django.core.management.base import BaseCommand, CommandError
+
+from app.scheduler import Scheduler, load_jobs, run_history
+
+
+class Command(BaseCommand):
+    help = 'Запускает планировщик задач SCHEDULER_JOBS. Задачи выполняет один ведущий процесс кластера.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--run', metavar='NAME', help='выполнить задачу сразу и завершить работу')
+        parser.add_argument('--status', action='store_true', help='вывести метрики запусков задач')
+
+    def handle(self, *args, **options):
+        jobs = load_jobs()
+        if options['status']:
+            for job in jobs:
+                history, recent = run_history(job.name)
+                self.stdout.write('{} [{}]: {}'.format(job.name, job.schedule.expr, history or 'нет запусков'))
+                for run in recent[:5]:
+                    self.stdout.write('    {}'.format(run))
+            return
+        if options['run']:
+            job = next((job for job in jobs if job.name == options['run']), None)
+            if job is None:
+                raise CommandError('Неизвестная задача: ' + options['run'])
+            job.task()
+            self.stdout.write(self.style.SUCCESS('Задача {} выполнена.'.format(job.name)))
+            return
+
+        scheduler = Scheduler(jobs)
+        for signum in (signal.SIGTERM, signal.SIGINT):                                  # мягкая остановка по сигналу
+            signal.signal(signum, lambda *_: scheduler.stop())
+        self.stdout.write('Планировщик запущен, задач: {}.'.format(len(jobs)))
+        scheduler.run()
+        self.stdout.write('Планировщик остановлен.')
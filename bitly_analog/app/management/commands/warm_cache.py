@@ -0,0 +1,25 @@
+# ----- Команда прогрева и сверки кэша маппингов перенаправлений
+
+from time import perf_counter
+from django.core.management.base import BaseCommand
+
+from app.warmup import WARMUP_CHUNK_SIZE, reconcile_links, warm_links
+
+
+class Command(BaseCommand):
+    help = 'Записывает в Redis маппинги действующих правил Url; с --reconcile сверяет ключи Redis с таблицей Url.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reconcile', action='store_true', help='удалить маппинги без правил и исправить расходящиеся')
+        parser.add_argument('--chunk-size', type=int, default=WARMUP_CHUNK_SIZE, help='число правил/ключей в пачке')
+
+    def handle(self, *args, **options):
+        begin = perf_counter()
+        if options['reconcile']:
+            checked, removed, fixed = reconcile_links(options['chunk_size'])
+            count, message = checked, 'Проверено ключей: {}, удалено: {}, исправлено: {}'.format(checked, removed, fixed)
+        else:
+            count = warm_links(options['chunk_size'])
+            message = 'Записано маппингов: {}'.format(count)
+        elapsed = perf_counter() - begin
+        self.stdout.write(self.style.SUCCESS('{} за {:.1f} с ({:.0f} в секунду)'.format(message, elapsed, count / elapsed if elapsed else 0)))
@@ -0,0 +1,270 @@
+# ----- Метрики производительности запросов (гистограммы процесса, текстовый формат Prometheus)
+
+import asyncio, bisect, contextvars, logging, random, threading
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from redis import asyncio as aioredis
+from redis.connection import ConnectionPool
+from time import perf_counter
+
+from .middleware import sessionless
+
+
+# ----- Глобальные переменные
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)  # границы гистограмм времени (сек)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)                                        # границы гистограмм числа обращений
+HISTOGRAMS = {                                                                          # имя -> (описание, метки, границы корзин)
+    'http_request_duration_seconds': ('Время обработки запроса', ('view',), DURATION_BUCKETS),
+    'http_request_db_queries': ('Число запросов к БД на запрос', ('view',), COUNT_BUCKETS),
+    'http_request_db_seconds': ('Время запросов к БД на запрос', ('view',), DURATION_BUCKETS),
+    'http_request_redis_calls': ('Число обращений к Redis на запрос', ('view',), COUNT_BUCKETS),
+}
+COUNTERS = {                                                                            # имя -> (описание, метки)
+    'http_requests_total': ('Число запросов по коду ответа', ('view', 'status')),
+    'http_cache_requests_total': ('Обращения к слоям кэша', ('view', 'layer', 'result')),
+    'http_slow_requests_total': ('Число медленных запросов', ('view',)),
+}
+METRICS_SLOW_REQUEST = getattr(settings, 'METRICS_SLOW_REQUEST', 0)                     # порог медленного запроса (сек, 0 - не отслеживать)
+METRICS_SLOW_SAMPLE = getattr(settings, 'METRICS_SLOW_SAMPLE', 1)                       # доля запросов, для которых копится SQL (0..1)
+METRICS_SQL_LIMIT = getattr(settings, 'METRICS_SQL_LIMIT', 50)                          # предел числа запомненных запросов SQL
+METRICS_ALLOWED_IPS = getattr(settings, 'METRICS_ALLOWED_IPS', ())                      # адреса, которым доступны метрики (пусто - всем)
+
+slow_log = logging.getLogger('app.metrics')                                             # лог медленных запросов
+request_stats = contextvars.ContextVar('request_stats', default=None)                  # показатели текущего запроса
+
+
+class RequestStats:
+    ''' Показатели одного запроса: обращения к БД, Redis и слоям кэша.
+        Аргументы:
+        sample (bool) -- запоминать ли SQL запроса (для лога медленных запросов)
+    '''
+    __slots__ = ('queries', 'db_time', 'redis_calls', 'caches', 'sql')
+
+    def __init__(self, sample=False):
+        self.queries = 0
+        self.db_time = 0.0
+        self.redis_calls = 0
+        self.caches = {}                                                                # слой -> [попадания, промахи]
+        self.sql = [] if sample else None                                               # (время, SQL) выборки медленных запросов
+
+
+class Registry:
+    ''' Гистограммы и счётчики процесса. Запись - без блокировок: каждый поток пишет только в свой набор
+        значений, при выдаче метрик наборы всех потоков суммируются.
+    '''
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []                                                               # наборы значений потоков
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            self._shards.append(shard)                                                  # list.append атомарен
+        return shard
+
+    def observe(self, name, labels, value):
+        ''' Запись значения value в гистограмму name с метками labels (кортеж значений). '''
+        buckets = HISTOGRAMS[name][2]
+        shard = self._shard()
+        series = shard.get((name, labels))
+        if series is None:
+            series = shard[(name, labels)] = [0] * (len(buckets) + 1) + [0.0]           # число значений по корзинам (+Inf), сумма
+        series[bisect.bisect_left(buckets, value)] += 1
+        series[-1] += value
+
+    def inc(self, name, labels, amount=1):
+        ''' Увеличение счётчика name с метками labels. '''
+        shard = self._shard()
+        shard[(name, labels)] = shard.get((name, labels), 0) + amount
+
+    def collect(self):
+        ''' Возвращает {(имя, метки): значение} - сумму наборов всех потоков. '''
+        total = {}
+        for shard in list(self._shards):
+            for key, value in list(shard.items()):                                      # копия: поток-владелец продолжает запись
+                if isinstance(value, list):
+                    merged = total.setdefault(key, [0] * len(value))
+                    for i, item in enumerate(list(value)):
+                        merged[i] += item
+                else:
+                    total[key] = total.get(key, 0) + value
+        return total
+
+    def render(self):
+        ''' Возвращает метрики в текстовом формате Prometheus. '''
+        total = self.collect()
+        lines = []
+        for name, (text, labelnames, buckets) in HISTOGRAMS.items():
+            lines += ['# HELP {} {}'.format(name, text), '# TYPE {} histogram'.format(name)]
+            for (metric, labels), series in sorted(total.items()):
+                if metric != name:
+                    continue
+                pairs, count = label_pairs(labelnames, labels), 0
+                for bound, value in zip(buckets + ('+Inf',), series):
+                    count += value
+                    lines.append('{}_bucket{{{}}} {}'.format(name, ','.join(pairs + ['le="{}"'.format(bound)]), count))
+                lines.append('{}_sum{{{}}} {}'.format(name, ','.join(pairs), round(series[-1], 6)))
+                lines.append('{}_count{{{}}} {}'.format(name, ','.join(pairs), count))
+        for name, (text, labelnames) in COUNTERS.items():
+            lines += ['# HELP {} {}'.format(name, text), '# TYPE {} counter'.format(name)]
+            for (metric, labels), value in sorted(total.items()):
+                if metric == name:
+                    lines.append('{}{{{}}} {}'.format(name, ','.join(label_pairs(labelnames, labels)), value))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        ''' Сброс значений всех потоков. '''
+        for shard in list(self._shards):
+            shard.clear()
+
+
+registry = Registry()                                                                   # метрики процесса
+
+
+def label_pairs(names, values):
+    ''' Возвращает список меток вида name="value" с экранированием значений. '''
+    return ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in zip(names, values)]
+
+
+def record_cache(layer, hit):
+    ''' Учёт обращения к слою кэша layer в показателях текущего запроса (вне запроса - без учёта).
+        Аргументы:
+        layer (str)  -- слой кэша
+        hit   (bool) -- True - попадание, False - промах
+    '''
+    stats = request_stats.get()
+    if stats is not None:
+        stats.caches.setdefault(layer, [0, 0])[0 if hit else 1] += 1
+
+
+def record_query(execute, sql, params, many, context):
+    ''' Обёртка выполнения запроса к БД (connection.execute_wrapper): число и время запросов текущего запроса. '''
+    stats = request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    begin = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = perf_counter() - begin
+        stats.queries += 1
+        stats.db_time += elapsed
+        if stats.sql is not None and len(stats.sql) < METRICS_SQL_LIMIT:
+            stats.sql.append((elapsed, sql))
+
+
+def install_query_hook(connection, **kwargs):
+    ''' Подключение record_query к соединению с БД (один раз на объект соединения потока). '''
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_hook, dispatch_uid='app.metrics.install_query_hook')   # соединения потоков sync_to_async
+
+
+class CountingConnectionPool(ConnectionPool):
+    ''' Пул соединений Redis с учётом обращений текущего запроса: соединение берётся из пула
+        на каждую команду и на каждый конвейер (pipeline), т.е. на каждый обмен с сервером.
+        Подключается параметром CACHES['default']['OPTIONS']['CONNECTION_POOL_CLASS'].
+    '''
+    def get_connection(self, *args, **kwargs):
+        stats = request_stats.get()
+        if stats is not None:
+            stats.redis_calls += 1
+        return super().get_connection(*args, **kwargs)
+
+
+class AsyncCountingConnectionPool(aioredis.ConnectionPool):
+    ''' Асинхронный вариант CountingConnectionPool (клиент app.async_cache). '''
+    async def get_connection(self, *args, **kwargs):
+        stats = request_stats.get()
+        if stats is not None:
+            stats.redis_calls += 1
+        return await super().get_connection(*args, **kwargs)
+
+
+def view_name(request):
+    ''' Имя представления запроса для меток (маршрут не найден - 'unresolved'). '''
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unresolved'
+
+
+def observe_request(request, response, stats, elapsed):
+    ''' Запись показателей завершённого запроса в метрики процесса; медленный запрос с выборкой SQL - в лог.
+        Аргументы:
+        request  (HttpRequest)  -- объект HTTP-запроса
+        response (HttpResponse) -- ответ
+        stats    (RequestStats) -- показатели запроса
+        elapsed  (float)        -- время обработки (сек)
+    '''
+    view = view_name(request)
+    registry.observe('http_request_duration_seconds', (view,), elapsed)
+    registry.observe('http_request_db_queries', (view,), stats.queries)
+    registry.observe('http_request_db_seconds', (view,), stats.db_time)
+    registry.observe('http_request_redis_calls', (view,), stats.redis_calls)
+    registry.inc('http_requests_total', (view, str(response.status_code)))
+    for layer, (hits, misses) in stats.caches.items():
+        if hits:
+            registry.inc('http_cache_requests_total', (view, layer, 'hit'), hits)
+        if misses:
+            registry.inc('http_cache_requests_total', (view, layer, 'miss'), misses)
+    if METRICS_SLOW_REQUEST and elapsed >= METRICS_SLOW_REQUEST:
+        registry.inc('http_slow_requests_total', (view,))
+        if stats.sql is not None:
+            slow_log.warning('Медленный запрос %s %s (%s): %.3f с, запросов к БД %d (%.3f с), обращений к Redis %d\n%s',
+                             request.method, request.get_full_path(), view, elapsed, stats.queries, stats.db_time,
+                             stats.redis_calls, '\n'.join('{:.3f} с  {}'.format(*item) for item in stats.sql))
+
+
+class MetricsMiddleware:
+    ''' Учёт показателей каждого запроса: время обработки, число и время запросов к БД, обращения к Redis
+        и к слоям кэша (record_cache). Подключается первым в MIDDLEWARE - время включает остальные слои.
+        Поддерживает синхронную и асинхронную обработку.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine                       # признак асинхронного слоя для Django
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        install_query_hook(connection)                                                  # соединение потока, созданное до подключения сигнала
+        stats = RequestStats(sample=bool(METRICS_SLOW_REQUEST) and random.random() < METRICS_SLOW_SAMPLE)
+        token = request_stats.set(stats)
+        begin = perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            request_stats.reset(token)
+        observe_request(request, response, stats, perf_counter() - begin)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats(sample=bool(METRICS_SLOW_REQUEST) and random.random() < METRICS_SLOW_SAMPLE)
+        token = request_stats.set(stats)                                                # контекст наследуют вызовы sync_to_async
+        begin = perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_stats.reset(token)
+        observe_request(request, response, stats, perf_counter() - begin)
+        return response
+
+
+@sessionless()
+def prometheus_metrics(request):
+    ''' Метрики процесса в текстовом формате Prometheus (каждый процесс сервера отдаёт свои значения).
+        Аргументы:
+        request (HttpRequest) -- объект HTTP-запроса
+    '''
+    if METRICS_ALLOWED_IPS and request.META.get('REMOTE_ADDR') not in METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,43 @@
+# ----- Промежуточные слои (middleware)
+
+from django.contrib.sessions.middleware import SessionMiddleware
+
+
+# ----- Глобальные переменные
+ALL_METHODS = ('GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE')               # все методы запроса
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')                                               # методы только для чтения
+
+
+def sessionless(*methods):
+    ''' Декоратор представления: запросы указанными методами (по умолчанию - любыми) обслуживаются без сессии.
+        Аргументы:
+        methods (str) -- методы HTTP-запроса
+    '''
+    def decorator(view):
+        view.sessionless = methods or ALL_METHODS
+        return view
+    return decorator
+
+
+def sessionless_methods(view_func):
+    ''' Возвращает методы, для которых представлению не нужна сессия (атрибут функции либо класса представления). '''
+    methods = getattr(view_func, 'sessionless', None)
+    if methods is None:
+        view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)   # ViewSet DRF / View
+        methods = getattr(view_class, 'sessionless', ())
+    return methods
+
+
+class SessionlessMiddleware(SessionMiddleware):
+    ''' SessionMiddleware с обходом сессий для представлений с атрибутом sessionless (перенаправления,
+        чтение API): сессия не читается из хранилища, не записывается и кука не отправляется.
+    '''
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method in sessionless_methods(view_func):
+            request.sessionless = True
+            request.session = self.SessionStore()                                       # пустая сессия без обращения к хранилищу
+
+    def process_response(self, request, response):
+        if getattr(request, 'sessionless', False):
+            return response
+        return super().process_response(request, response)
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.21 on 2026-10-18 09:34
+
+from django.db import migrations, models
+
+
+def rename_duplicates(apps, schema_editor):
+    ''' Переименование повторяющихся субдоменов перед созданием уникального индекса.
+        Первое (с наименьшим id) правило сохраняет субдомен, остальные получают суффикс '-<id>'.
+    '''
+    Url = apps.get_model('app', 'Url')
+    duplicates = Url.objects.values('subpart').annotate(count=models.Count('id')).filter(count__gt=1)
+    for row in duplicates:
+        for url in Url.objects.filter(subpart=row['subpart']).order_by('id')[1:]:
+            suffix = '-{}'.format(url.id)
+            subpart = url.subpart[:40 - len(suffix)] + suffix
+            url.alias = url.alias[:len(url.alias) - len(url.subpart)] + subpart
+            url.subpart = subpart
+            url.save(update_fields=['subpart', 'alias'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='url',
+            name='subpart',
+            field=models.CharField(max_length=40, unique=True, verbose_name='Субдомен'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.21 on 2026-10-18 09:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_url_subpart_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='url',
+            index=models.Index(fields=['owner', 'expire_date', 'id'], name='url_owner_expire_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='url',
+            index=models.Index(fields=['expire_date', 'id'], name='url_expire_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_url_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClickStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('total', 'Всего'), ('day', 'День'), ('referrer', 'Источник перехода'), ('agent', 'Тип клиента')], max_length=10, verbose_name='Вид счётчика')),
+                ('key', models.CharField(blank=True, max_length=100, verbose_name='Значение группы (дата, домен источника, тип клиента)')),
+                ('clicks', models.PositiveIntegerField(default=0, verbose_name='Число переходов')),
+                ('url', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.url')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='clickstat',
+            constraint=models.UniqueConstraint(fields=('url', 'kind', 'key'), name='clickstat_url_kind_key'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:50
+
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+from django.db import migrations, models
+
+
+# Копии Url.normalize_link и Url.digest на момент миграции: их изменение в модели не меняет заполненные хэши
+def normalize_link(link):
+    ''' Нормализованная ссылка: схема и хост в нижнем регистре, без порта по умолчанию, пустой путь - '/'. '''
+    parts = urlsplit(link.strip())
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    if (scheme, netloc.rpartition(':')[2]) in (('http', '80'), ('https', '443')):
+        netloc = netloc.rpartition(':')[0]
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, parts.fragment))
+
+
+def digest(link):
+    ''' Хэш нормализованной ссылки (32 hex-символа). '''
+    return hashlib.blake2b(normalize_link(link).encode(), digest_size=16).hexdigest()
+
+
+def fill_link_hash(apps, schema_editor):
+    ''' Заполнение хэша ссылок существующих правил пачками по первичному ключу. '''
+    Url = apps.get_model('app', 'Url')
+    last_id = 0
+    while True:
+        batch = list(Url.objects.filter(id__gt=last_id).order_by('id').only('id', 'link')[:1000])
+        if not batch:
+            break
+        for url in batch:
+            url.link_hash = digest(url.link)
+        Url.objects.bulk_update(batch, ['link_hash'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_clickstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='link_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, verbose_name='Хэш нормализованной ссылки'),
+        ),
+        migrations.RunPython(fill_link_hash, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='url',
+            index=models.Index(fields=['owner', 'link_hash'], name='url_owner_link_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_url_link_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='redirect_status',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(301, '301 Moved Permanently'), (302, '302 Found'), (307, '307 Temporary Redirect')], null=True, verbose_name='Код перенаправления (пусто - по умолчанию сервиса)'),
+        ),
+    ]
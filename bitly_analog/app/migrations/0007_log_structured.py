@@ -0,0 +1,82 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:04
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def move_text(apps, schema_editor):
+    ''' Перенос имени процесса и текста существующих записей в данные события пачками по первичному ключу. '''
+    Log = apps.get_model('app', 'Log')
+    last_id = 0
+    while True:
+        batch = list(Log.objects.filter(id__gt=last_id).order_by('id').only('id', 'process', 'execute')[:1000])
+        if not batch:
+            break
+        for log in batch:
+            log.payload = {'process': log.process, 'message': log.execute}
+        Log.objects.bulk_update(batch, ['payload'])
+        last_id = batch[-1].id
+
+
+def restore_text(apps, schema_editor):
+    ''' Обратный перенос: имя процесса и текст записи из данных события. '''
+    Log = apps.get_model('app', 'Log')
+    last_id = 0
+    while True:
+        batch = list(Log.objects.filter(id__gt=last_id).order_by('id').only('id', 'event', 'payload')[:1000])
+        if not batch:
+            break
+        for log in batch:
+            log.process = log.payload.get('process', '')[:100]
+            log.execute = log.payload.get('message') or '{} {}'.format(log.event, log.payload)
+        Log.objects.bulk_update(batch, ['process', 'execute'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_url_redirect_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='event',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Прочее'), (1, 'Создан пользователь'), (2, 'Создано правило'), (3, 'Создан кэш страницы правил'), (4, 'Пакетно созданы правила'), (5, 'Удалены правила с истёкшим сроком'), (6, 'Сбой периодической задачи'), (7, 'Удалены старые записи журнала')], default=0, verbose_name='Событие'),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='payload',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Данные события'),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='rule_id',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='id правила'),
+        ),
+        migrations.AlterField(                                                          # значения по умолчанию - для отката RemoveField
+            model_name='log',
+            name='process',
+            field=models.CharField(default='', max_length=100, verbose_name='Имя процесса'),
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='execute',
+            field=models.TextField(default='', verbose_name='Что выполнено'),
+        ),
+        migrations.RunPython(move_text, restore_text),
+        migrations.RemoveField(
+            model_name='log',
+            name='execute',
+        ),
+        migrations.RemoveField(
+            model_name='log',
+            name='process',
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='date_time',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Дата и время операции'),
+        ),
+    ]
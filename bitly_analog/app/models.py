@@ -2,6 +2,8 @@
 Definition of models.
 """
 
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
 from django.db import models
 from django.utils import timezone
 from django.contrib.sessions.models import Session
@@ -20,15 +22,60 @@ class Owner(models.Model):
         return 'Пользователь: {}...{}'.format(self.session.session_key[:4], self.session.session_key[-3:])
 
 
+REDIRECT_STATUSES = (
+    (301, '301 Moved Permanently'),
+    (302, '302 Found'),
+    (307, '307 Temporary Redirect'),
+)
+
+
 class Url(models.Model):
     """ Модель БД. Хранит параметры правил сокращения ссылок. """
     link = models.URLField('Оригинальная ссылка')
     alias = models.CharField('Алиас', max_length=100)
-    subpart = models.CharField('Субдомен', max_length=40)
+    subpart = models.CharField('Субдомен', max_length=40, unique=True)
     expire_date = models.DateField('Дата удаления правила')     
     str_limit = models.PositiveSmallIntegerField('Число первых символов отображения оригинального URL в методе __str__'
                                                  , default=40)
     owner = models.ForeignKey(Owner, on_delete=models.CASCADE)                   # связь с таблицей пользователей Owner
+    link_hash = models.CharField('Хэш нормализованной ссылки', max_length=32, blank=True, editable=False)
+    redirect_status = models.PositiveSmallIntegerField('Код перенаправления (пусто - по умолчанию сервиса)',
+                                                       choices=REDIRECT_STATUSES, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'expire_date', 'id'], name='url_owner_expire_idx'),  # страницы правил пользователя
+            models.Index(fields=['expire_date', 'id'], name='url_expire_idx'),                  # страницы API и очистка по дате
+            models.Index(fields=['owner', 'link_hash'], name='url_owner_link_idx'),            # поиск дубликата ссылки пользователя
+        ]
+
+    @staticmethod
+    def normalize_link(link):
+        """ Нормализованная ссылка: схема и хост в нижнем регистре, без порта по умолчанию, пустой путь - '/'. """
+        parts = urlsplit(link.strip())
+        scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+        if (scheme, netloc.rpartition(':')[2]) in (('http', '80'), ('https', '443')):
+            netloc = netloc.rpartition(':')[0]
+        return urlunsplit((scheme, netloc, parts.path or '/', parts.query, parts.fragment))
+
+    @classmethod
+    def digest(cls, link):
+        """ Хэш нормализованной ссылки фиксированной длины (32 hex-символа) для индексного поиска. """
+        return hashlib.blake2b(cls.normalize_link(link).encode(), digest_size=16).hexdigest()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """ Объект из БД с запоминанием загруженного субдомена (сигнал записи сбрасывает маппинг прежнего субдомена). """
+        instance = super().from_db(db, field_names, values)
+        instance._saved_subpart = instance.__dict__.get('subpart')                     # None - поле не загружено
+        return instance
+
+    def save(self, *args, **kwargs):
+        """ Запись правила с пересчётом хэша ссылки. """
+        self.link_hash = self.digest(self.link)
+        if kwargs.get('update_fields') is not None and 'link' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'link_hash'}
+        super().save(*args, **kwargs)
 
     def to_json(self):
         """ Сведения об объекте модели в формате JSON. """
@@ -59,12 +106,47 @@ class Collection(models.Model):
 
 
 class Log(models.Model):
-    """ Модель БД. Хранит статистику выполнения операций пользователями и приложением. """
-    date_time = models.DateTimeField('Дата и время операции', default=timezone.now)
+    """ Модель БД. Хранит журнал операций пользователей и приложения: вид события, id правила и данные события.
+        Записи старше LOG_RETENTION_DAYS удаляет задача clean_logs (см. app.log_retention).
+    """
+    OTHER, OWNER_CREATED, RULE_CREATED, RULES_CACHED, RULES_BULK_CREATED, RULES_CLEANED, TASK_FAILED, LOGS_CLEANED = range(8)
+    EVENTS = (
+        (OTHER, 'Прочее'),
+        (OWNER_CREATED, 'Создан пользователь'),
+        (RULE_CREATED, 'Создано правило'),
+        (RULES_CACHED, 'Создан кэш страницы правил'),
+        (RULES_BULK_CREATED, 'Пакетно созданы правила'),
+        (RULES_CLEANED, 'Удалены правила с истёкшим сроком'),
+        (TASK_FAILED, 'Сбой периодической задачи'),
+        (LOGS_CLEANED, 'Удалены старые записи журнала'),
+    )
+
+    date_time = models.DateTimeField('Дата и время операции', default=timezone.now, db_index=True)   # отбор записей по сроку хранения
     owner = models.ForeignKey(Owner, null=True, on_delete=models.SET_NULL)       # связь с таблицей пользователей Owner
-    process = models.CharField('Имя процесса', max_length=100)
-    execute = models.TextField('Что выполнено')
+    event = models.PositiveSmallIntegerField('Событие', choices=EVENTS, default=OTHER)
+    rule_id = models.PositiveIntegerField('id правила', null=True, blank=True)   # без внешнего ключа: правило удаляется раньше записи
+    payload = models.JSONField('Данные события', default=dict, blank=True)
+
+    def __str__(self):
+        """ Строковое представление модели. """
+        return '{}: {} | {} | {} | {}'.format(self.date_time, self.owner, self.get_event_display(), self.rule_id, self.payload)
+
+
+class ClickStat(models.Model):
+    """ Модель БД. Хранит счётчики переходов по правилам: всего, по дням, по источникам и типам клиентов. """
+    TOTAL, DAY, REFERRER, AGENT = 'total', 'day', 'referrer', 'agent'
+    KINDS = ((TOTAL, 'Всего'), (DAY, 'День'), (REFERRER, 'Источник перехода'), (AGENT, 'Тип клиента'))
+
+    url = models.ForeignKey(Url, on_delete=models.CASCADE)                       # связь с таблицей правил Url
+    kind = models.CharField('Вид счётчика', max_length=10, choices=KINDS)
+    key = models.CharField('Значение группы (дата, домен источника, тип клиента)', max_length=100, blank=True)
+    clicks = models.PositiveIntegerField('Число переходов', default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['url', 'kind', 'key'], name='clickstat_url_kind_key'),   # ключ пакетного upsert
+        ]
 
     def __str__(self):
         """ Строковое представление модели. """
-        return '{}: {} | {} | {}'.format(self.date_time, self.owner, self.process, self.execute)
+        return '{} | {} {}: {}'.format(self.url_id, self.get_kind_display(), self.key, self.clicks)
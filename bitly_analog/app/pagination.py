@@ -0,0 +1,122 @@
+# ----- Пагинация по ключу (keyset) на (expire_date, id)
+
+import hashlib
+from collections import OrderedDict
+from datetime import date
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+# ----- Глобальные переменные
+CURSOR_END = 'end'                                                                      # курсор последней страницы
+COUNT_TTL = getattr(settings, 'CACHE_TTL', 300)                                         # время жизни закэшированного числа строк (сек)
+COUNT_KEY = 'api:count:{}:{}'                                                           # шаблон ключа числа строк: модель, хэш SQL выборки
+
+
+def row_value(row, name):
+    ''' Значение поля строки выборки: словаря values() либо объекта модели. '''
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def count_key(queryset):
+    ''' Возвращает ключ кэша числа строк выборки: отфильтрованные выборки (в т.ч. правила одного пользователя)
+        кэшируются отдельно от полной по хэшу их SQL с параметрами.
+    '''
+    sql = hashlib.blake2b(str(queryset.query).encode(), digest_size=16).hexdigest()
+    return COUNT_KEY.format(queryset.model._meta.label_lower, sql)
+
+
+def format_cursor(key):
+    ''' Возвращает курсор ключа (expire_date, id) в формате <expire_date>_<id> (CURSOR_END - без изменений). '''
+    return key if key == CURSOR_END else '{}_{}'.format(key[0].isoformat(), key[1])
+
+
+def encode_cursor(row):
+    ''' Возвращает курсор строки выборки. '''
+    return format_cursor((row_value(row, 'expire_date'), row_value(row, 'id')))
+
+
+def decode_cursor(cursor):
+    ''' Возвращает ключ (expire_date, id) из курсора, CURSOR_END либо None для пустого или некорректного курсора. '''
+    if cursor == CURSOR_END:
+        return CURSOR_END
+    try:
+        date_str, id_str = cursor.split('_')
+        return date.fromisoformat(date_str), int(id_str)
+    except (AttributeError, ValueError):
+        return None
+
+
+def keyset_page(query, onpage, after=None, before=None):
+    ''' Выборка страницы по ключу (expire_date, id): стоимость не зависит от номера страницы.
+        Возвращает кортеж (строки страницы, есть ли следующая, есть ли предыдущая).
+        Аргументы:
+        query  (QuerySet) -- выборка правил (модели или values())
+        onpage (int)      -- количество строк на странице
+        after  (tuple)    -- ключ строки, после которой начинается страница
+        before (tuple)    -- ключ строки, перед которой заканчивается страница (CURSOR_END - последняя страница)
+    '''
+    if before:
+        if before != CURSOR_END:
+            query = query.filter(Q(expire_date__lt=before[0]) | Q(expire_date=before[0], id__lt=before[1]))
+        rows = list(query.order_by('-expire_date', '-id')[:onpage + 1])                 # +1 строка - признак соседней страницы
+        return rows[:onpage][::-1], before != CURSOR_END, len(rows) > onpage
+    if after and after != CURSOR_END:
+        query = query.filter(Q(expire_date__gt=after[0]) | Q(expire_date=after[0], id__gt=after[1]))
+    rows = list(query.order_by('expire_date', 'id')[:onpage + 1])
+    return rows[:onpage], len(rows) > onpage, bool(after)
+
+
+class KeysetPage:
+    ''' Страница списка правил для шаблона (аналог django.core.paginator.Page без номера страницы).
+        Аргументы:
+        object_list  (list)    -- строки страницы
+        count        (int)     -- общее число строк списка
+        has_next     (Boolean) -- есть ли следующая страница
+        has_previous (Boolean) -- есть ли предыдущая страница
+    '''
+    def __init__(self, object_list, count, has_next, has_previous):
+        self.object_list = object_list
+        self.count = count
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.object_list else None
+
+
+class KeysetPagination(BasePagination):
+    ''' Пагинация REST API по ключу (expire_date, id) с параметрами ?after=<курсор> / ?before=<курсор>.
+        Общее число строк выборки кэшируется на COUNT_TTL секунд (ключ - по SQL выборки, см. count_key).
+    '''
+    page_size = getattr(settings, 'REST_FRAMEWORK', {}).get('PAGE_SIZE') or 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        after = decode_cursor(request.query_params.get('after'))
+        before = decode_cursor(request.query_params.get('before'))
+        rows, has_next, has_previous = keyset_page(queryset, self.page_size, after, before)
+        count = cache.get_or_set(count_key(queryset), queryset.count, COUNT_TTL)
+        self.page = KeysetPage(rows, count, has_next, has_previous)
+        return rows
+
+    def get_link(self, param, cursor):
+        url = remove_query_param(self.request.build_absolute_uri(), 'after' if param == 'before' else 'before')
+        return replace_query_param(url, param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.page.count),                                                 # приблизительно: из кэша
+            ('next', self.get_link('after', self.page.next_cursor) if self.page.has_next else None),
+            ('previous', self.get_link('before', self.page.previous_cursor) if self.page.has_previous else None),
+            ('results', data),
+        ]))
@@ -1,47 +1,62 @@
 # ----- Периодические задачи
 
-import threading, inspect, time
-from datetime import datetime, timedelta
-from app.common import logger, get_fname
-from app.models import Url
-
-def clean_urls(*args):                                                                      
-    ''' Очистка в БД записей правил модели 'Url' с наступившей датой удаления 'expire_date'. 
-        Вызывается асинхронно в отдельном потоке.
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from app.common import logger, drop_link, invalidate_rules
+from app.models import Url, Collection, ClickStat, Log
+
+
+# ----- Глобальные переменные
+CLEAN_BATCH_SIZE = getattr(settings, 'CLEAN_BATCH_SIZE', 1000)                          # число правил, удаляемых в одной транзакции
+
+
+def delete_rows(model, ids):
+    ''' Удаление строк модели по первичному ключу одним DELETE без сборщика каскадов и построчных сигналов
+        (для Url - post_delete: кэш очищается вызывающим для всей пачки). Зависимые строки удаляются заранее.
+        Аргументы:
+        model (Model)    -- класс модели
+        ids   (iterable) -- значения первичного ключа
     '''
-    msg = 'Периодическая задача: очистка в БД Url-объектов правил по текущую дату включительно. '
-    while True:
-        delay = 24*60*60  # одни сутки                                                  # время в секундах между вызовами функции
-        # очистка правил в БД и логирование
-        try: 
-            query = Url.objects.filter(expire_date__lte=datetime.now().date())          # выборка всех правил до текущей даты включительно
-        except NameError:
-            msg += DB_ERROR + 'Таблица Url не найдена.' 
-        else: 
-            ids = [url.id for url in query]
-            # сообщение в лог
-            msg = ('Удалены правила ({}) с id : ' + str(len(ids)) + str(ids)) if query \
-                else 'Нет правил для удаления.' + msg
-            query.delete()                                                              # удаление правил с соответствующей датой
-        finally:
-            logger(None, get_fname(inspect.currentframe()), msg)                        # запись лога в БД  
-        # очистка правил в кэше
-        time.sleep(delay)                                                               # останов задачи на период
-
-
-def scheduller(task, *args):
-    ''' Выполняет запуск асинхронной задачи в потоке.
+    qn = connection.ops.quote_name
+    ids = list(ids)
+    sql = 'DELETE FROM {} WHERE {} IN ({})'.format(
+        qn(model._meta.db_table), qn(model._meta.pk.column), ', '.join(['%s'] * len(ids)))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, ids)
+
+
+def delete_expired_urls(batch_size=CLEAN_BATCH_SIZE):
+    ''' Удаление правил с наступившей датой удаления пачками по первичному ключу в коротких транзакциях.
+        Для каждой пачки маппинги редиректов удаляются из Redis одной командой,
+        а кэш списков правил владельцев сбрасывается одним конвейером. Возвращает число удалённых правил.
         Аргументы:
-        task (str)      -- имя задачи/функции
-        args (tuple)    -- аргументы задачи task
+        batch_size (int) -- число правил в пачке
+    '''
+    today = timezone.localdate()                                                        # как в фильтрах действующих правил
+    deleted = 0
+    last_id = 0
+    while True:
+        batch = list(Url.objects.filter(expire_date__lte=today, id__gt=last_id)
+                     .order_by('id').values_list('id', 'subpart', 'owner_id')[:batch_size])
+        if not batch:
+            break
+        ids, subparts, owner_ids = zip(*batch)
+        with transaction.atomic():
+            Collection.objects.filter(url_id__in=ids).delete()                          # без сигналов - один DELETE
+            ClickStat.objects.filter(url_id__in=ids).delete()                           # статистика переходов правил - так же
+            delete_rows(Url, ids)
+        drop_link(*subparts)                                                            # очистка правил в кэше
+        invalidate_rules(*set(owner_ids))
+        deleted += len(ids)
+        last_id = ids[-1]
+    return deleted
+
+
+def clean_urls():
+    ''' Очистка в БД и кэше правил модели 'Url' с наступившей датой удаления 'expire_date'. 
+        Запускается планировщиком (см. SCHEDULER_JOBS и manage.py run_scheduler). Освобождённые субдомены
+        остаются в фильтре до его перестроения отдельной задачей rebuild_subpart_filter (ложные "занят" проверяются по БД).
     '''
-    thread = threading.Thread(target=task, args=args)                                  # инициализация потока
-    try:
-        thread.start()
-    except:
-        msg = 'Не удалось запустить асинхроную задачу.' + task.__name__ 
-    else: 
-        msg = '--> В асинхронном потоке запущена задача ' + task.__name__ \
-                + ((': ' + args[0]) if args else '') + '\n'                            # сообщение в лог из аргументов 
-    logger(None, get_fname(inspect.currentframe()), msg)                               # запись лога в БД  
-    print(msg)                                                                         # сообщение в консоль сервера
+    deleted = delete_expired_urls()
+    logger(None, Log.RULES_CLEANED, deleted=deleted)                                    # запись лога в БД  
@@ -0,0 +1,114 @@
+# ----- Ограничение частоты запросов (token bucket в Redis)
+
+import math, time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from rest_framework.throttling import BaseThrottle
+
+
+# ----- Глобальные переменные
+RATE_LIMITS = getattr(settings, 'RATE_LIMITS', {})                                      # область -> 'N/s|m|h|d' (нет области - без ограничения)
+RATE_LIMIT_KEY = 'ratelimit:{}:{}'                                                      # шаблон ключа корзины: область, клиент
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}                                      # длительность периода (сек)
+
+# Корзина токенов: пополнение rate токенов в секунду до capacity, запрос забирает один токен.
+# Проверка и списание - одним атомарным вызовом. KEYS: ключ корзины; ARGV: capacity, rate, текущее время (мс).
+# Возвращает {1, 0} - запрос разрешён, {0, <мс до появления токена>} - отклонён.
+BUCKET_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+local allowed, wait = 0, 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate))
+return {allowed, wait}
+'''
+
+_script = None                                                                          # зарегистрированный BUCKET_SCRIPT
+
+
+def parse_rate(rate):
+    ''' Возвращает (ёмкость корзины, токенов в секунду) для лимита вида 'N/s|m|h|d'. '''
+    count, period = rate.split('/')
+    count = int(count)
+    return count, count / PERIODS[period[0]]
+
+
+def client_key(request):
+    ''' Идентификатор клиента - IP-адрес (ключ сессии из куки не проверен и легко подменяется). '''
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def hit(scope, request):
+    ''' Учёт запроса в корзине области scope одним обращением к Redis (EVALSHA).
+        Возвращает 0, если запрос разрешён, иначе число секунд до появления токена.
+        При недоступности Redis запрос разрешается.
+        Аргументы:
+        scope   (str)         -- область лимита (ключ RATE_LIMITS)
+        request (HttpRequest) -- объект HTTP-запроса
+    '''
+    global _script
+    rate = RATE_LIMITS.get(scope)
+    if not rate:
+        return 0
+    capacity, per_second = parse_rate(rate)
+    conn = get_redis_connection('default')
+    if _script is None or _script.registered_client is not conn:
+        _script = conn.register_script(BUCKET_SCRIPT)
+    key = cache.make_key(RATE_LIMIT_KEY.format(scope, client_key(request)))
+    try:
+        allowed, wait = _script(keys=[key], args=[capacity, per_second, int(time.time() * 1000)])
+    except RedisError:
+        return 0
+    return 0 if allowed else max(math.ceil(wait / 1000), 1)
+
+
+def too_many_requests(wait):
+    ''' Ответ 429 с заголовком Retry-After (сек). '''
+    response = HttpResponse('Слишком много запросов. Повторите через {} сек.'.format(wait), status=429)
+    response['Retry-After'] = str(wait)
+    return response
+
+
+def ratelimit(scope, methods=None):
+    ''' Декоратор представления: ограничение частоты запросов клиента по лимиту RATE_LIMITS[scope].
+        Аргументы:
+        scope   (str)   -- область лимита
+        methods (tuple) -- ограничиваемые методы запроса (None - все)
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if methods is None or request.method in methods:
+                wait = hit(scope, request)
+                if wait:
+                    return too_many_requests(wait)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RedisRateThrottle(BaseThrottle):
+    ''' Ограничение частоты запросов DRF по корзине Redis: область - атрибут throttle_scope представления
+        (по умолчанию 'api'). DRF отвечает 429 с Retry-After.
+    '''
+    def allow_request(self, request, view):
+        self.retry_after = hit(getattr(view, 'throttle_scope', 'api'), request)
+        return not self.retry_after
+
+    def wait(self):
+        return self.retry_after
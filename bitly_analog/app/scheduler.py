@@ -0,0 +1,221 @@
+# ----- Планировщик периодических задач с выбором ведущего процесса через Redis
+
+import json, random, threading
+from datetime import timedelta
+from time import monotonic
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+from redis.exceptions import LockError, RedisError
+
+from .common import logger
+from .models import Log
+
+
+# ----- Глобальные переменные
+SCHEDULER_JOBS = getattr(settings, 'SCHEDULER_JOBS', [])                                # описания задач: name, task, cron, jitter
+SCHEDULER_TICK = getattr(settings, 'SCHEDULER_TICK', 10)                                # период проверки расписания (сек)
+LEADER_KEY = 'scheduler:leader'                                                         # ключ блокировки ведущего планировщика
+RUN_KEY = 'scheduler:run:{}:{}'                                                         # ключ запуска задачи в слоте расписания
+HISTORY_KEY = 'scheduler:history:{}'                                                    # ключ метрик запусков задачи (hash)
+RECENT_KEY = 'scheduler:recent:{}'                                                      # ключ последних запусков задачи (list)
+RECENT_SIZE = 50                                                                        # число хранимых последних запусков
+
+
+class CronSchedule:
+    ''' Расписание в формате cron: "минута час день месяц день_недели" (*, */n, a-b, a,b; воскресенье - 0).
+        Аргументы:
+        expr (str) -- выражение расписания
+    '''
+    BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('Ожидается 5 полей расписания cron: ' + expr)
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self.parse(field, *bounds) for field, bounds in zip(fields, self.BOUNDS))
+        self.any_day, self.any_weekday = fields[2] == '*', fields[4] == '*'
+
+    @staticmethod
+    def parse(field, low, high):
+        ''' Возвращает множество значений поля расписания. '''
+        values = set()
+        for part in field.split(','):
+            rng, _, step = part.partition('/')
+            if rng == '*':
+                start, end = low, high
+            else:
+                start, _, end = rng.partition('-')
+                start = int(start)
+                end = int(end) if end else (high if step else start)
+            if not low <= start <= end <= high:
+                raise ValueError('Значение вне диапазона {}-{}: {}'.format(low, high, part))
+            values.update(range(start, end + 1, int(step or 1)))
+        return values
+
+    def match(self, moment):
+        ''' Проверка совпадения момента (с точностью до минуты) с расписанием. '''
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        day_ok = day and weekday if self.any_day or self.any_weekday else day or weekday   # правило cron для дня
+        return moment.minute in self.minutes and moment.hour in self.hours and moment.month in self.months and day_ok
+
+    def next_after(self, moment):
+        ''' Возвращает ближайший момент расписания строго после moment. '''
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(366 * 24 * 60):
+            if self.match(moment):
+                return moment
+            moment += timedelta(minutes=1)
+        raise ValueError('Расписание не срабатывает в течение года: ' + self.expr)
+
+
+class Job:
+    ''' Периодическая задача планировщика.
+        Аргументы:
+        name   (str)      -- имя задачи
+        task   (callable) -- функция задачи без аргументов
+        cron   (str)      -- расписание в формате cron
+        jitter (int)      -- случайная задержка запуска (сек) для разнесения нагрузки
+    '''
+    def __init__(self, name, task, cron, jitter=0):
+        self.name = name
+        self.task = task
+        self.schedule = CronSchedule(cron)
+        self.jitter = jitter
+        self.slot = None                                                                # момент расписания текущего запуска
+        self.due = None                                                                 # момент запуска с учётом задержки
+
+    def plan(self, now):
+        ''' Расчёт следующего запуска после момента now. '''
+        self.slot = self.schedule.next_after(now)
+        self.due = self.slot + timedelta(seconds=random.uniform(0, self.jitter))
+
+
+def load_jobs(config=None):
+    ''' Возвращает список задач Job по описаниям из настройки SCHEDULER_JOBS. '''
+    return [Job(item['name'], import_string(item['task']), item['cron'], item.get('jitter', 0))
+            for item in (SCHEDULER_JOBS if config is None else config)]
+
+
+def record_run(name, started_at, duration, status):
+    ''' Запись метрик запуска задачи в Redis одним конвейером.
+        Аргументы:
+        name       (str)      -- имя задачи
+        started_at (datetime) -- время запуска
+        duration   (float)    -- длительность (сек)
+        status     (str)      -- результат: 'ok' / 'error'
+    '''
+    run = {'started_at': started_at.isoformat(), 'duration': round(duration, 3), 'status': status}
+    history, recent = cache.make_key(HISTORY_KEY.format(name)), cache.make_key(RECENT_KEY.format(name))
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    pipe.hset(history, mapping={'last_' + key: value for key, value in run.items()})
+    pipe.hincrby(history, 'runs', 1)
+    if status != 'ok':
+        pipe.hincrby(history, 'failures', 1)
+    pipe.lpush(recent, json.dumps(run))
+    pipe.ltrim(recent, 0, RECENT_SIZE - 1)
+    pipe.execute()
+
+
+def run_history(name):
+    ''' Возвращает метрики запусков задачи: словарь счётчиков и последних значений, список последних запусков. '''
+    conn = get_redis_connection('default')
+    history = {key.decode(): value.decode() for key, value in conn.hgetall(cache.make_key(HISTORY_KEY.format(name))).items()}
+    recent = [json.loads(item) for item in conn.lrange(cache.make_key(RECENT_KEY.format(name)), 0, -1)]
+    return history, recent
+
+
+class Scheduler:
+    ''' Планировщик задач. Может быть запущен в нескольких процессах (manage.py run_scheduler):
+        задачи выполняет только ведущий процесс, удерживающий блокировку в Redis,
+        а каждый слот расписания запускается не более одного раза на кластер.
+        Аргументы:
+        jobs (list)  -- задачи Job
+        tick (float) -- период проверки расписания (сек)
+    '''
+    def __init__(self, jobs, tick=SCHEDULER_TICK):
+        self.jobs = jobs
+        self.tick = tick
+        self.leader = get_redis_connection('default').lock(cache.make_key(LEADER_KEY), timeout=max(tick * 3, 1),
+                                                           thread_local=False)        # продление из потока keep_leader
+        self._stop = threading.Event()
+
+    def is_leader(self):
+        ''' Захват или продление блокировки ведущего. Возвращает Boolean. '''
+        try:
+            if self.leader.owned():
+                self.leader.reacquire()                                                 # продление срока блокировки
+                return True
+            return self.leader.acquire(blocking=False)
+        except (LockError, RedisError):
+            return False
+
+    def keep_leader(self, done):
+        ''' Продление блокировки ведущего каждые tick секунд, пока выполняется задача (цикл фонового потока).
+            Аргументы:
+            done (Event) -- событие завершения задачи
+        '''
+        while not done.wait(self.tick):
+            try:
+                self.leader.reacquire()
+            except (LockError, RedisError):                                             # блокировка потеряна: следующие задачи
+                return                                                                  # не запускаются (см. run_pending)
+
+    def run_job(self, job):
+        ''' Запуск задачи в её слоте расписания, если слот не был запущен другим процессом. Возвращает Boolean. '''
+        slot = job.slot
+        job.plan(max(timezone.localtime(), slot))
+        if not cache.add(RUN_KEY.format(job.name, slot.isoformat()), 1, timeout=24 * 60 * 60):
+            return False
+        started_at, start, status = timezone.localtime(), monotonic(), 'ok'
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self.keep_leader, args=(done,), name='scheduler-heartbeat', daemon=True)
+        heartbeat.start()                                                               # задача может идти дольше срока блокировки
+        try:
+            job.task()
+        except Exception as error:                                                      # сбой задачи не останавливает планировщик
+            status = 'error'
+            logger(None, Log.TASK_FAILED, task=job.name, error=repr(error)[:200])
+        finally:
+            done.set()
+            heartbeat.join()
+        record_run(job.name, started_at, monotonic() - start, status)
+        return True
+
+    def run_pending(self):
+        ''' Запуск задач с наступившим временем (только в ведущем процессе). Возвращает число запусков. '''
+        if not self.is_leader():
+            return 0
+        now = timezone.localtime()
+        count = 0
+        for job in self.jobs:
+            if job.due > now:
+                continue
+            if count and not self.is_leader():                                          # роль ведущего потеряна во время задачи
+                break
+            count += self.run_job(job)
+        return count
+
+    def run(self):
+        ''' Цикл планировщика до вызова stop(). '''
+        now = timezone.localtime()
+        for job in self.jobs:
+            job.plan(now)
+        try:
+            while not self._stop.is_set():
+                self.run_pending()
+                self._stop.wait(self.tick)
+        finally:
+            try:
+                self.leader.release()                                                   # передача роли ведущего без ожидания TTL
+            except (LockError, RedisError):
+                pass
+
+    def stop(self):
+        ''' Мягкая остановка: текущая задача завершается, новые не запускаются. '''
+        self._stop.set()
@@ -1,8 +1,43 @@
 from rest_framework import serializers
-from .models import Url
+from rest_framework.reverse import reverse
+from .models import Url, ClickStat
+
+# поля выборки values() для быстрой сериализации списка правил
+URL_VALUES = ('id', 'link', 'alias', 'subpart', 'expire_date', 'str_limit', 'owner__session_id', 'redirect_status', 'clicks')
+
 
 class UrlSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Url
-        fields = '__all__'
-    owner = serializers.ReadOnlyField(source='owner.session.session_key')
+        exclude = ('link_hash',)
+    # ключ сессии - первичный ключ Session, хранится в owner.session_id: без запроса к таблице сессий
+    owner = serializers.ReadOnlyField(source='owner.session_id')
+    # число переходов из ClickStat (в списке - аннотация выборки, см. app.clicks.total_clicks)
+    clicks = serializers.SerializerMethodField()
+
+    def get_clicks(self, obj):
+        clicks = getattr(obj, 'clicks', None)
+        if clicks is None:
+            clicks = ClickStat.objects.filter(url=obj, kind=ClickStat.TOTAL).values_list('clicks', flat=True).first()
+        return clicks or 0
+
+
+def serialize_values(rows, request):
+    ''' Быстрая сериализация строк values(URL_VALUES) в словари формата UrlSerializer без объектов моделей.
+        Аргументы:
+        rows    (iterable)    -- строки выборки
+        request (HttpRequest) -- объект HTTP-запроса для абсолютных ссылок
+    '''
+    detail = reverse('url-detail', args=[0], request=request)                          # ссылка правила с id=0
+    prefix, suffix = detail.rsplit('0', 1)
+    return [{
+        'url': '{}{}{}'.format(prefix, row['id'], suffix),
+        'owner': row['owner__session_id'],
+        'link': row['link'],
+        'alias': row['alias'],
+        'subpart': row['subpart'],
+        'expire_date': row['expire_date'].isoformat(),
+        'str_limit': row['str_limit'],
+        'redirect_status': row['redirect_status'],
+        'clicks': row['clicks'],
+    } for row in rows]
@@ -0,0 +1,36 @@
+# ----- Обработчики сигналов моделей
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Url
+from .common import drop_link, cache_link, invalidate_rules
+from .bloom import subpart_filter
+from .clicks import move_clicks
+
+
+@receiver(post_save, sender=Url)
+def url_saved(sender, instance, created, **kwargs):
+    ''' Запись маппинга созданного/изменённого правила в кэш. Заменяет негативную запись для этого субдомена.
+        Маппинг прежнего субдомена изменённого правила удаляется (его несброшенные переходы переносятся на новый),
+        L1-кэши процессов сбрасываются после записи в Redis.
+        Новый субдомен (созданного правила либо изменённый) добавляется в фильтр занятых субдоменов.
+    '''
+    old = getattr(instance, '_saved_subpart', None)
+    changed = old != instance.subpart                                                   # новое правило либо изменённый субдомен
+    cache_link(instance.subpart, instance.link, instance.expire_date, instance.redirect_status)
+    if old and changed:
+        move_clicks(old, instance.subpart)                                              # несброшенные переходы - за правилом
+        drop_link(old)
+    drop_link(instance.subpart, shared=False)
+    instance._saved_subpart = instance.subpart
+    invalidate_rules(instance.owner_id)                                                 # список правил пользователя изменился
+    if created or changed:
+        subpart_filter.add(instance.subpart)
+
+
+@receiver(post_delete, sender=Url)
+def url_deleted(sender, instance, **kwargs):
+    ''' Сброс закэшированного маппинга и списка правил пользователя при удалении правила. '''
+    drop_link(instance.subpart)
+    invalidate_rules(instance.owner_id)
@@ -92,7 +92,7 @@ function let_short(event) {
                     }
                 })
         } else {
-            errors.innerHTML = 'Установите имя субдомена!';
+            errors.innerHTML = '<span style="color: green;">Субдомен будет сгенерирован автоматически.</span>';
         }
     }
 
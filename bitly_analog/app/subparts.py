@@ -0,0 +1,113 @@
+# ----- Генерация субдоменов и пул свободных субдоменов
+
+import secrets, string, threading
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django_redis import get_redis_connection
+
+from .models import Url
+from .cache_fill import release
+
+
+# ----- Глобальные переменные
+ALPHABET = string.digits + string.ascii_letters                                         # алфавит base62
+SUBPART_LENGTH = getattr(settings, 'SUBPART_LENGTH', 7)                                 # длина генерируемого субдомена
+SUBPART_POOL_SIZE = getattr(settings, 'SUBPART_POOL_SIZE', 1000)                        # размер пула свободных субдоменов
+SUBPART_POOL_LOW = getattr(settings, 'SUBPART_POOL_LOW', SUBPART_POOL_SIZE // 4)        # порог запуска пополнения пула
+SUBPART_POOL_KEY = 'subparts:pool'                                                      # ключ списка свободных субдоменов в Redis
+SUBPART_POOL_LOCK = 'subparts:pool:lock'                                                # ключ блокировки пополнения пула
+SUBPART_POOL_LOCK_TTL = 60                                                              # предел удержания блокировки (сек)
+SUBPART_POOL_BATCH = 500                                                                # число субдоменов в одном запросе проверки к БД
+refill_running = threading.Lock()                                                       # не больше одного фонового пополнения в процессе
+
+
+def generate_subpart(length=SUBPART_LENGTH):
+    ''' Возвращает случайный субдомен из символов base62.
+        Аргументы:
+        length (int) -- длина субдомена
+    '''
+    return ''.join(secrets.choice(ALPHABET) for _ in range(length))
+
+
+def refill_subpart_pool():
+    ''' Пополнение пула до SUBPART_POOL_SIZE субдоменами, проверенными по БД пачками.
+        Выполняется одним процессом кластера (блокировка в Redis). Возвращает число добавленных субдоменов.
+    '''
+    conn = get_redis_connection('default')
+    lock = conn.lock(cache.make_key(SUBPART_POOL_LOCK), timeout=SUBPART_POOL_LOCK_TTL)  # снимается только владельцем
+    if not lock.acquire(blocking=False):                                                # пул уже пополняет другой поток/процесс
+        return 0
+    try:
+        key = cache.make_key(SUBPART_POOL_KEY)
+        added = 0
+        missing = SUBPART_POOL_SIZE - conn.llen(key)
+        while added < missing:
+            batch = {generate_subpart() for _ in range(min(SUBPART_POOL_BATCH, missing - added))}
+            batch -= set(Url.objects.filter(subpart__in=batch).values_list('subpart', flat=True))
+            if batch:
+                conn.rpush(key, *batch)
+                added += len(batch)
+        return added
+    finally:
+        release(lock)
+
+
+def refill_in_thread():
+    ''' Пополнение пула в фоновом потоке с закрытием соединения потока с БД и снятием отметки пополнения. '''
+    try:
+        refill_subpart_pool()
+    finally:
+        connection.close()
+        refill_running.release()
+
+
+def start_refill():
+    ''' Запуск фонового пополнения пула, если пополнение в процессе ещё не выполняется. '''
+    if not refill_running.acquire(blocking=False):
+        return
+    try:
+        threading.Thread(target=refill_in_thread, name='refill_subpart_pool', daemon=True).start()
+    except RuntimeError:                                                                # поток не запущен - пополнит следующий вызов
+        refill_running.release()
+
+
+def pop_subpart():
+    ''' Возвращает свободный субдомен из пула одним запросом к Redis (LPOP + LLEN в конвейере).
+        При опустошении пула ниже порога запускает его пополнение в фоновом потоке (одном на процесс),
+        при пустом пуле возвращает сгенерированный субдомен без проверки (её выполняет уникальный индекс).
+    '''
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    key = cache.make_key(SUBPART_POOL_KEY)
+    pipe.lpop(key)
+    pipe.llen(key)
+    subpart, left = pipe.execute()
+    if left < SUBPART_POOL_LOW:
+        start_refill()
+    return subpart.decode() if subpart else generate_subpart()
+
+
+def pop_subparts(count):
+    ''' Возвращает count свободных субдоменов из пула одним запросом LPOP с числом элементов (Redis 6.2+),
+        недостающие генерируются без проверки. Пополнение пула - как в pop_subpart.
+        Аргументы:
+        count (int) -- число субдоменов
+    '''
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    key = cache.make_key(SUBPART_POOL_KEY)
+    pipe.lpop(key, count)
+    pipe.llen(key)
+    subparts, left = pipe.execute()
+    if left < SUBPART_POOL_LOW:
+        start_refill()
+    subparts = [subpart.decode() for subpart in subparts or ()]
+    return subparts + [generate_subpart() for _ in range(count - len(subparts))]
+
+
+def renew_subpart(url):
+    ''' Замена занятого субдомена правила на новый сгенерированный (для повторной записи в common.save_rule).
+        Аргументы:
+        url (Url) -- объект правила
+    '''
+    url.subpart = generate_subpart()
+    url.alias = '{}/{}'.format(url.alias.rsplit('/', 1)[0], url.subpart)
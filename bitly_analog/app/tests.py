@@ -3,8 +3,40 @@ This file demonstrates writing tests using the unittest module. These will pass
 when you run "manage.py test".
 """
 
-import django
-from django.test import TestCase
+import django, gzip, json, os, tempfile, threading
+from asgiref.sync import async_to_sync
+from datetime import timedelta
+from io import StringIO
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection
+from django.http import Http404, HttpRequest
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework.request import Request
+from unittest import mock
+
+from app.benchmark import compare, measure
+from app.bloom import subpart_filter
+from app.cache_fill import early_refresh, fill_lock, single_flight
+from app.clicks import flush_clicks
+from app.common import LINK_DROPS_CHANNEL, RULES_PAGE_KEY, aredirect_subpart, caching, get_link, is_subpart_exists, \
+    link_target, local_links, redirect_key, rules_version, save_rule
+from app.export import export_rows
+from app.forms import SUBPART_DUPLICATE
+from app.log_buffer import LogBuffer, log_buffer
+from app.log_retention import clean_logs, expire_logs
+from app.metrics import registry
+from app.models import ClickStat, Collection, Log, Owner, Session, Url
+from app.pagination import KeysetPagination
+from app.periodic_tasks import delete_expired_urls
+from app.scheduler import CronSchedule, Job, Scheduler, run_history
+from app.warmup import WARMUP_LOCK, reconcile_links, warm_links, warm_once
+from app.subparts import SUBPART_LENGTH, SUBPART_POOL_LOCK, SUBPART_POOL_SIZE, pop_subpart, pop_subparts, refill_running, \
+    refill_subpart_pool
 
 # TODO: Configure your database in settings.py and sync before running tests.
 
@@ -32,3 +64,801 @@ class ViewTest(TestCase):
         """Tests the about page."""
         response = self.client.get('/about')
         self.assertContains(response, 'About', 3, 200)
+
+
+class RuleTestCase(TestCase):
+    """Base case with an owner and one live rule."""
+
+    @staticmethod
+    def create_owner():
+        store = SessionStore()
+        store.create()
+        return Owner.objects.create(session=Session.objects.get(session_key=store.session_key))
+
+    def setUp(self):
+        cache.clear()
+        local_links.clear()
+        for patcher in (mock.patch.object(log_buffer, 'maxsize', 0),   # write logs inside the test transaction
+                        mock.patch('app.subparts.SUBPART_POOL_LOW', 0)):  # no background refill threads
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.owner = self.create_owner()
+        self.url = Url.objects.create(link='https://example.com/long', alias='host/abc', subpart='abc',
+                                      expire_date=timezone.localdate() + timedelta(days=2), owner=self.owner)
+
+
+class RedirectTest(RuleTestCase):
+    """Tests for the short link redirect."""
+
+    def test_redirect_caches_link(self):
+        """Tests that the first click fills the cache and the next one skips the DB."""
+        response = self.client.get('/abc')
+        self.assertRedirects(response, 'https://example.com/long', fetch_redirect_response=False)
+        self.assertEqual(cache.get(redirect_key('abc'))[0], 'https://example.com/long')
+        with self.assertNumQueries(0):
+            response = self.client.get('/abc')
+        self.assertEqual(response.status_code, 302)
+
+    def test_redirect_unknown(self):
+        """Tests that unknown and expired subparts are not redirected."""
+        self.assertEqual(self.client.get('/missing').status_code, 404)
+        self.url.expire_date = timezone.localdate()
+        self.url.save()
+        self.assertEqual(self.client.get('/abc').status_code, 404)
+
+    def test_local_cache(self):
+        """Tests that hot links are served from process memory and dropped when the rule is deleted."""
+        self.client.get('/abc')
+        cache.delete(redirect_key('abc'))
+        self.assertEqual(self.client.get('/abc').status_code, 302)
+        self.url.delete()
+        self.assertIsNone(cache.get(redirect_key('abc')))
+        self.assertEqual(self.client.get('/abc').status_code, 404)
+
+    def test_subpart_change(self):
+        """Tests that renaming a rule's subpart drops the old mapping from Redis and L1."""
+        self.client.get('/abc')
+        rule = Url.objects.get(pk=self.url.pk)
+        rule.subpart = 'renamed'
+        rule.save()
+        self.assertIsNone(cache.get(redirect_key('abc')))
+        self.assertEqual(self.client.get('/abc').status_code, 404)
+        self.assertEqual(self.client.get('/renamed').status_code, 302)
+
+    def test_drop_message(self):
+        """Tests that a drop published by another process clears the mapping from this process's L1."""
+        self.client.get('/abc')
+        self.assertIsNotNone(local_links.get('abc'))
+        get_redis_connection('default').publish(cache.make_key(LINK_DROPS_CHANNEL),
+                                                json.dumps({'from': 'other', 'subparts': ['abc']}))
+        for _ in range(100):
+            if local_links.get('abc') is None:
+                break
+            threading.Event().wait(0.01)
+        self.assertIsNone(local_links.get('abc'))
+
+    def test_status_and_cache_control(self):
+        """Tests the default and per-rule status with max-age capped by the rule lifetime."""
+        with mock.patch('app.common.REDIRECT_MAX_AGE', 10 ** 6):
+            response = self.client.get('/abc')
+            self.assertEqual(response.status_code, 302)
+            max_age = int(response['Cache-Control'].split('max-age=')[1])
+            self.assertTrue(86400 < max_age <= 2 * 86400)
+            self.url.redirect_status = 301
+            self.url.save()
+            self.assertEqual(self.client.get('/abc').status_code, 301)
+        with mock.patch('app.common.REDIRECT_MAX_AGE', 0):
+            self.assertIn('no-store', self.client.get('/abc')['Cache-Control'])
+
+    def test_negative_cache(self):
+        """Tests that a miss is remembered and cleared once a rule with the subpart is created."""
+        self.assertEqual(self.client.get('/new').status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/new').status_code, 404)
+        Url.objects.create(link='https://example.com/new', alias='host/new', subpart='new',
+                           expire_date=self.url.expire_date, owner=self.owner)
+        self.assertEqual(self.client.get('/new').status_code, 302)
+
+
+class ClickStatsTest(RuleTestCase):
+    """Tests for the buffered click counters."""
+
+    def stats(self):
+        return {(row.kind, row.key): row.clicks for row in ClickStat.objects.filter(url=self.url)}
+
+    def test_count_and_flush(self):
+        """Tests that clicks are counted in Redis and added to the stats table by each flush."""
+        self.client.get('/abc', HTTP_USER_AGENT='Mozilla/5.0 (iPhone)', HTTP_REFERER='https://t.me/chat')
+        self.client.get('/abc')                                            # served from process memory
+        self.client.get('/missing')
+        self.assertFalse(ClickStat.objects.exists())
+        self.assertEqual(flush_clicks(), 2)
+        self.client.get('/abc')
+        self.assertEqual(flush_clicks(), 1)
+        self.assertEqual(flush_clicks(), 0)
+        day = timezone.localdate().isoformat()
+        self.assertEqual(self.stats(), {
+            ('total', ''): 3, ('day', day): 3, ('referrer', 't.me'): 1, ('referrer', 'direct'): 2,
+            ('agent', 'mobile'): 1, ('agent', 'unknown'): 2,
+        })
+        self.assertEqual(self.client.get('/urls/').json()['results'][0]['clicks'], 3)
+
+    def test_deleted_and_renamed_rules(self):
+        """Tests that pending clicks follow a renamed rule and are dropped with a deleted one."""
+        self.client.get('/abc')
+        rule = Url.objects.get(pk=self.url.pk)
+        rule.subpart = 'renamed'
+        rule.save()
+        self.client.get('/renamed')
+        other = Url.objects.create(link='https://example.com/other', alias='host/gone', subpart='gone',
+                                   expire_date=self.url.expire_date, owner=self.owner)
+        self.client.get('/gone')
+        other.delete()
+        Url.objects.create(link='https://example.com/reused', alias='host/gone', subpart='gone',
+                           expire_date=self.url.expire_date, owner=self.owner)
+        self.assertEqual(flush_clicks(), 2)
+        self.assertEqual(self.stats()[('total', '')], 2)
+        self.assertFalse(ClickStat.objects.exclude(url=self.url).exists())
+
+    def test_stats_endpoint(self):
+        """Tests that the API returns the flushed counters grouped by kind."""
+        self.client.get('/abc', HTTP_REFERER='https://t.me/chat')
+        self.client.get('/abc')
+        flush_clicks()
+        response = self.client.get('/urls/{}/stats/'.format(self.url.id))
+        self.assertEqual(response.json(), {
+            'id': self.url.id, 'total': 2, 'day': {timezone.localdate().isoformat(): 2},
+            'referrer': {'t.me': 1, 'direct': 1}, 'agent': {'unknown': 2},
+        })
+        self.assertEqual(self.client.get('/urls/0/stats/').status_code, 404)
+
+
+class SessionTest(RuleTestCase):
+    """Tests for the session-less routes and the session-cached owner."""
+
+    def test_sessionless_routes(self):
+        """Tests that redirects and API reads neither load nor save the session."""
+        self.client.get('/')
+        get_link('abc')
+        for path in ('/abc', '/urls_list/', '/ajax_check_subpart/abc/'):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path)
+            self.assertFalse([query for query in queries if 'django_session' in query['sql']])
+            self.assertNotIn('sessionid', response.cookies)
+
+    def test_owner_from_session(self):
+        """Tests that a returning visitor is resolved without owner or session queries."""
+        self.client.get('/')
+        owner = Owner.objects.get(session_id=self.client.session.session_key)
+        with mock.patch('app.common.Owner.objects.get_or_create') as get_or_create:
+            response = self.client.get('/')
+        get_or_create.assert_not_called()
+        self.assertNotIn('sessionid', response.cookies)              # renewed at most once a day
+        self.assertEqual(response.context['page_obj'].count, 0)
+        self.assertEqual(Owner.objects.get(session_id=owner.session_id), owner)
+
+
+class RateLimitTest(RuleTestCase):
+    """Tests for the Redis token bucket limiter."""
+
+    @mock.patch.dict('app.ratelimit.RATE_LIMITS', {'check': '2/m', 'api': '1/h', 'create': '1/m'})
+    def test_limits(self):
+        """Tests that views and the API answer 429 with Retry-After once the bucket is empty."""
+        for _ in range(2):
+            self.assertEqual(self.client.get('/ajax_check_subpart/abc/').status_code, 200)
+        response = self.client.get('/ajax_check_subpart/abc/')
+        self.assertEqual((response.status_code, response['Retry-After']), (429, '30'))
+        self.assertEqual(self.client.get('/urls/').status_code, 200)
+        response = self.client.get('/urls/')
+        self.assertEqual((response.status_code, response['Retry-After']), (429, '3600'))
+        self.assertEqual(self.client.get('/').status_code, 200)                 # reads are not limited
+        self.client.post('/', {'link': 'https://example.com/1', 'domain': 'host', 'subpart': 'x1'})
+        response = self.client.post('/', {'link': 'https://example.com/2', 'domain': 'host', 'subpart': 'x2'})
+        self.assertEqual(response.status_code, 429)
+        other = self.client.get('/ajax_check_subpart/abc/', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(other.status_code, 200)
+
+
+class SubpartFilterTest(RuleTestCase):
+    """Tests for the subpart Bloom filter."""
+
+    def test_without_filter(self):
+        """Tests that a missing filter falls through to the DB."""
+        with self.assertNumQueries(1):
+            self.assertTrue(is_subpart_exists(None, 'abc'))
+
+    def test_rebuild(self):
+        """Tests that free subparts are answered without a query after a rebuild."""
+        call_command('rebuild_subpart_filter', stdout=StringIO())
+        with self.assertNumQueries(0):
+            self.assertFalse(is_subpart_exists(None, 'free'))
+        self.assertTrue(is_subpart_exists(None, 'abc'))
+        Url.objects.create(link='https://example.com/new', alias='host/new', subpart='new',
+                           expire_date=self.url.expire_date, owner=self.owner)
+        self.assertTrue(subpart_filter.might_contain('new'))
+
+    def test_subpart_change(self):
+        """Tests that a rule's changed subpart is added to the filter."""
+        call_command('rebuild_subpart_filter', stdout=StringIO())
+        rule = Url.objects.get(pk=self.url.pk)
+        rule.subpart = 'renamed'
+        rule.save()
+        self.assertTrue(subpart_filter.might_contain('renamed'))
+        self.assertTrue(is_subpart_exists(None, 'renamed'))
+
+
+class CreateRuleTest(RuleTestCase):
+    """Tests for rule creation from the home page form."""
+
+    def post(self, subpart):
+        return self.client.post('/', {'link': 'https://example.com/other', 'domain': 'host', 'subpart': subpart,
+                                      'expire_date': self.url.expire_date.strftime('%d.%m.%Y')})
+
+    def test_create(self):
+        """Tests that a free subpart is saved together with its collection entry."""
+        response = self.post('free')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Url.objects.get(subpart='free').alias, 'host/free')
+
+    def test_duplicate_subpart(self):
+        """Tests that a taken subpart is reported by the unique index instead of a pre-check."""
+        response = self.post('abc')
+        self.assertContains(response, SUBPART_DUPLICATE)
+        self.assertEqual(Url.objects.filter(subpart='abc').count(), 1)
+
+    def test_other_integrity_error(self):
+        """Tests that an integrity error with a free subpart is raised instead of retried as a taken one."""
+        url = Url(link='https://example.com/fk', alias='host/free', subpart='free', expire_date=self.url.expire_date,
+                  owner=self.owner)
+        renew = mock.Mock()
+        with mock.patch.object(Url, 'save', side_effect=IntegrityError('FOREIGN KEY constraint failed')):
+            with self.assertRaises(IntegrityError):
+                save_rule(url, renew)
+        renew.assert_not_called()
+        url.subpart = 'abc'
+        self.assertFalse(save_rule(url))
+
+    def test_generated_subpart(self):
+        """Tests that an empty subpart is taken from the pool of free codes."""
+        self.assertEqual(refill_subpart_pool(), SUBPART_POOL_SIZE)
+        self.post('')
+        url = Url.objects.exclude(id=self.url.id).get()
+        self.assertEqual(len(url.subpart), SUBPART_LENGTH)
+        self.assertEqual(url.alias, 'host/' + url.subpart)
+        self.assertEqual(refill_subpart_pool(), 1)
+
+    def test_refill_lock_owner(self):
+        """Tests that a refill neither runs under nor removes another process's pool lock."""
+        lock = get_redis_connection('default').lock(cache.make_key(SUBPART_POOL_LOCK), timeout=60)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertEqual(refill_subpart_pool(), 0)
+        self.assertTrue(lock.owned())
+        lock.release()
+
+    def test_single_refill_thread(self):
+        """Tests that a drained pool starts at most one background refill per process."""
+        with mock.patch('app.subparts.SUBPART_POOL_LOW', 10), mock.patch('app.subparts.threading.Thread') as thread, \
+                mock.patch('app.subparts.refill_subpart_pool') as refill, mock.patch('app.subparts.connection') as db:
+            pop_subpart()
+            pop_subparts(3)
+            self.assertEqual(thread.call_count, 1)
+            thread.call_args.kwargs['target']()                   # run the refill: it closes the connection and clears the flag
+            self.assertEqual((refill.call_count, db.close.call_count), (1, 1))
+            pop_subpart()
+            self.assertEqual(thread.call_count, 2)
+        refill_running.release()
+
+    def test_deduplicate_link(self):
+        """Tests that shortening the same link again returns the owner's live rule."""
+        self.post('')
+        self.post('')
+        url = Url.objects.exclude(id=self.url.id).get()
+        self.assertEqual(url.link_hash, Url.digest('HTTPS://Example.com:443/other'))
+        results = self.client.post('/urls/bulk/', [{'link': 'https://EXAMPLE.com/other'}, {'link': 'https://example.com/x'},
+                                                   {'link': 'https://example.com/x'}], content_type='application/json').json()['results']
+        self.assertEqual((results[0]['id'], results[0]['existing']), (url.id, True))
+        self.assertEqual((results[2]['id'], results[2]['existing']), (results[1]['id'], False))
+        self.assertEqual(Url.objects.count(), 3)
+        self.assertEqual(Log.objects.filter(event=Log.RULES_BULK_CREATED).get().payload['created'], 1)
+        response = self.client.post('/urls/bulk/', [{'link': 'https://example.com/x'}], content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['results'][0]['existing']), (200, True))
+        self.assertEqual(Log.objects.filter(event=Log.RULES_BULK_CREATED).count(), 1)
+        with mock.patch('app.views.DEDUPLICATE_LINKS', False):
+            self.post('')
+        self.assertEqual(Url.objects.count(), 4)
+
+    def test_deduplicate_extends_rule(self):
+        """Tests that a bulk dedup hit extends the live rule to a later date, as the form does."""
+        def bulk(expire_date):
+            return self.client.post('/urls/bulk/', [{'link': 'https://example.com/x', 'expire_date': expire_date.isoformat()}],
+                                    content_type='application/json').json()['results'][0]
+        first = bulk(self.url.expire_date)
+        later = self.url.expire_date + timedelta(days=5)
+        result = bulk(later)
+        self.assertEqual((result['id'], result['existing'], result['expire_date']), (first['id'], True, later.isoformat()))
+        self.assertEqual(Url.objects.get(pk=first['id']).expire_date, later)
+        self.assertEqual(cache.get(redirect_key(first['subpart'])), link_target('https://example.com/x', later))
+
+
+class BulkCreateTest(RuleTestCase):
+    """Tests for the bulk shortening endpoint."""
+
+    def test_json_array(self):
+        """Tests that valid items are created in bulk, cached and reported per item."""
+        items = [
+            {'link': 'https://example.com/1', 'subpart': 'one'},
+            {'link': 'https://example.com/2'},
+            {'link': 'https://example.com/3', 'subpart': 'abc'},
+            {'link': 'not a link', 'expire_date': '2000-01-01'},
+            {'link': 'https://example.com/5', 'subpart': 'one'},
+        ]
+        response = self.client.post('/urls/bulk/', items, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        results = response.json()['results']
+        self.assertEqual([sorted(result.get('errors', {})) for result in results],
+                         [[], [], ['subpart'], ['expire_date', 'link'], ['subpart']])
+        self.assertEqual(results[0]['alias'], 'testserver/one')
+        generated = Url.objects.get(id=results[1]['id'])
+        self.assertEqual(len(generated.subpart), SUBPART_LENGTH)
+        self.assertEqual(Collection.objects.filter(url__subpart__in=['one', generated.subpart]).count(), 2)
+        self.assertEqual(cache.get(redirect_key('one'))[0], 'https://example.com/1')
+        self.assertEqual(self.client.get('/' + generated.subpart)['Location'], 'https://example.com/2')
+
+    def test_ndjson(self):
+        """Tests that an NDJSON stream is processed and bad lines are reported."""
+        body = '\n'.join(['{"link": "https://example.com/%d", "subpart": "n%d"}' % (i, i) for i in range(5)] + ['{'])
+        response = self.client.post('/urls/bulk/', body, content_type='application/x-ndjson')
+        results = response.json()['results']
+        self.assertEqual([result['index'] for result in results], list(range(6)))
+        self.assertEqual(results[-1]['errors'], {'item': ['Ожидается JSON-объект.']})
+        self.assertEqual(Url.objects.filter(subpart__startswith='n').count(), 5)
+
+
+class LogBufferTest(RuleTestCase):
+    """Tests for the buffered log sink."""
+
+    def test_flush_and_drop(self):
+        """Tests that queued entries are written in one batch and overflow is counted, not blocked."""
+        buffer = LogBuffer(maxsize=2, flush_size=100, interval=3600)
+        for i in range(3):
+            buffer.put(Log(owner=self.owner, event=Log.OTHER, payload={'i': i}))
+        self.assertEqual(buffer.dropped, 1)
+        self.assertEqual(Log.objects.count(), 0)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 1)
+        self.assertEqual(Log.objects.count(), 2)
+
+    def test_failed_rows(self):
+        """Tests that a failing row is dropped alone and the rest of the batch is written."""
+        bulk_create = Log.objects.bulk_create
+
+        def checked(entries, **kwargs):
+            if any(entry.payload.get('bad') for entry in entries):
+                raise DatabaseError('FOREIGN KEY constraint failed')
+            return bulk_create(entries, **kwargs)
+
+        buffer = LogBuffer(maxsize=10, flush_size=100, interval=3600)
+        for i in range(5):
+            buffer.put(Log(owner=self.owner, event=Log.OTHER, payload={'i': i, 'bad': i == 3}))
+        with mock.patch.object(Log.objects, 'bulk_create', side_effect=checked):
+            self.assertEqual(buffer.flush(), 4)
+        self.assertEqual((buffer.dropped, Log.objects.count()), (1, 4))
+
+
+class RulesCacheTest(RuleTestCase):
+    """Tests for the per-owner rule list cache."""
+
+    def page(self, owner, **params):
+        request = HttpRequest()
+        request.GET.update(params)
+        return caching(request, owner)
+
+    def test_owner_keys(self):
+        """Tests that owners get their own cached pages."""
+        other = self.create_owner()
+        self.assertEqual(self.page(self.owner)['page_obj'].count, 1)
+        self.assertEqual(self.page(other)['page_obj'].count, 0)
+        with self.assertNumQueries(0):
+            context = self.page(self.owner)
+        self.assertFalse(context['is_db_query'])
+        self.assertEqual(context['page_obj'].object_list[0]['subpart'], 'abc')
+
+    def test_invalidation(self):
+        """Tests that a new rule of the owner invalidates the cached pages."""
+        self.page(self.owner)
+        Url.objects.create(link='https://example.com/new', alias='host/new', subpart='new',
+                           expire_date=self.url.expire_date, owner=self.owner)
+        context = self.page(self.owner)
+        self.assertTrue(context['is_db_query'])
+        self.assertEqual(context['page_obj'].count, 2)
+
+    def test_stale_while_filling(self):
+        """Tests that the previous version is served while another request rebuilds the page."""
+        self.page(self.owner)
+        Url.objects.create(link='https://example.com/new', alias='host/new', subpart='new',
+                           expire_date=self.url.expire_date, owner=self.owner)
+        lock = fill_lock(RULES_PAGE_KEY.format(self.owner.id, rules_version(self.owner.id), '', self.owner.trows_on_page))
+        self.assertTrue(lock.acquire(blocking=False))
+        with self.assertNumQueries(0):
+            context = self.page(self.owner)
+        self.assertEqual((context['is_db_query'], context['page_obj'].count), (False, 1))
+        lock.release()
+        self.assertEqual(self.page(self.owner)['page_obj'].count, 2)
+
+
+class CacheFillTest(RuleTestCase):
+    """Tests for single-flight cache filling."""
+
+    def test_waiter_reads_filled_value(self):
+        """Tests that a request without the lock waits for the value instead of loading it."""
+        lock = fill_lock('k')
+        self.assertTrue(lock.acquire(blocking=False))
+        threading.Timer(0.05, cache.set, ('k', 'filled')).start()
+        load = mock.Mock(return_value='loaded')
+        self.assertEqual(single_flight('k', load, lambda: cache.get('k'), wait=2), 'filled')
+        load.assert_not_called()
+        self.assertEqual(single_flight('x', load, lambda: cache.get('x'), wait=0.05), 'loaded')
+        lock.release()
+
+    def test_redirect_miss_single_flight(self):
+        """Tests that a redirect miss goes to the DB only under the fill lock."""
+        cache.delete(redirect_key('abc'))
+        lock = fill_lock(redirect_key('abc'))
+        self.assertTrue(lock.acquire(blocking=False))
+        threading.Timer(0.05, cache.set, (redirect_key('abc'), ('https://example.com/long', None, 0))).start()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_link('abc')[0], 'https://example.com/long')
+        lock.release()
+
+    def test_early_refresh(self):
+        """Tests that the refresh decision depends on the time left and the load time."""
+        now = timezone.now().timestamp()
+        self.assertTrue(early_refresh(1, now - 1))
+        self.assertFalse(early_refresh(0.001, now + 3600))
+
+
+class WarmupTest(RuleTestCase):
+    """Tests for the redirect cache warm-up and reconciliation."""
+
+    def test_warm_links(self):
+        """Tests that live rules are loaded into an empty cache and expired ones are skipped."""
+        Url.objects.create(link='https://example.com/old', alias='host/old', subpart='old',
+                           expire_date=timezone.localdate(), owner=self.owner)
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(warm_links(), 1)
+        self.assertEqual(cache.get(redirect_key('abc'))[0], 'https://example.com/long')
+        self.assertIsNone(cache.get(redirect_key('old')))
+
+    def test_reconcile(self):
+        """Tests that mappings without a rule are removed and drifted ones are rewritten."""
+        cache.set(redirect_key('gone'), ('https://example.com/gone', None, 0))
+        cache.set(redirect_key('miss'), 0)
+        cache.set(redirect_key('abc'), 0)
+        self.assertEqual(reconcile_links(chunk_size=2), (3, 1, 1))
+        self.assertIsNone(cache.get(redirect_key('gone')))
+        self.assertEqual(cache.get(redirect_key('miss')), 0)
+        self.assertEqual(cache.get(redirect_key('abc'))[0], 'https://example.com/long')
+
+    def test_warm_once_lock(self):
+        """Tests that a warm-up neither runs under nor removes another process's lock."""
+        lock = get_redis_connection('default').lock(cache.make_key(WARMUP_LOCK), timeout=60)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertEqual(warm_once(), 0)
+        self.assertTrue(lock.owned())
+        lock.release()
+        self.assertEqual(warm_once(), 1)
+        self.assertEqual(warm_once(), 0)
+
+    def test_command(self):
+        """Tests the warm_cache command output."""
+        out = StringIO()
+        call_command('warm_cache', stdout=out)
+        self.assertIn('Записано маппингов: 1', out.getvalue())
+
+
+class KeysetPaginationTest(RuleTestCase):
+    """Tests for keyset pagination of the home table and the API."""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(4):
+            Url.objects.create(link='https://example.com/{}'.format(i), alias='host/s{}'.format(i),
+                               subpart='s{}'.format(i), expire_date=self.url.expire_date, owner=self.owner)
+
+    def test_home_pages(self):
+        """Tests that pages follow the (expire_date, id) cursor in both directions."""
+        request = HttpRequest()
+        first = caching(request, self.owner)['page_obj']
+        self.assertEqual((len(first.object_list), first.count, first.has_next), (3, 5, True))
+        request.GET['after'] = first.next_cursor
+        second = caching(request, self.owner)['page_obj']
+        self.assertEqual([row['subpart'] for row in second.object_list], ['s2', 's3'])
+        self.assertFalse(second.has_next)
+        request = HttpRequest()
+        request.GET['before'] = second.previous_cursor
+        self.assertEqual(caching(request, self.owner)['page_obj'].object_list, first.object_list)
+
+    def test_api_pages(self):
+        """Tests that the API returns bounded pages with cursor links."""
+        with mock.patch.object(KeysetPagination, 'page_size', 2):
+            data = self.client.get('/urls_list/').json()
+            self.assertEqual((data['count'], len(data['results']), data['previous']), (5, 2, None))
+            data = self.client.get(data['next']).json()
+            self.assertEqual([row['subpart'] for row in data['results']], ['s1', 's2'])
+
+    def test_filtered_count(self):
+        """Tests that the cached count of a filtered queryset is kept apart from the full one."""
+        request = Request(RequestFactory().get('/urls/'))
+        paginator = KeysetPagination()
+        queryset = Url.objects.order_by('expire_date', 'id')
+        paginator.paginate_queryset(queryset, request)
+        self.assertEqual(paginator.page.count, 5)
+        paginator.paginate_queryset(queryset.filter(subpart__startswith='s'), request)
+        self.assertEqual(paginator.page.count, 4)
+
+
+class ApiQueriesTest(RuleTestCase):
+    """Query-count regression tests for the API."""
+
+    def assertConstantQueries(self, path):
+        with self.assertNumQueries(2):   # page + total count
+            self.assertEqual(len(self.client.get(path).json()['results']), 1)
+        for i in range(10):
+            Url.objects.create(link='https://example.com/{}'.format(i), alias='host/s{}'.format(i),
+                               subpart='s{}'.format(i), expire_date=self.url.expire_date, owner=self.create_owner())
+        cache.clear()
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.client.get(path).json()['results']), 11)
+
+    def test_list_queries(self):
+        """Tests that listing rules does not issue per-row owner or session queries."""
+        self.assertConstantQueries('/urls_list/')
+
+    def test_viewset_queries(self):
+        """Tests that the viewset list and detail do not query owners or sessions."""
+        self.assertConstantQueries('/urls/')
+        with self.assertNumQueries(1):
+            data = self.client.get('/urls/{}/'.format(self.url.id)).json()
+        self.assertEqual(data['owner'], self.owner.session_id)
+
+
+class ExportTest(RuleTestCase):
+    """Tests for the streaming rule export."""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(4):
+            Url.objects.create(link='https://example.com/{}'.format(i), alias='host/s{}'.format(i), subpart='s{}'.format(i),
+                               expire_date=self.url.expire_date + timedelta(days=i), owner=self.owner)
+
+    def test_endpoint(self):
+        """Tests that the export streams filtered rows as NDJSON and CSV."""
+        response = self.client.get('/export/', {'expire_from': (self.url.expire_date + timedelta(days=1)).isoformat()})
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['subpart'] for row in rows], ['s1', 's2', 's3'])
+        response = self.client.get('/export/', {'format': 'csv', 'owner': self.owner.id})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual((lines[0], len(lines)), ('id,link,alias,subpart,expire_date,owner_id', 6))
+        self.assertEqual(self.client.get('/export/', {'expire_to': 'tomorrow'}).status_code, 400)
+
+    def test_command(self):
+        """Tests that the rows are read in primary-key chunks and written by the management command."""
+        self.assertEqual([row[0] for row in export_rows(Url.objects.all(), chunk_size=2)],
+                         list(Url.objects.order_by('id').values_list('id', flat=True)))
+        out = StringIO()
+        call_command('export_rules', '--format=csv', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 6)
+
+
+class CleanupTest(RuleTestCase):
+    """Tests for the expired rule cleanup."""
+
+    def test_delete_expired(self):
+        """Tests that expired rules, their collections and cached redirects are removed in batches."""
+        today = timezone.localdate()
+        for i in range(5):
+            url = Url.objects.create(link='https://example.com/{}'.format(i), alias='host/s{}'.format(i),
+                                     subpart='s{}'.format(i), expire_date=today, owner=self.owner)
+            Collection.objects.create(owner=self.owner, url=url)
+            ClickStat.objects.create(url=url, kind=ClickStat.TOTAL, clicks=1)
+            cache.set(redirect_key(url.subpart), url.link)
+        self.assertEqual(delete_expired_urls(batch_size=2), 5)
+        self.assertEqual(list(Url.objects.values_list('subpart', flat=True)), ['abc'])
+        self.assertFalse(Collection.objects.exists() or ClickStat.objects.exists())
+        self.assertIsNone(cache.get(redirect_key('s0')))
+
+
+class LogRetentionTest(RuleTestCase):
+    """Tests for structured log records, retention and archiving."""
+
+    def add_logs(self, days, count):
+        Log.objects.bulk_create([Log(owner=self.owner, event=Log.RULE_CREATED, rule_id=i, payload={'collection': i},
+                                     date_time=timezone.now() - timedelta(days=days)) for i in range(count)])
+
+    def test_rule_created_record(self):
+        """Tests that creating a rule from the form writes one structured record."""
+        with mock.patch('app.common.log_buffer', LogBuffer(0, 1, 1)):
+            self.client.post('/', {'link': 'https://example.com/logged', 'domain': 'host', 'subpart': 'logged',
+                                   'expire_date': self.url.expire_date.strftime('%d.%m.%Y')})
+        url = Url.objects.get(subpart='logged')
+        log = Log.objects.get(event=Log.RULE_CREATED)
+        self.assertEqual((log.rule_id, log.payload), (url.id, {'collection': Collection.objects.get(url=url).id}))
+
+    def test_clean_logs_with_archive(self):
+        """Tests that old records are archived to NDJSON.gz and deleted in batches, recent ones are kept."""
+        self.add_logs(100, 5)
+        self.add_logs(1, 2)
+        with tempfile.TemporaryDirectory() as folder:
+            with mock.patch('app.log_retention.LOG_ARCHIVE_DIR', folder), \
+                    mock.patch('app.log_retention.expire_logs', lambda before, archive: expire_logs(before, archive, batch_size=2)):
+                self.assertEqual(clean_logs(), 5)
+            name, = os.listdir(folder)
+            with gzip.open(os.path.join(folder, name), 'rt', encoding='utf-8') as archive:
+                rows = [json.loads(line) for line in archive]
+        self.assertEqual([row['rule_id'] for row in rows], [0, 1, 2, 3, 4])
+        self.assertEqual((rows[0]['event'], rows[0]['payload']), (Log.RULE_CREATED, {'collection': 0}))
+        self.assertEqual(Log.objects.filter(event=Log.RULE_CREATED).count(), 2)
+
+    def test_archive_command(self):
+        """Tests that the command exports without deleting unless asked to."""
+        self.add_logs(100, 3)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'logs.ndjson.gz')
+            call_command('archive_logs', path, stdout=StringIO())
+            self.assertEqual(Log.objects.count(), 3)
+            call_command('archive_logs', path, '--delete', stdout=StringIO())
+            with gzip.open(path, 'rt', encoding='utf-8') as archive:
+                self.assertEqual(len(archive.readlines()), 6)
+        self.assertFalse(Log.objects.exists())
+
+
+class SchedulerTest(RuleTestCase):
+    """Tests for the periodic task scheduler."""
+
+    def test_cron(self):
+        """Tests the next run calculation of cron schedules."""
+        moment = timezone.localtime().replace(year=2026, month=10, day=18, hour=10, minute=7)   # Sunday
+        self.assertEqual(CronSchedule('5 0 * * *').next_after(moment), moment.replace(day=19, hour=0, minute=5, second=0, microsecond=0))
+        self.assertEqual(CronSchedule('*/15 * * * *').next_after(moment).minute, 15)
+        self.assertEqual(CronSchedule('0 9 * * 1-5').next_after(moment).day, 19)
+        with self.assertRaises(ValueError):
+            CronSchedule('61 * * * *')
+
+    def test_single_leader(self):
+        """Tests that one scheduler holds the leadership and each slot runs once."""
+        calls = []
+        first = Scheduler([Job('test', lambda: calls.append(1), '* * * * *')], tick=1)
+        second = Scheduler([Job('test', lambda: calls.append(2), '* * * * *')], tick=1)
+        self.assertTrue(first.is_leader())
+        self.assertFalse(second.is_leader())
+        now = timezone.localtime()
+        for job in first.jobs + second.jobs:
+            job.plan(now - timedelta(minutes=1))
+            job.due = now
+        self.assertEqual(first.run_pending(), 1)
+        self.assertFalse(second.run_job(second.jobs[0]))
+        self.assertEqual(calls, [1])
+        history, recent = run_history('test')
+        self.assertEqual((history['runs'], recent[0]['status']), ('1', 'ok'))
+
+    def test_leader_renewed_during_job(self):
+        """Tests that the leader lock outlives a job longer than its timeout."""
+        scheduler = Scheduler([Job('slow', lambda: threading.Event().wait(1.3), '* * * * *')], tick=0.1)
+        other = Scheduler([], tick=0.1)
+        self.assertTrue(scheduler.is_leader())
+        now = timezone.localtime()
+        scheduler.jobs[0].plan(now - timedelta(minutes=1))
+        scheduler.jobs[0].due = now
+        self.assertEqual(scheduler.run_pending(), 1)
+        self.assertFalse(other.is_leader())
+        self.assertTrue(scheduler.leader.owned())
+
+
+class MetricsTest(RuleTestCase):
+    """Tests for the request metrics middleware and endpoint."""
+
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+
+    def test_request_metrics(self):
+        """Tests that DB queries, Redis calls and cache layers of requests are exported per view."""
+        self.client.get('/abc')
+        self.client.get('/abc')
+        text = self.client.get('/metrics/').content.decode()
+        self.assertIn('http_requests_total{view="redirect_subpart",status="302"} 2', text)
+        self.assertIn('http_request_duration_seconds_count{view="redirect_subpart"} 2', text)
+        self.assertIn('http_request_db_queries_bucket{view="redirect_subpart",le="0"} 2', text)
+        self.assertIn('http_cache_requests_total{view="redirect_subpart",layer="l1",result="miss"} 1', text)
+        self.assertIn('http_cache_requests_total{view="redirect_subpart",layer="l1",result="hit"} 1', text)
+        self.assertIn('http_cache_requests_total{view="redirect_subpart",layer="redis",result="hit"} 1', text)
+        self.assertIn('http_request_redis_calls_sum{view="redirect_subpart"} 2', text)
+
+    def test_threads_merged(self):
+        """Tests that values written by other threads are summed on export."""
+        worker = threading.Thread(target=registry.inc, args=('http_slow_requests_total', ('x',), 2))
+        worker.start()
+        worker.join()
+        registry.inc('http_slow_requests_total', ('x',))
+        self.assertIn('http_slow_requests_total{view="x"} 3', registry.render())
+
+    def test_slow_request_log(self):
+        """Tests that a sampled slow request is logged with its SQL."""
+        with mock.patch('app.metrics.METRICS_SLOW_REQUEST', 1e-9), mock.patch('app.metrics.METRICS_SLOW_SAMPLE', 1):
+            with self.assertLogs('app.metrics', 'WARNING') as logs:
+                self.client.get('/redirect_to/{}/'.format(self.url.id))
+        self.assertIn('app_url', logs.output[0])
+
+
+class BenchmarkTest(RuleTestCase):
+    """Tests for the benchmark helpers."""
+
+    def test_measure_and_compare(self):
+        """Tests the measured metrics and the regression flags of a report comparison."""
+        result = measure(lambda i: Url.objects.count(), 5)
+        self.assertEqual((result['requests'], result['queries']), (5, 1.0))
+        self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        base = {'results': {'list': dict(result, rps=100.0, queries=1.0)}}
+        new = {'results': {'list': dict(result, rps=80.0, queries=1.0)}}
+        diff = compare(base, new)['list']
+        self.assertEqual(diff['rps'], (100.0, 80.0, -20.0, True))
+        self.assertFalse(diff['queries'][3])
+
+
+class AsyncRedisStub:
+    """Async facade over the test cache connection."""
+
+    def __init__(self):
+        self.conn = get_redis_connection('default')
+
+    async def get(self, key):
+        return self.conn.get(key)
+
+    def register_script(self, script):
+        run = self.conn.register_script(script)
+
+        async def call(keys=(), args=()):
+            return run(keys=keys, args=args)
+        call.registered_client = self
+        return call
+
+    def pipeline(self, transaction=True):
+        pipe = self.conn.pipeline(transaction=transaction)
+        execute = pipe.execute
+
+        async def aexecute():
+            return execute()
+        pipe.execute = aexecute
+        return pipe
+
+
+class AsyncRedirectTest(RuleTestCase):
+    """Tests for the async redirect view."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('app.common.get_async_redis', AsyncRedisStub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def redirect(self, subpart):
+        return async_to_sync(aredirect_subpart)(RequestFactory().get('/' + subpart), subpart)
+
+    def test_redis_hit(self):
+        """Tests that a cached mapping is served and counted through the async client."""
+        get_link('abc')
+        local_links.clear()
+        self.assertEqual(self.redirect('abc')['Location'], 'https://example.com/long')
+        self.assertEqual(self.redirect('abc')['Location'], 'https://example.com/long')
+        flush_clicks()
+        self.assertEqual(ClickStat.objects.get(url=self.url, kind='total').clicks, 2)
+
+    def test_unknown(self):
+        """Tests that a miss falls back to the DB loader and ends in 404."""
+        with mock.patch('app.common.load_link_in_thread', return_value='') as load:
+            with self.assertRaises(Http404):
+                self.redirect('missing')
+        load.assert_called_once_with('missing')
@@ -1,6 +1,7 @@
 ''' Маршрутизация ссылок приложения. '''
 
 from app import forms, views
+from django.conf import settings
 from django.urls import include, path
 
 from rest_framework import routers
@@ -14,6 +15,10 @@ urlpatterns = [
     path('', include(router.urls)),
     #path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),                     # кнопка 'log in'
     path('urls_list/', views.UrlList.as_view()),                                                        # на основе класса ListAPIView
+    path('export/', views.export_rules, name='export_rules'),                                           # потоковая выгрузка правил NDJSON/CSV
+    path('metrics/', views.prometheus_metrics, name='metrics'),                                         # метрики запросов в формате Prometheus
     # api # path('short/'), views,  
+    # перенаправление по короткой ссылке (последним): асинхронное при запуске через ASGI
+    path('<str:subpart>', views.aredirect_subpart if settings.ASYNC_REDIRECT else views.redirect_subpart, name='redirect_subpart'),
 ]
 
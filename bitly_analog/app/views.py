@@ -1,6 +1,6 @@
 """ Definition of views. """
 
-import threading, inspect
+import threading
 
 from django.http import HttpRequest
 from django.shortcuts import render, redirect
@@ -8,22 +8,24 @@ from django.db import IntegrityError
 from datetime import datetime, timedelta
 
 from .models import Log, Session, Owner, Url, Collection
-from .forms import Mainform
+from .forms import Mainform, SUBPART_DUPLICATE
 
 # модули
-from .common import logger, is_subpart_exists, get_owner, get_fname, paginate, redirect_to, ajax_check_subpart, caching 
-from .periodic_tasks import clean_urls, scheduller
+from .common import logger, is_subpart_exists, get_owner, redirect_to, redirect_subpart, aredirect_subpart, ajax_check_subpart, \
+    caching, save_rule, find_rule, DEDUPLICATE_LINKS
 from .api import UrlList, UrlViewSet
+from .export import export_rules
+from .metrics import prometheus_metrics
+from .subparts import pop_subpart, renew_subpart
+from .ratelimit import ratelimit
 
 
 # ----- Глобальные переменные 
 DB_ERROR = 'Ошибка доступа к БД.'                                                       # ошибка при обращении к БД для записи лога
 
-# запуск задачи clean_rules после запуска проекта на host-сервере
-scheduller(clean_urls, 'периодическая очистка URL-правил в БД')
-
 # ----- Представления HTML-страниц 
 
+@ratelimit('create', methods=('POST',))                                                # запись правил - не чаще лимита
 def home(request):
     ''' Главная страница серсвиса. 
         Аргументы:
@@ -34,7 +36,6 @@ def home(request):
     assert isinstance(request, HttpRequest)                                             # проверка принадлежности объекта запроса к своему классу
     url = None
     owner = get_owner(request)                                                          # инициализация пользователя
-    process = get_fname(inspect.currentframe())                                         # имя текущей функции
 
     # данные для начальной формы - срок жизни правила (в сутках)
     default_data = {'expire_date': datetime.now().date() + timedelta(days=owner.url_ttl)} 
@@ -46,17 +47,30 @@ def home(request):
     if request.method == 'POST':
         if mainform.is_valid():                                                         # учтена проверка субдомена          
             url = mainform.save(commit=False)                                           # инициализация объекта Url
-            url.alias = '{}/{}'.format(mainform.cleaned_data['domain'], url.subpart)    # формирование короткой ссылки 
-            url.owner = owner                                                           # добавление пользователя
-            url.save()                                                                  # сохранение формы - запись объекта правила в БД
-            logger(owner, process, 'Создан объект правила с id: ' + str(url.id))        # запись лога в БД 
-            
-            url_col = Collection.objects.create(owner=get_owner(request), url=url)      # создание нового правила в БД-коллекцию пользователя
-            logger(owner, process, 
-                   'Создан объект коллекци правил с id: ' + str(url_col.id))            # запись лога в БД  
-            
-            savemsg = '{}'.format(url)                                                  # из метода __str__ модели  
-            mainform = Mainform(default_data)                                           # чистая форма после записи предыдущих данных
+            generated = not url.subpart                                                 # субдомен не задан пользователем
+            existing = find_rule(owner, url.link) if generated and DEDUPLICATE_LINKS else None
+            if existing:                                                                # ссылка уже сокращена пользователем
+                if existing.expire_date < url.expire_date:                              # продление правила до новой даты
+                    existing.expire_date = url.expire_date
+                    existing.save(update_fields=['expire_date'])                        # маппинг в кэше обновляет сигнал
+                url = existing
+                savemsg = 'Ссылка уже сокращена: {}'.format(url)
+                mainform = Mainform(default_data)
+            else:
+                if generated:
+                    url.subpart = pop_subpart()                                         # свободный субдомен из пула
+                url.alias = '{}/{}'.format(mainform.cleaned_data['domain'], url.subpart)    # формирование короткой ссылки 
+                url.owner = owner                                                       # добавление пользователя
+                if save_rule(url, renew_subpart if generated else None):                # запись правила в БД и его маппинга в кэш (сигнал)
+                    url_col = Collection.objects.create(owner=owner, url=url)           # создание нового правила в БД-коллекцию пользователя
+                    logger(owner, Log.RULE_CREATED, url.id, collection=url_col.id)      # запись лога в БД 
+
+                    savemsg = '{}'.format(url)                                          # из метода __str__ модели  
+                    mainform = Mainform(default_data)                                   # чистая форма после записи предыдущих данных
+                else:
+                    url = None
+                    mainform.add_error('subpart', SUBPART_DUPLICATE)                    # субдомен занят (уникальный индекс)
+                    errors = mainform.errors
         else:
             errors = mainform.errors                                                    # ошибки валидации формы
     # --- end of POST
@@ -69,5 +83,5 @@ def home(request):
         'errors': errors,
     }
 
-    context.update(caching(request, owner, process, url, 'cache_key', 'url'))           # контекст кэширования
+    context.update(caching(request, owner))                                             # контекст кэширования
     return render(request, 'app/index.html', context)
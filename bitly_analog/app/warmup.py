@@ -0,0 +1,115 @@
+# ----- Прогрев кэша маппингов перенаправлений и сверка кэша с таблицей Url
+
+import threading
+from itertools import islice
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from .models import Url
+from .common import REDIRECT_KEY, MISSING_LINK, cache_links, link_target
+from .export import export_rows
+from .cache_fill import release
+
+
+# ----- Глобальные переменные
+WARMUP_CHUNK_SIZE = getattr(settings, 'WARMUP_CHUNK_SIZE', 5000)                        # правил в одном запросе к БД и одном конвейере Redis
+WARMUP_ON_START = getattr(settings, 'WARMUP_ON_START', False)                           # прогрев при запуске процесса сервера после сброса Redis
+WARMUP_DONE_KEY = 'warmup:done'                                                         # метка прогретого кэша (пропадает вместе с данными Redis)
+WARMUP_LOCK = 'warmup:lock'                                                             # ключ блокировки прогрева
+WARMUP_LOCK_TTL = 600                                                                   # предел удержания блокировки (сек)
+WARMUP_FIELDS = ('id', 'subpart', 'link', 'expire_date', 'redirect_status')             # поля правила для маппинга
+
+
+def warm_links(chunk_size=WARMUP_CHUNK_SIZE):
+    ''' Запись маппингов всех действующих правил (дата удаления позже сегодняшней) в кэш:
+        правила читаются пачками по первичному ключу, каждая пачка пишется одним конвейером SET EX
+        с TTL по дате удаления. Возвращает число записанных маппингов.
+        Аргументы:
+        chunk_size (int) -- число правил в пачке
+    '''
+    rows = export_rows(Url.objects.filter(expire_date__gt=timezone.localdate()), chunk_size, WARMUP_FIELDS)
+    count = 0
+    while True:
+        chunk = [row[1:] for row in islice(rows, chunk_size)]
+        if not chunk:
+            break
+        cache_links(chunk)
+        count += len(chunk)
+    cache.set(WARMUP_DONE_KEY, 1, timeout=None)
+    return count
+
+
+def reconcile_links(chunk_size=WARMUP_CHUNK_SIZE):
+    ''' Сверка маппингов в Redis с таблицей Url (обход ключей SCAN пачками): удаляются маппинги
+        без действующего правила, переписываются маппинги, расходящиеся с правилом (в т.ч. негативные записи
+        для существующего правила). Негативные записи без правила сохраняются.
+        Маппинг правила, созданного во время сверки, может быть удалён - его восстановит следующий промах.
+        Возвращает (проверено, удалено, исправлено).
+        Аргументы:
+        chunk_size (int) -- число ключей в пачке (подсказка COUNT для SCAN, один MGET и один запрос к БД)
+    '''
+    conn = get_redis_connection('default')
+    prefix = cache.make_key(REDIRECT_KEY.format(''))
+    keys = conn.scan_iter(match=prefix + '*', count=chunk_size)
+    checked = removed = fixed = 0
+    while True:
+        batch = list(islice(keys, chunk_size))
+        if not batch:
+            break
+        values = conn.mget(batch)
+        subparts = [key.decode()[len(prefix):] for key in batch]
+        rules = {subpart: rule for subpart, *rule in Url.objects.filter(
+            subpart__in=subparts, expire_date__gt=timezone.localdate()).values_list('subpart', 'link', 'expire_date', 'redirect_status')}
+        stale, drift = [], []
+        for key, subpart, value in zip(batch, subparts, values):
+            if value is None:                                                           # истёк во время обхода
+                continue
+            target = cache.client.decode(value)
+            rule = rules.get(subpart)
+            if rule is None:
+                if target != MISSING_LINK:
+                    stale.append(key)
+            elif target != link_target(*rule):
+                drift.append((subpart, *rule))
+        if stale:
+            conn.delete(*stale)
+        if drift:
+            cache_links(drift)
+        checked += len(batch)
+        removed += len(stale)
+        fixed += len(drift)
+    return checked, removed, fixed
+
+
+def warm_once():
+    ''' Прогрев кэша одним процессом кластера (блокировка в Redis), если метка прогрева отсутствует.
+        Возвращает число записанных маппингов (0 - прогрев не потребовался или выполняется другим процессом).
+    '''
+    if cache.get(WARMUP_DONE_KEY):
+        return 0
+    lock = get_redis_connection('default').lock(cache.make_key(WARMUP_LOCK), timeout=WARMUP_LOCK_TTL)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        return warm_links()
+    finally:
+        release(lock)                                                                   # снимается только владельцем
+
+
+def warm_in_thread():
+    ''' Прогрев в фоновом потоке с закрытием соединения потока с БД. '''
+    try:
+        warm_once()
+    finally:
+        connection.close()
+
+
+def warm_on_start():
+    ''' Прогрев кэша при запуске процесса сервера (WARMUP_ON_START) в фоновом потоке: запросы обслуживаются сразу,
+        промахи до окончания прогрева идут в БД. Вызывается из bitly_analog.wsgi / bitly_analog.asgi.
+    '''
+    if WARMUP_ON_START:
+        threading.Thread(target=warm_in_thread, name='warm_links', daemon=True).start()
@@ -0,0 +1,26 @@
+"""
+ASGI config for bitly_analog project.
+
+This module exposes the ASGI callable as a module-level variable named
+``application``. Under an ASGI server (e.g. ``uvicorn bitly_analog.asgi:application``)
+with ``ASYNC_REDIRECT = True`` in settings, the short link redirect is served by
+an async view, so one process can hold many concurrent redirects while they wait
+on Redis. Form and API views stay synchronous and run in Django's thread pool.
+
+For more information, visit
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault(
+    'DJANGO_SETTINGS_MODULE',
+    'bitly_analog.settings')
+
+application = get_asgi_application()
+
+# Warm the redirect cache in the background after a Redis restart or flush
+# (WARMUP_ON_START in settings; one process of the cluster does the work).
+from app.warmup import warm_on_start
+warm_on_start()
@@ -0,0 +1,30 @@
+"""
+Settings for benchmarks (manage.py benchmark --settings=bitly_analog.bench_settings).
+
+SQLite instead of MySQL and an in-process Redis stand-in (fakeredis; Lua scripts need lupa):
+    pip install fakeredis lupa
+"""
+
+import fakeredis
+
+from bitly_analog.settings import *
+
+
+BENCHMARK_STANDIN = True        # хранилища - заглушки процесса: команда benchmark может очищать кэш
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'bench.sqlite3'),   # база замеров создаётся как тестовая (в памяти)
+    }
+}
+
+CACHES['default']['OPTIONS']['CONNECTION_POOL_KWARGS'] = {
+    'connection_class': fakeredis.FakeConnection,
+    'server': fakeredis.FakeServer(),
+}
+
+DEBUG = False
+RATE_LIMITS = {}                # замеры без ограничения частоты запросов
+LOG_BUFFER_SIZE = 0             # записи Log - синхронно: без фонового потока, пишущего в SQLite
+SUBPART_POOL_LOW = 0            # пул субдоменов заполняется при засеве, без фонового пополнения
@@ -37,15 +37,16 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     # Add your apps here to enable them
-    'app',
+    'app.apps.MainConfig',
     'rest_framework',
 ]
 
 # Middleware framework
 # https://docs.djangoproject.com/en/2.1/topics/http/middleware/
 MIDDLEWARE = [
+    'app.metrics.MetricsMiddleware',                        # показатели запросов (первым: время включает остальные слои)
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'app.middleware.SessionlessMiddleware',                 # SessionMiddleware с обходом сессий для перенаправлений и чтения API
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -74,6 +75,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'bitly_analog.wsgi.application'
+ASGI_APPLICATION = 'bitly_analog.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
@@ -84,6 +86,9 @@ DATABASES = {
     }
 }
 
+# Тип автоматических первичных ключей моделей
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
 '''
 {
         # MySQL engine. Powered by the mysqlclient module.
@@ -103,11 +108,99 @@ CACHES = {
         'LOCATION': 'redis://127.0.0.1:6379/',
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_CLASS': 'app.metrics.CountingConnectionPool',     # учёт обращений к Redis в метриках запросов
         }
     }
 }
 
 
+# Время жизни объектов кэша по умолчанию (сек), в т.ч. страниц списка правил пользователя
+CACHE_TTL = 60 * 5
+
+# Локальный (L1) кэш редиректов в памяти каждого процесса перед Redis
+REDIRECT_L1_SIZE = 10000    # максимальное число маппингов subpart -> link (0 - отключить)
+REDIRECT_L1_TTL = 60        # время жизни маппинга (сек): изменения правил доходят до процессов через Redis Pub/Sub,
+                            # TTL - предел устаревания при обрыве подписки
+# Асинхронное перенаправление (включать при запуске через ASGI: bitly_analog.asgi)
+ASYNC_REDIRECT = False
+ASYNC_REDIS_MAX_CONNECTIONS = 100   # предел пула соединений асинхронного клиента Redis на процесс
+# Негативный кэш: время (сек), на которое запоминается отсутствие правила для субдомена
+REDIRECT_MISS_TTL = 30
+
+# Генерация субдоменов: длина (base62) и пул заранее проверенных свободных субдоменов в Redis
+SUBPART_LENGTH = 7
+SUBPART_POOL_SIZE = 1000    # размер пула
+SUBPART_POOL_LOW = 250      # порог фонового пополнения пула
+
+# Очистка правил с наступившей датой удаления: число правил в одной транзакции
+CLEAN_BATCH_SIZE = 1000
+
+# Планировщик периодических задач (процесс manage.py run_scheduler, задачи выполняет один ведущий процесс)
+SCHEDULER_TICK = 10         # период проверки расписания (сек)
+SCHEDULER_JOBS = [
+    # cron: минута час день месяц день_недели; jitter - случайная задержка запуска (сек)
+    {'name': 'clean_urls', 'task': 'app.periodic_tasks.clean_urls', 'cron': '5 0 * * *', 'jitter': 300},
+    {'name': 'refill_subpart_pool', 'task': 'app.subparts.refill_subpart_pool', 'cron': '*/5 * * * *', 'jitter': 30},
+    {'name': 'flush_clicks', 'task': 'app.clicks.flush_clicks', 'cron': '* * * * *', 'jitter': 0},
+    {'name': 'clean_logs', 'task': 'app.log_retention.clean_logs', 'cron': '35 0 * * *', 'jitter': 300},
+    # полный обход таблицы Url: освобождённые субдомены убираются из фильтра (до этого - лишь ложные "занят")
+    {'name': 'rebuild_subpart_filter', 'task': 'app.bloom.rebuild_subpart_filter', 'cron': '15 3 * * 0', 'jitter': 600},
+]
+
+# Перенаправление по короткой ссылке: код по умолчанию (301/302/307, правило может задать свой) и предел
+# Cache-Control: max-age (сек, не дольше срока жизни правила). Переходы из кэша браузера/CDN не попадают в счётчики.
+REDIRECT_STATUS = 302
+REDIRECT_MAX_AGE = 3600
+
+# Прогрев кэша маппингов (manage.py warm_cache; --reconcile - сверка ключей Redis с таблицей Url)
+WARMUP_CHUNK_SIZE = 5000    # правил в одном запросе к БД и одном конвейере Redis
+WARMUP_ON_START = False     # прогрев в фоне при запуске каждого процесса сервера, если Redis сброшен (метка прогрева отсутствует)
+
+# Повторное сокращение той же ссылки пользователем возвращает его действующее правило (поиск по индексу хэша ссылки)
+DEDUPLICATE_LINKS = True
+
+# Счётчики переходов: копятся в Redis, в таблицу ClickStat переносятся задачей flush_clicks
+CLICKS_FLUSH_BATCH = 500    # число правил в одной пачке сброса
+
+# Буфер записей Log: запись в БД пачками из фонового потока
+LOG_BUFFER_SIZE = 10000     # предел очереди в памяти процесса, сверх него записи отбрасываются (0 - синхронная запись)
+LOG_FLUSH_SIZE = 500        # число записей для досрочного сброса
+LOG_FLUSH_INTERVAL = 2      # период сброса (сек)
+# Срок хранения записей Log: задача clean_logs удаляет старые записи пачками (архив - manage.py archive_logs)
+LOG_RETENTION_DAYS = 90     # срок хранения (сутки, 0 - бессрочно)
+LOG_ARCHIVE_DIR = None      # каталог архивов NDJSON.gz задачи clean_logs (None - удаление без архива)
+LOG_CLEAN_BATCH = 5000      # число записей, удаляемых одним запросом
+
+
+# Метрики запросов (app.metrics): текстовый формат Prometheus по адресу /metrics/
+METRICS_ALLOWED_IPS = ['127.0.0.1']    # адреса сборщика метрик (пусто - без ограничения)
+METRICS_SLOW_REQUEST = 0.5  # порог медленного запроса (сек): такие запросы пишутся в лог app.metrics вместе с SQL (0 - отключить)
+METRICS_SLOW_SAMPLE = 0.1   # доля запросов, для которых копится SQL (выборка медленных запросов)
+METRICS_SQL_LIMIT = 50      # предел числа запросов SQL в записи лога
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {'app.metrics': {'handlers': ['console'], 'level': 'WARNING'}},
+}
+
+
+# Django REST framework: число правил на странице API (пагинация по ключу, см. app.pagination)
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'app.pagination.KeysetPagination',
+    'PAGE_SIZE': 100,
+    'DEFAULT_THROTTLE_CLASSES': ['app.ratelimit.RedisRateThrottle'],   # лимит области throttle_scope (по умолчанию 'api')
+}
+
+# Лимиты частоты запросов с одного IP-адреса (корзина токенов в Redis, см. app.ratelimit): 'N/s|m|h|d'
+RATE_LIMITS = {
+    'create': '30/m',   # запись правила с главной страницы
+    'check': '120/m',   # проверка субдомена (AJAX)
+    'api': '300/m',     # API правил
+    'bulk': '10/m',     # пакетное создание правил
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -139,5 +232,7 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = posixpath.join(*(BASE_DIR.split(os.path.sep) + ['static']))
 
-# Запись сесии при любом своём изменении в БД и отправка куки при каждом запросе
-SESSION_SAVE_EVERY_REQUEST = True
\ No newline at end of file
+# Сессии читаются из кэша Redis с записью в БД; запись - только при изменении сессии
+# (создание пользователя и продление раз в сутки, см. app.common.get_owner)
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_SAVE_EVERY_REQUEST = False
\ No newline at end of file
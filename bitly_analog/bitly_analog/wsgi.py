@@ -27,3 +27,8 @@ os.environ.setdefault(
 # file. This includes Django's development server, if the WSGI_APPLICATION
 # setting points here.
 application = get_wsgi_application()
+
+# Warm the redirect cache in the background after a Redis restart or flush
+# (WARMUP_ON_START in settings; one process of the cluster does the work).
+from app.warmup import warm_on_start
+warm_on_start()